@@ -0,0 +1,256 @@
+import os
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import cfdi
+from settings import ARCHIVE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Invoice archive.
+#
+# Every invoice a job brings back is kept: the ZIP and the PDF/XML inside
+# it are stored once under their SHA-256 (blobs/ab/abcdef...), and an
+# SQLite index maps rfc, ticket, folio_factura, servicio, fecha and the CFDI
+# UUID to them. A repeated request for the same ticket, a re-download or a
+# monthly report is then answered from disk instead of from the portal.
+
+ARTIFACT_KINDS = ('zip', 'pdf', 'xml')
+
+# Searchable request fields, in the order they appear in the index
+SEARCH_FIELDS = ('servicio', 'rfc', 'ticket', 'folio_factura', 'uuid')
+
+FECHA_COMPRA_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d')
+
+
+def normalize_date(value):
+    """ISO date (YYYY-MM-DD) from the date formats clients send, or None"""
+    if not value:
+        return None
+    value = str(value).strip()[:10]
+    for fmt in FECHA_COMPRA_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+class InvoiceArchive:
+    """Content-addressed invoice files with an SQLite search index"""
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = Path(directory)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        # Opened on first use so importing this module stays free of disk access
+        if self._conn is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.directory / 'index.sqlite3'),
+                                         check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS invoices (
+                    invoice_id TEXT PRIMARY KEY,
+                    servicio TEXT NOT NULL,
+                    rfc TEXT,
+                    ticket TEXT,
+                    folio_factura TEXT,
+                    fecha_compra TEXT,
+                    fecha TEXT,
+                    uuid TEXT,
+                    job_id TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS invoices_rfc ON invoices (rfc, fecha);
+                CREATE INDEX IF NOT EXISTS invoices_ticket ON invoices (servicio, ticket);
+                CREATE INDEX IF NOT EXISTS invoices_folio ON invoices (folio_factura);
+                CREATE INDEX IF NOT EXISTS invoices_uuid ON invoices (uuid);
+                CREATE INDEX IF NOT EXISTS invoices_fecha ON invoices (fecha);
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    invoice_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    PRIMARY KEY (invoice_id, kind)
+                );
+            """)
+        return self._conn
+
+    # -- blobs --
+
+    def blob_path(self, digest):
+        return self.directory / 'blobs' / digest[:2] / digest
+
+    def _put_blob(self, content):
+        """Store bytes under their SHA-256 (once) and return the digest"""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.blob_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return digest
+
+    # -- writing --
+
+    def store(self, zip_path, data, servicio, job_id=None, metadata=None):
+        """Archive a job's invoice ZIP and its PDF/XML members; returns the index record"""
+        zip_path = Path(zip_path)
+        zip_bytes = zip_path.read_bytes()
+        artifacts = {'zip': (zip_path.name, zip_bytes)}
+        with zipfile.ZipFile(zip_path) as zf:
+            for name in zf.namelist():
+                kind = Path(name).suffix.lower().lstrip('.')
+                if kind in ARTIFACT_KINDS and kind not in artifacts:
+                    artifacts[kind] = (Path(name).name, zf.read(name))
+
+        if metadata is None:
+            metadata = cfdi.parse_zip(zip_path) or {}
+        invoice_uuid = metadata.get("uuid")
+        if invoice_uuid:
+            existing = self.search(uuid=invoice_uuid, limit=1)
+            if existing:
+                return self._add_artifacts(existing[0], artifacts)
+
+        fecha_compra = data.get('fecha_compra')
+        record = {
+            "invoice_id": uuid.uuid4().hex,
+            "servicio": servicio,
+            "rfc": (data.get('rfc') or '').strip().upper() or None,
+            "ticket": str(data['ticket']).strip() if data.get('ticket') else None,
+            "folio_factura": str(data['folio_factura']).strip() if data.get('folio_factura') else None,
+            "fecha_compra": str(fecha_compra) if fecha_compra else None,
+            "fecha": normalize_date(metadata.get("fecha")) or normalize_date(fecha_compra) or datetime.now().date().isoformat(),
+            "uuid": invoice_uuid,
+            "job_id": job_id,
+            "created_at": time.time(),
+        }
+        rows = [(record["invoice_id"], kind, name, self._put_blob(content), len(content))
+                for kind, (name, content) in artifacts.items()]
+
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                db.execute(
+                    "INSERT INTO invoices VALUES (:invoice_id, :servicio, :rfc, :ticket, :folio_factura, "
+                    ":fecha_compra, :fecha, :uuid, :job_id, :created_at)",
+                    record,
+                )
+                db.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?)", rows)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+        logger.info("Archived invoice %s (%s)", record["invoice_id"], ", ".join(artifacts))
+        return self.get(record["invoice_id"])
+
+    def _add_artifacts(self, record, artifacts):
+        """
+        Attach the files of a repeated download to an archived invoice. A
+        ZIP holding more files (say PDF and XML after an XML-only formato)
+        replaces the stored one; otherwise only missing kinds are added.
+        """
+        upgrade = set(artifacts) > set(record["artifacts"])
+        verb = "INSERT OR REPLACE" if upgrade else "INSERT OR IGNORE"
+        rows = [(record["invoice_id"], kind, name, self._put_blob(content), len(content))
+                for kind, (name, content) in artifacts.items()]
+        with self._lock:
+            self._db().executemany(f"{verb} INTO artifacts VALUES (?, ?, ?, ?, ?)", rows)
+        logger.info("Invoice %s already archived as %s", record["uuid"], record["invoice_id"])
+        return self.get(record["invoice_id"])
+
+    # -- reading --
+
+    def _with_artifacts(self, rows):
+        records = [dict(row) for row in rows]
+        if not records:
+            return records
+        by_id = {record["invoice_id"]: record for record in records}
+        for record in records:
+            record["artifacts"] = {}
+        placeholders = ", ".join("?" * len(by_id))
+        with self._lock:
+            artifact_rows = self._db().execute(
+                f"SELECT * FROM artifacts WHERE invoice_id IN ({placeholders})", list(by_id)
+            ).fetchall()
+        for row in artifact_rows:
+            by_id[row["invoice_id"]]["artifacts"][row["kind"]] = {
+                "name": row["name"], "sha256": row["sha256"], "size": row["size"],
+            }
+        return records
+
+    def get(self, invoice_id):
+        with self._lock:
+            row = self._db().execute("SELECT * FROM invoices WHERE invoice_id = ?", (invoice_id,)).fetchone()
+        records = self._with_artifacts([row] if row else [])
+        return records[0] if records else None
+
+    def search(self, desde=None, hasta=None, limit=100, offset=0, **filters):
+        """Invoices matching the exact-match filters and the fecha range, newest first"""
+        clauses, params = [], []
+        for field in SEARCH_FIELDS:
+            value = filters.get(field)
+            if value:
+                if field in ('rfc', 'uuid'):
+                    value = str(value).strip().upper()
+                clauses.append(f"{field} = ?")
+                params.append(str(value).strip())
+        if desde:
+            clauses.append("fecha >= ?")
+            params.append(desde)
+        if hasta:
+            clauses.append("fecha <= ?")
+            params.append(hasta)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._db().execute(
+                f"SELECT * FROM invoices {where} ORDER BY fecha DESC, created_at DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return self._with_artifacts(rows)
+
+    def find_for_request(self, servicio, data, kinds=('zip',)):
+        """An archived invoice for the same portal ticket (and RFC, when given) with all `kinds` of files, or None"""
+        if not data.get('ticket'):
+            return None
+        matches = self.search(servicio=servicio, ticket=data['ticket'], rfc=data.get('rfc'),
+                              folio_factura=data.get('folio_factura'), limit=1)
+        if matches and all(kind in matches[0]["artifacts"] for kind in kinds):
+            return matches[0]
+        return None
+
+    def artifact_path(self, record, kind):
+        """Blob path of one of an invoice's files, or None"""
+        artifact = record["artifacts"].get(kind)
+        if not artifact:
+            return None
+        path = self.blob_path(artifact["sha256"])
+        return path if path.exists() else None
+
+    def status(self):
+        with self._lock:
+            invoices = self._db().execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+            blobs = self._db().execute(
+                "SELECT COUNT(DISTINCT sha256), COALESCE(SUM(size), 0) FROM artifacts"
+            ).fetchone()
+        return {"invoices": invoices, "blobs": blobs[0], "bytes_referenced": blobs[1]}
+
+
+invoice_archive = InvoiceArchive()
@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import fcntl
+import base64
+import sqlite3
+import hashlib
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from urllib.parse import urlparse
+
+from settings import (
+    ASSET_CACHE_ENABLED, ASSET_CACHE_DIR, ASSET_CACHE_MB, ASSET_CACHE_HOSTS, ASSET_CACHE_TIMEOUT, PORTAL_URLS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Shared static-asset cache.
+#
+# Every Chrome session downloads the same Angular bundles, stylesheets,
+# images and fonts from the portals. Each driver's script, stylesheet, image
+# and font requests to the portal hosts are intercepted over the DevTools
+# Fetch domain and answered from one LRU disk cache shared by all sessions
+# and worker processes: a miss is downloaded once (a file lock per key keeps
+# parallel sessions from fetching it again), stored if its cache headers
+# allow a shared cache to keep it, and revalidated with its ETag or
+# Last-Modified once stale. Documents and XHR/fetch API calls are never
+# intercepted. Counters live in the index so /metrics sees every process.
+
+RESOURCE_TYPES = ('Script', 'Stylesheet', 'Image', 'Font')
+
+# Headers not replayed from the cache: hop-by-hop ones, and the encoding of
+# a body that is stored decoded
+DROPPED_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length', 'set-cookie'}
+
+# Heuristic freshness for responses with only Last-Modified (RFC 9111 4.2.2)
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX = 86400
+
+LOCK_STRIPES = 256
+
+COUNTERS = ('hits', 'misses', 'revalidated', 'uncacheable', 'errors', 'bytes_saved', 'bytes_fetched')
+
+
+def cache_directives(value):
+    """{"max-age": "600", "immutable": None, ...} from a Cache-Control header"""
+    directives = {}
+    for item in (value or '').split(','):
+        name, _, argument = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def _timestamp(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def freshness(headers, now):
+    """Seconds a shared cache may serve the response without revalidating, or None if it must not store it"""
+    directives = cache_directives(headers.get('Cache-Control'))
+    if {'no-store', 'private', 'no-cache'} & directives.keys() or headers.get('Set-Cookie'):
+        return None
+    vary = {v.strip().lower() for v in (headers.get('Vary') or '').split(',') if v.strip()}
+    if vary - {'accept-encoding'}:
+        return None
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return max(0, int(directives[name]))
+            except (TypeError, ValueError):
+                return 0
+    date = _timestamp(headers.get('Date')) or now
+    expires = _timestamp(headers.get('Expires'))
+    if headers.get('Expires'):
+        return max(0, int(expires - date)) if expires else 0
+    modified = _timestamp(headers.get('Last-Modified'))
+    if modified:
+        return int(min(HEURISTIC_MAX, max(0, date - modified) * HEURISTIC_FRACTION))
+    return None
+
+
+class AssetCache:
+    """LRU disk cache of portal assets with an SQLite index shared between processes"""
+
+    def __init__(self, directory=ASSET_CACHE_DIR, max_mb=ASSET_CACHE_MB, enabled=ASSET_CACHE_ENABLED,
+                 hosts=ASSET_CACHE_HOSTS, timeout=ASSET_CACHE_TIMEOUT):
+        self.directory = Path(directory)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.enabled = enabled
+        self.hosts = sorted({urlparse(url).hostname for url in PORTAL_URLS.values()}
+                            | {host.strip() for host in hosts.split(',') if host.strip()})
+        self.timeout = timeout
+        self._conn = None
+        self._http = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        # Opened on first use (per process) so importing this module stays free of disk access
+        if self._conn is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.directory / 'index.sqlite3'), timeout=10,
+                                         check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS assets (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    status INTEGER NOT NULL,
+                    headers TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    used_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS assets_used ON assets (used_at);
+                CREATE TABLE IF NOT EXISTS asset_counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            """)
+        return self._conn
+
+    def _session(self):
+        if self._http is None:
+            import requests
+            self._http = requests.Session()
+        return self._http
+
+    def _path(self, key):
+        return self.directory / key[:2] / key
+
+    def _count(self, **increments):
+        with self._lock:
+            db = self._db()
+            for name, value in increments.items():
+                db.execute("INSERT INTO asset_counters VALUES (?, ?) "
+                           "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, value))
+
+    # -- lookups --
+
+    def get(self, url, request_headers):
+        """(status, headers, body) for an asset, from the cache when possible; None to let the browser fetch it"""
+        key = hashlib.sha256(url.encode()).hexdigest()
+        self.directory.joinpath('locks').mkdir(parents=True, exist_ok=True)
+        # One download per asset, whichever session or process asks first
+        with open(self.directory / 'locks' / f"{int(key[:2], 16) % LOCK_STRIPES}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._get(key, url, request_headers)
+            except Exception as e:
+                logger.warning("Asset cache failed for %s: %s", url, str(e))
+                self._count(errors=1)
+                return None
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _get(self, key, url, request_headers):
+        now = time.time()
+        with self._lock:
+            row = self._db().execute("SELECT * FROM assets WHERE key = ?", (key,)).fetchone()
+        body = self._read(key) if row else None
+        if row and body is not None and row["expires_at"] > now:
+            self._touch(key, now)
+            self._count(hits=1, bytes_saved=len(body))
+            return row["status"], json.loads(row["headers"]), body
+
+        headers = {k: v for k, v in request_headers.items() if k.lower() not in ('if-none-match', 'if-modified-since')}
+        if body is not None:
+            if row["etag"]:
+                headers['If-None-Match'] = row["etag"]
+            if row["last_modified"]:
+                headers['If-Modified-Since'] = row["last_modified"]
+        # Redirects go back to the browser, so relative URLs resolve against the right address
+        response = self._session().get(url, headers=headers, timeout=self.timeout, allow_redirects=False)
+
+        if response.status_code == 304 and body is not None:
+            lifetime = freshness(response.headers, now)
+            with self._lock:
+                self._db().execute("UPDATE assets SET expires_at = ?, used_at = ? WHERE key = ?",
+                                   (now + (lifetime or 0), now, key))
+            self._count(revalidated=1, bytes_saved=len(body))
+            return row["status"], json.loads(row["headers"]), body
+
+        content = response.content
+        replayed = [[name, value] for name, value in response.headers.items() if name.lower() not in DROPPED_HEADERS]
+        lifetime = freshness(response.headers, now)
+        validators = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if response.status_code == 200 and lifetime is not None and (lifetime > 0 or validators):
+            self._store(key, url, response, replayed, content, now + lifetime, now)
+            self._count(misses=1, bytes_fetched=len(content))
+        else:
+            self._count(uncacheable=1, bytes_fetched=len(content))
+        return response.status_code, replayed, content
+
+    def _read(self, key):
+        try:
+            return self._path(key).read_bytes()
+        except OSError:
+            return None
+
+    def _touch(self, key, now):
+        with self._lock:
+            self._db().execute("UPDATE assets SET used_at = ? WHERE key = ?", (now, key))
+
+    def _store(self, key, url, response, headers, content, expires_at, now):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(f"{key}.{os.getpid()}.tmp")
+        temporary.write_bytes(content)
+        os.replace(temporary, path)
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url, response.status_code, json.dumps(headers), len(content), expires_at,
+                 response.headers.get('ETag'), response.headers.get('Last-Modified'), now),
+            )
+        self._evict()
+
+    def _evict(self):
+        """Drop least recently used assets until the cache is under 90% of its size"""
+        with self._lock:
+            db = self._db()
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM assets").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for row in db.execute("SELECT key, size FROM assets ORDER BY used_at").fetchall():
+                if total <= self.max_bytes * 0.9:
+                    break
+                db.execute("DELETE FROM assets WHERE key = ?", (row["key"],))
+                self._path(row["key"]).unlink(missing_ok=True)
+                total -= row["size"]
+
+    # -- browser side --
+
+    def attach(self, driver):
+        """Serve the driver's asset requests from the cache until the browser goes away"""
+        if not self.enabled:
+            return
+        thread = threading.Thread(target=self._intercept, args=(driver,), name="asset-cache", daemon=True)
+        thread.start()
+
+    def _intercept(self, driver):
+        import trio
+
+        async def serve():
+            async with driver.bidi_connection() as connection:
+                session, devtools = connection.session, connection.devtools
+                fetch = devtools.fetch
+                patterns = [
+                    fetch.RequestPattern(url_pattern=f"*://{host}/*", resource_type=devtools.network.ResourceType(kind),
+                                         request_stage=fetch.RequestStage.REQUEST)
+                    for host in self.hosts for kind in RESOURCE_TYPES
+                ]
+                await session.execute(fetch.enable(patterns=patterns))
+
+                async def answer(event):
+                    request = event.request
+                    headers = dict(request.headers)
+                    result = None
+                    try:
+                        if request.method == 'GET' and not any(name.lower() == 'range' for name in headers):
+                            result = await trio.to_thread.run_sync(self.get, request.url, headers)
+                        if result is None:
+                            await session.execute(fetch.continue_request(request_id=event.request_id))
+                            return
+                        status, headers, body = result
+                        await session.execute(fetch.fulfill_request(
+                            request_id=event.request_id,
+                            response_code=status,
+                            response_headers=[fetch.HeaderEntry(name=name, value=value) for name, value in headers],
+                            body=base64.b64encode(body).decode(),
+                        ))
+                    except Exception as e:
+                        # The page navigated away or the request was cancelled
+                        logger.debug("Could not answer %s: %s", request.url, str(e))
+
+                async with trio.open_nursery() as nursery:
+                    async for event in session.listen(fetch.RequestPaused, buffer_size=200):
+                        nursery.start_soon(answer, event)
+
+        try:
+            trio.run(serve)
+        except Exception as e:
+            # Usually the driver quitting; its requests go to the network again
+            logger.debug("Asset cache interception ended: %s", str(e))
+
+    def status(self):
+        if not self.enabled:
+            return {"enabled": False}
+        with self._lock:
+            db = self._db()
+            counters = dict(db.execute("SELECT name, value FROM asset_counters").fetchall())
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM assets").fetchone()
+        counters = {name: counters.get(name, 0) for name in COUNTERS}
+        served = counters["hits"] + counters["revalidated"]
+        requests_seen = served + counters["misses"] + counters["uncacheable"]
+        return dict(
+            counters,
+            enabled=True,
+            hosts=self.hosts,
+            entries=entries,
+            size_mb=round(size / (1024 * 1024), 1),
+            max_mb=round(self.max_bytes / (1024 * 1024)),
+            hit_ratio=round(served / requests_seen, 3) if requests_seen else None,
+            mb_saved=round(counters["bytes_saved"] / (1024 * 1024), 1),
+        )
+
+
+asset_cache = AssetCache()
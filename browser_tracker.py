@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import signal
+import logging
+import threading
+
+from jobs import DEFAULT_JOB_TIMEOUT
+from settings import (
+    BROWSER_SESSIONS_DIR, BROWSER_REAP_INTERVAL, BROWSER_MAX_SESSION_AGE, BROWSER_REAP_ORPHANS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Browser process tracking.
+#
+# Every chromedriver a process launches is recorded as a small JSON file
+# (pid, start time, owning process, job), so sessions outlive the process
+# that started them on disk. The reaper in the web process uses those files
+# to kill browsers whose owner died (a crashed or killed worker, a
+# gunicorn restart), sessions past their hard lifetime and stray Chrome
+# processes reparented to init (crash handlers excepted), and to report CPU
+# and memory per session.
+
+BROWSER_PROCESS_NAMES = ('chrome', 'chromedriver', 'chrome_crashpad')
+
+# Crash handlers daemonize, so they run under init while their browser is
+# still alive and cannot be told apart from orphans; they exit with it
+CRASH_HANDLER_NAME = 'chrome_crashpad'
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_stat(pid):
+    """(comm, fields after comm) from /proc/<pid>/stat, or None if the process is gone"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            raw = f.read()
+    except OSError:
+        return None
+    comm = raw[raw.find('(') + 1:raw.rfind(')')]
+    return comm, raw[raw.rfind(')') + 2:].split()
+
+
+def start_time(pid):
+    """Process start time in clock ticks; tells a process apart from a reused pid"""
+    stat = read_stat(pid)
+    return int(stat[1][19]) if stat else None
+
+
+def process_tree(pid):
+    """pid and all of its descendants, read from /proc"""
+    children = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return [pid]
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        stat = read_stat(entry)
+        if stat:
+            children.setdefault(int(stat[1][1]), []).append(int(entry))
+
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, ()))
+    return tree
+
+
+def tree_usage(pid):
+    """(process count, RSS bytes, CPU seconds) of a process tree"""
+    count = rss = ticks = 0
+    for member in process_tree(pid):
+        stat = read_stat(member)
+        if not stat:
+            continue
+        fields = stat[1]
+        count += 1
+        ticks += int(fields[11]) + int(fields[12])
+        rss += int(fields[21]) * PAGE_SIZE
+    return count, rss, ticks / CLOCK_TICKS
+
+
+def tree_rss_mb(pid):
+    """Resident memory of a process and its children (chromedriver, Chrome) in MB"""
+    return tree_usage(pid)[1] // (1024 * 1024)
+
+
+def kill_tree(pid):
+    """SIGKILL a process and all of its descendants; returns how many were signalled"""
+    killed = 0
+    for member in reversed(process_tree(pid)):
+        try:
+            os.kill(member, signal.SIGKILL)
+            killed += 1
+        except (ProcessLookupError, PermissionError):
+            continue
+    return killed
+
+
+class BrowserTracker:
+    """Records launched drivers on disk and reaps the ones nobody owns any more"""
+
+    def __init__(self, directory=BROWSER_SESSIONS_DIR, interval=BROWSER_REAP_INTERVAL,
+                 max_age=BROWSER_MAX_SESSION_AGE):
+        self.directory = directory
+        self.interval = interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cpu_samples = {}
+        self.reaped_sessions = 0
+        self.reaped_orphans = 0
+        self.expired_sessions = 0
+        self.last_reap = None
+
+    # -- owner side: every process that launches drivers --
+
+    def _path(self, pid):
+        return self.directory / f"{pid}.json"
+
+    def register(self, driver):
+        """Record a freshly launched driver's chromedriver process"""
+        try:
+            pid = driver.service.process.pid
+        except AttributeError:
+            return
+        record = {
+            "session_id": driver.session_id,
+            "pid": pid,
+            "pid_start": start_time(pid),
+            "owner_pid": os.getpid(),
+            "owner_start": start_time(os.getpid()),
+            "launched_at": time.time(),
+            "job_id": None,
+        }
+        self._write(pid, record)
+
+    def assign(self, driver, job_id):
+        """Tag a session with the job using it (None when it goes back to the pool)"""
+        pid = self._driver_pid(driver)
+        record = self._read(self._path(pid)) if pid else None
+        if record:
+            record["job_id"] = job_id
+            self._write(pid, record)
+
+    def unregister(self, driver):
+        """Driver quit: kill anything left of its tree and drop the record"""
+        pid = self._driver_pid(driver)
+        if not pid:
+            return
+        record = self._read(self._path(pid))
+        if record and self._is_same_process(record["pid"], record["pid_start"]):
+            kill_tree(pid)
+        self._remove(pid)
+
+    def _driver_pid(self, driver):
+        try:
+            return driver.service.process.pid
+        except AttributeError:
+            return None
+
+    def _write(self, pid, record):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path(pid).with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(record))
+        tmp_path.replace(self._path(pid))
+
+    def _read(self, path):
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _remove(self, pid):
+        try:
+            self._path(pid).unlink()
+        except OSError:
+            pass
+
+    def _is_same_process(self, pid, recorded_start):
+        return recorded_start is not None and start_time(pid) == recorded_start
+
+    def sessions(self):
+        if not self.directory.exists():
+            return []
+        records = []
+        for path in self.directory.glob('*.json'):
+            record = self._read(path)
+            if record:
+                records.append(record)
+        return records
+
+    # -- reaper side: the web process --
+
+    def start(self):
+        """Reap leftovers from previous runs now, then periodically"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="browser-reaper", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error("Browser reaper failed: %s", str(e))
+            time.sleep(self.interval)
+
+    def reap(self):
+        """Kill sessions of dead owners, sessions past their hard lifetime and stray browsers"""
+        with self._lock:
+            now = time.time()
+            tracked = set()
+            # A job cannot legitimately hold a driver longer than this: the pool
+            # stops handing out sessions at max_age and a job ends by its deadline
+            hard_limit = self.max_age + DEFAULT_JOB_TIMEOUT
+
+            for record in self.sessions():
+                pid = record["pid"]
+                alive = self._is_same_process(pid, record["pid_start"])
+                if not alive:
+                    self._remove(pid)
+                    continue
+                if not self._is_same_process(record["owner_pid"], record["owner_start"]):
+                    killed = kill_tree(pid)
+                    self._remove(pid)
+                    self.reaped_sessions += 1
+                    logger.warning("Reaped browser session %s (%s processes): owner %s is gone",
+                                   pid, killed, record["owner_pid"])
+                    continue
+                if now - record["launched_at"] > hard_limit:
+                    killed = kill_tree(pid)
+                    self._remove(pid)
+                    self.expired_sessions += 1
+                    logger.warning("Killed browser session %s (%s processes) after %.0fs, job %s",
+                                   pid, killed, now - record["launched_at"], record["job_id"])
+                    continue
+                tracked.update(process_tree(pid))
+
+            if BROWSER_REAP_ORPHANS:
+                self._reap_orphans(tracked)
+            self._reap_zombies()
+            self.last_reap = now
+
+    def _reap_orphans(self, tracked):
+        """Browser processes reparented to init that no live session accounts for"""
+        uid = os.getuid()
+        try:
+            entries = os.listdir('/proc')
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.isdigit() or int(entry) in tracked:
+                continue
+            stat = read_stat(entry)
+            if not stat or not stat[0].startswith(BROWSER_PROCESS_NAMES) or stat[1][1] != '1':
+                continue
+            if stat[0].startswith(CRASH_HANDLER_NAME):
+                continue
+            try:
+                if os.stat(f'/proc/{entry}').st_uid != uid:
+                    continue
+            except OSError:
+                continue
+            killed = kill_tree(int(entry))
+            self.reaped_orphans += 1
+            logger.warning("Reaped orphaned %s process %s (%s processes)", stat[0], entry, killed)
+
+    def _reap_zombies(self):
+        """Collect exited browser children of this process"""
+        me = str(os.getpid())
+        for pid in process_tree(os.getpid())[1:]:
+            stat = read_stat(pid)
+            if stat and stat[1][0] == 'Z' and stat[1][1] == me and stat[0].startswith(BROWSER_PROCESS_NAMES):
+                try:
+                    os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    pass
+
+    def sample(self):
+        """CPU and memory per live session, for /metrics"""
+        now = time.monotonic()
+        report = []
+        seen = set()
+        for record in self.sessions():
+            pid = record["pid"]
+            if not self._is_same_process(pid, record["pid_start"]):
+                continue
+            count, rss, cpu_seconds = tree_usage(pid)
+            previous = self._cpu_samples.get(pid)
+            cpu_percent = None
+            if previous and now > previous[0]:
+                cpu_percent = round(max(0.0, cpu_seconds - previous[1]) / (now - previous[0]) * 100, 1)
+            self._cpu_samples[pid] = (now, cpu_seconds)
+            seen.add(pid)
+            report.append({
+                "session_id": record["session_id"],
+                "pid": pid,
+                "owner_pid": record["owner_pid"],
+                "job_id": record["job_id"],
+                "age_seconds": round(time.time() - record["launched_at"], 1),
+                "processes": count,
+                "rss_mb": round(rss / (1024 * 1024), 1),
+                "cpu_seconds": round(cpu_seconds, 2),
+                "cpu_percent": cpu_percent,
+            })
+        for pid in set(self._cpu_samples) - seen:
+            del self._cpu_samples[pid]
+        return report
+
+    def status(self):
+        return {
+            "reaped_sessions": self.reaped_sessions,
+            "reaped_orphans": self.reaped_orphans,
+            "expired_sessions": self.expired_sessions,
+            "last_reap": self.last_reap,
+        }
+
+
+browser_tracker = BrowserTracker()
@@ -0,0 +1,196 @@
+import json
+import logging
+import zipfile
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+logger = logging.getLogger(__name__)
+
+# CFDI metadata.
+#
+# What the portal actually issued - UUID, emisor/receptor, total, fecha and
+# conceptos - read from the invoice XML with a pull parser fed in chunks.
+# Elements are dropped as soon as they are read, so a CFDI with thousands
+# of conceptos is parsed in bounded memory, and the job names its ZIP and
+# answers with these fields without the caller unzipping anything.
+
+CHUNK_SIZE = 64 * 1024
+
+# Conceptos kept in the metadata; the rest are only counted
+MAX_CONCEPTOS = 100
+
+MANIFEST_NAME = 'cfdi.json'
+
+# Namespaces of the CFDI 3.3 and 4.0 structure; complements (comercio
+# exterior, nomina, ...) reuse names like Emisor and Receptor in their own
+CFDI_NAMESPACES = ('http://www.sat.gob.mx/cfd/3', 'http://www.sat.gob.mx/cfd/4')
+
+COMPROBANTE_FIELDS = {
+    'Version': 'version',
+    'Serie': 'serie',
+    'Folio': 'folio',
+    'Fecha': 'fecha',
+    'SubTotal': 'subtotal',
+    'Descuento': 'descuento',
+    'Total': 'total',
+    'Moneda': 'moneda',
+    'TipoDeComprobante': 'tipo_comprobante',
+    'MetodoPago': 'metodo_pago',
+    'FormaPago': 'forma_pago',
+    'LugarExpedicion': 'lugar_expedicion',
+}
+EMISOR_FIELDS = {'Rfc': 'rfc', 'Nombre': 'nombre', 'RegimenFiscal': 'regimen_fiscal'}
+RECEPTOR_FIELDS = {
+    'Rfc': 'rfc', 'Nombre': 'nombre', 'UsoCFDI': 'uso_cfdi',
+    'DomicilioFiscalReceptor': 'codigo_postal', 'RegimenFiscalReceptor': 'regimen_fiscal',
+}
+CONCEPTO_FIELDS = {
+    'ClaveProdServ': 'clave_prod_serv', 'Cantidad': 'cantidad', 'ClaveUnidad': 'clave_unidad',
+    'Descripcion': 'descripcion', 'ValorUnitario': 'valor_unitario', 'Importe': 'importe',
+}
+TIMBRE_FIELDS = {'UUID': 'uuid', 'FechaTimbrado': 'fecha_timbrado', 'RfcProvCertif': 'rfc_prov_certif'}
+
+# Fields sent back as response headers (X-CFDI-<Name>)
+HEADER_FIELDS = (
+    ('UUID', ('uuid',)),
+    ('Fecha', ('fecha',)),
+    ('Total', ('total',)),
+    ('Moneda', ('moneda',)),
+    ('Emisor-RFC', ('emisor', 'rfc')),
+    ('Receptor-RFC', ('receptor', 'rfc')),
+)
+
+
+class InvalidCFDI(ValueError):
+    """The XML is not a readable CFDI"""
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _cfdi_name(tag):
+    """Local name of an element in the CFDI namespace, None for any other"""
+    namespace, _, name = tag[1:].partition('}') if tag.startswith('{') else ('', '', tag)
+    return name if namespace in CFDI_NAMESPACES else None
+
+
+def _pick(attrib, fields):
+    return {name: attrib[key] for key, name in fields.items() if key in attrib}
+
+
+class CfdiParser:
+    """Incremental CFDI reader: feed() bytes as they arrive, then close()"""
+
+    def __init__(self, max_conceptos=MAX_CONCEPTOS):
+        self.max_conceptos = max_conceptos
+        self._parser = XMLPullParser(events=('start', 'end'))
+        self._open = []
+        self.metadata = {"uuid": None, "emisor": {}, "receptor": {}, "conceptos": [], "conceptos_count": 0}
+        self._seen_comprobante = False
+
+    def feed(self, chunk):
+        try:
+            self._parser.feed(chunk)
+            self._drain()
+        except ParseError as e:
+            raise InvalidCFDI(f"Invalid CFDI XML: {e}") from e
+
+    def close(self):
+        try:
+            self._parser.close()
+            self._drain()
+        except ParseError as e:
+            raise InvalidCFDI(f"Invalid CFDI XML: {e}") from e
+        if not self._seen_comprobante:
+            raise InvalidCFDI("No cfdi:Comprobante element")
+        if self.metadata["uuid"]:
+            self.metadata["uuid"] = self.metadata["uuid"].upper()
+        return self.metadata
+
+    def _drain(self):
+        metadata = self.metadata
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                self._open.append(element)
+                depth = len(self._open)
+                name = _cfdi_name(element.tag)
+                # Attributes are complete on start, so nothing is kept past it.
+                # Emisor, Receptor and Concepto only count where the CFDI
+                # structure puts them, never inside a complement.
+                if name == 'Comprobante' and depth == 1:
+                    self._seen_comprobante = True
+                    metadata.update(_pick(element.attrib, COMPROBANTE_FIELDS))
+                elif name == 'Emisor' and depth == 2 and self._seen_comprobante:
+                    metadata["emisor"] = _pick(element.attrib, EMISOR_FIELDS)
+                elif name == 'Receptor' and depth == 2 and self._seen_comprobante:
+                    metadata["receptor"] = _pick(element.attrib, RECEPTOR_FIELDS)
+                elif (name == 'Concepto' and depth == 3 and self._seen_comprobante
+                      and _cfdi_name(self._open[-2].tag) == 'Conceptos'):
+                    metadata["conceptos_count"] += 1
+                    if len(metadata["conceptos"]) < self.max_conceptos:
+                        metadata["conceptos"].append(_pick(element.attrib, CONCEPTO_FIELDS))
+                elif _local(element.tag) == 'TimbreFiscalDigital':
+                    metadata.update(_pick(element.attrib, TIMBRE_FIELDS))
+            else:
+                # Detach finished elements so the tree never grows
+                self._open.pop()
+                element.clear()
+                if self._open:
+                    self._open[-1].remove(element)
+
+
+def parse_stream(stream, chunk_size=CHUNK_SIZE):
+    """Metadata of the CFDI read from a binary file object"""
+    parser = CfdiParser()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    return parser.close()
+
+
+def parse_file(path):
+    with open(path, 'rb') as f:
+        return parse_stream(f)
+
+
+def xml_member(zf):
+    """Name of the invoice XML inside a ZIP, or None"""
+    for name in zf.namelist():
+        if name.lower().endswith('.xml'):
+            return name
+    return None
+
+
+def parse_zip(zip_path):
+    """Metadata of the CFDI inside an invoice ZIP, or None if it has no readable XML"""
+    with zipfile.ZipFile(zip_path) as zf:
+        name = xml_member(zf)
+        if name is None:
+            return None
+        with zf.open(name) as stream:
+            try:
+                return parse_stream(stream)
+            except InvalidCFDI as e:
+                logger.warning("Could not read CFDI %s: %s", name, str(e))
+                return None
+
+
+def add_manifest(zip_path, metadata):
+    """Append the metadata to the ZIP as cfdi.json"""
+    with zipfile.ZipFile(zip_path, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+        if MANIFEST_NAME not in zf.namelist():
+            zf.writestr(MANIFEST_NAME, json.dumps(metadata, ensure_ascii=False, indent=2))
+
+
+def response_headers(metadata):
+    """X-CFDI-* headers for the fields callers most often need"""
+    headers = {}
+    for header, path in HEADER_FIELDS:
+        value = metadata
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value:
+            headers[f'X-CFDI-{header}'] = str(value)
+    return headers
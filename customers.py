@@ -0,0 +1,183 @@
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from sat import normalize_rfc, validate_fiscal
+from settings import CUSTOMERS_DB, CUSTOMER_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Customer profiles.
+#
+# Callers invoice for the same customers over and over, so their fiscal
+# data is stored once (SQLite, keyed by RFC) and referenced by `customer_id`
+# or by `rfc` alone. Profiles are validated against the SAT catalogs when
+# saved, and the hot ones are kept in an in-memory LRU so resolving a
+# request costs no disk access.
+
+PROFILE_FIELDS = ('rfc', 'razon_social', 'codigo_postal', 'regimen_fiscal', 'uso_cfdi', 'email')
+
+
+class CustomerNotFound(LookupError):
+    """The request referenced a customer_id that is not stored"""
+
+
+class InvalidProfile(ValueError):
+    """The fiscal data of a profile fails the SAT catalog checks"""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+class CustomerStore:
+    """SQLite-backed customer profiles with an LRU of recently used ones"""
+
+    def __init__(self, path=CUSTOMERS_DB, cache_size=CUSTOMER_CACHE_SIZE):
+        self.path = Path(path)
+        self.cache_size = cache_size
+        self._conn = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self):
+        # Opened on first use so importing this module stays free of disk access
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS customers (
+                    customer_id TEXT PRIMARY KEY,
+                    rfc TEXT NOT NULL UNIQUE,
+                    razon_social TEXT,
+                    codigo_postal TEXT,
+                    regimen_fiscal TEXT,
+                    uso_cfdi TEXT,
+                    email TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+        return self._conn
+
+    def _remember(self, profile):
+        self._cache[profile["rfc"]] = profile
+        self._cache.move_to_end(profile["rfc"])
+        self._ids[profile["customer_id"]] = profile["rfc"]
+        while len(self._cache) > self.cache_size:
+            _, evicted = self._cache.popitem(last=False)
+            self._ids.pop(evicted["customer_id"], None)
+
+    def _forget(self, profile):
+        self._cache.pop(profile["rfc"], None)
+        self._ids.pop(profile["customer_id"], None)
+
+    def get(self, key):
+        """Profile by customer_id or RFC, or None"""
+        rfc = normalize_rfc(key)
+        with self._lock:
+            rfc = self._ids.get(key, rfc)
+            profile = self._cache.get(rfc)
+            if profile is not None:
+                self._cache.move_to_end(rfc)
+                self.hits += 1
+                return dict(profile)
+
+            self.misses += 1
+            row = self._db().execute(
+                "SELECT * FROM customers WHERE customer_id = ? OR rfc = ?", (key, rfc)
+            ).fetchone()
+            if row is None:
+                return None
+            profile = dict(row)
+            self._remember(profile)
+            return dict(profile)
+
+    def save(self, data, customer_id=None):
+        """Validate and upsert a profile keyed by RFC; returns the stored profile"""
+        profile = {field: str(data[field]).strip() for field in PROFILE_FIELDS if data.get(field) is not None}
+        if 'rfc' not in profile:
+            raise InvalidProfile(["rfc is required"])
+        profile['rfc'] = normalize_rfc(profile['rfc'])
+        if 'uso_cfdi' in profile:
+            profile['uso_cfdi'] = profile['uso_cfdi'].upper()
+        existing = self.get(profile['rfc'])
+        errors = validate_fiscal({**(existing or {}), **profile})
+        if errors:
+            raise InvalidProfile(errors)
+
+        now = time.time()
+        if existing:
+            customer_id = existing['customer_id']
+            created_at = existing['created_at']
+        else:
+            customer_id = customer_id or uuid.uuid4().hex[:12]
+            created_at = now
+        # Fields left out of an update keep their stored values
+        record = {field: profile.get(field, (existing or {}).get(field)) for field in PROFILE_FIELDS}
+        record.update(customer_id=customer_id, created_at=created_at, updated_at=now)
+
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO customers (customer_id, rfc, razon_social, codigo_postal, "
+                "regimen_fiscal, uso_cfdi, email, created_at, updated_at) "
+                "VALUES (:customer_id, :rfc, :razon_social, :codigo_postal, :regimen_fiscal, "
+                ":uso_cfdi, :email, :created_at, :updated_at)",
+                record,
+            )
+            self._remember(record)
+        logger.info("Saved customer %s (%s)", customer_id, 'updated' if existing else 'new')
+        return dict(record)
+
+    def delete(self, key):
+        """Remove a profile; returns False if it did not exist"""
+        profile = self.get(key)
+        if profile is None:
+            return False
+        with self._lock:
+            self._db().execute("DELETE FROM customers WHERE customer_id = ?", (profile["customer_id"],))
+            self._forget(profile)
+        return True
+
+    def resolve(self, data):
+        """
+        Fill the request's fiscal fields from a stored profile. Fields sent
+        with the request win over stored ones. `customer_id` must exist; a
+        bare `rfc` without a stored profile is simply used as sent.
+        """
+        customer_id = data.get('customer_id')
+        if customer_id:
+            profile = self.get(customer_id)
+            if profile is None:
+                raise CustomerNotFound(f"Unknown customer_id: {customer_id}")
+        elif data.get('rfc'):
+            profile = self.get(data['rfc'])
+            if profile is None:
+                return data
+        else:
+            return data
+
+        merged = dict(data)
+        for field in PROFILE_FIELDS:
+            if field not in merged and profile.get(field) is not None:
+                merged[field] = profile[field]
+        # A stored email was confirmed when the profile was saved
+        if 'email' not in data and 'email' in merged:
+            merged.setdefault('email_confirm', merged['email'])
+        return merged
+
+    def status(self):
+        with self._lock:
+            return {"cached": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+customer_store = CustomerStore()
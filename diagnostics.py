@@ -0,0 +1,232 @@
+import io
+import json
+import time
+import logging
+import threading
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlparse
+
+from settings import (
+    DIAGNOSTICS_DIR, DIAGNOSTICS_MAX_SNAPSHOTS, DIAGNOSTICS_MAX_AGE_HOURS,
+    DIAGNOSTICS_MAX_HAR_ENTRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Failure snapshots.
+#
+# When a job fails we grab everything needed to debug it in one pass - the
+# screenshot, the DOM, the browser console and the recent network traffic as
+# a HAR - and store it as a single compressed archive named after the job id.
+# This replaces walking every button on the page with WebDriver calls.
+
+SNAPSHOT_FILES = ('meta.json', 'screenshot.png', 'dom.html', 'console.json', 'network.har')
+
+
+def _drain_log(driver, log_type):
+    try:
+        return driver.get_log(log_type)
+    except Exception as e:
+        logger.debug("Could not read %s log: %s", log_type, str(e))
+        return []
+
+
+def drain_browser_logs(driver):
+    """Discard buffered console/network logs so the next job starts clean"""
+    for log_type in ('browser', 'performance'):
+        _drain_log(driver, log_type)
+
+
+def read_performance_log(driver):
+    """Drain the buffered CDP network events; pass them on to capture() when failing"""
+    return _drain_log(driver, 'performance')
+
+
+def portal_errors(performance_entries, host):
+    """Counts of throttling (429) and server error (5xx) responses from the portal's host"""
+    counts = {"429": 0, "5xx": 0}
+    for entry in performance_entries:
+        try:
+            message = json.loads(entry['message'])['message']
+        except (KeyError, TypeError, ValueError):
+            continue
+        if message.get('method') != 'Network.responseReceived':
+            continue
+        response = message.get('params', {}).get('response', {})
+        if urlparse(response.get('url', '')).hostname != host:
+            continue
+        status = response.get('status', 0)
+        if status == 429:
+            counts["429"] += 1
+        elif status >= 500:
+            counts["5xx"] += 1
+    return counts
+
+
+def build_har(performance_entries, max_entries=DIAGNOSTICS_MAX_HAR_ENTRIES):
+    """Turn Chrome performance-log (CDP Network.*) events into a minimal HAR 1.2 document"""
+    requests = {}
+    order = []
+
+    for entry in performance_entries:
+        try:
+            message = json.loads(entry['message'])['message']
+        except (KeyError, TypeError, ValueError):
+            continue
+        method = message.get('method', '')
+        params = message.get('params', {})
+        request_id = params.get('requestId')
+        if not request_id or not method.startswith('Network.'):
+            continue
+
+        if method == 'Network.requestWillBeSent':
+            request = params.get('request', {})
+            if request_id not in requests:
+                order.append(request_id)
+            requests[request_id] = {
+                "startedDateTime": datetime.fromtimestamp(params.get('wallTime', time.time())).isoformat(),
+                "_start": params.get('timestamp'),
+                "time": 0,
+                "request": {
+                    "method": request.get('method', 'GET'),
+                    "url": request.get('url', ''),
+                    "httpVersion": "",
+                    "headers": [{"name": k, "value": str(v)} for k, v in request.get('headers', {}).items()],
+                    "queryString": [],
+                    "cookies": [],
+                    "headersSize": -1,
+                    "bodySize": len(request.get('postData', '') or ''),
+                },
+                "response": {
+                    "status": 0, "statusText": "", "httpVersion": "", "headers": [], "cookies": [],
+                    "content": {"size": 0, "mimeType": ""}, "redirectURL": "",
+                    "headersSize": -1, "bodySize": -1,
+                },
+                "cache": {},
+                "timings": {"send": 0, "wait": 0, "receive": 0},
+            }
+        elif request_id in requests:
+            har_entry = requests[request_id]
+            if method == 'Network.responseReceived':
+                response = params.get('response', {})
+                har_entry["response"].update({
+                    "status": response.get('status', 0),
+                    "statusText": response.get('statusText', ''),
+                    "httpVersion": response.get('protocol', ''),
+                    "headers": [{"name": k, "value": str(v)} for k, v in response.get('headers', {}).items()],
+                    "content": {"size": 0, "mimeType": response.get('mimeType', '')},
+                })
+            elif method in ('Network.loadingFinished', 'Network.loadingFailed'):
+                if har_entry["_start"] is not None and params.get('timestamp') is not None:
+                    elapsed_ms = (params['timestamp'] - har_entry["_start"]) * 1000
+                    har_entry["time"] = round(elapsed_ms, 1)
+                    har_entry["timings"]["wait"] = round(elapsed_ms, 1)
+                if method == 'Network.loadingFinished':
+                    har_entry["response"]["bodySize"] = params.get('encodedDataLength', -1)
+                else:
+                    har_entry["response"]["_error"] = params.get('errorText', '')
+
+    entries = []
+    for request_id in order[-max_entries:]:
+        har_entry = requests[request_id]
+        har_entry.pop("_start", None)
+        entries.append(har_entry)
+
+    return {"log": {"version": "1.2", "creator": {"name": "ticketapi", "version": "1"}, "pages": [], "entries": entries}}
+
+
+class SnapshotStore:
+    """Compressed per-job failure snapshots with count and age retention"""
+
+    def __init__(self, directory=DIAGNOSTICS_DIR, max_snapshots=DIAGNOSTICS_MAX_SNAPSHOTS,
+                 max_age_hours=DIAGNOSTICS_MAX_AGE_HOURS):
+        self.directory = Path(directory)
+        self.max_snapshots = max_snapshots
+        self.max_age_seconds = max_age_hours * 3600
+        self._lock = threading.Lock()
+
+    def path_for(self, job_id):
+        # Job ids come from clients; keep them from escaping the directory
+        safe_id = "".join(c for c in str(job_id) if c.isalnum() or c in "-_")
+        return self.directory / f"{safe_id}.zip"
+
+    def capture(self, driver, job_id, error=None, step=None, extra=None, performance=None):
+        """Capture screenshot, DOM, console and network log (drained unless given) for a failed job"""
+        started = time.time()
+        meta = {
+            "job_id": job_id,
+            "error": str(error) if error else None,
+            "error_type": type(error).__name__ if error else None,
+            "step": step,
+            "captured_at": datetime.now().isoformat(),
+        }
+        if extra:
+            meta.update(extra)
+
+        files = {}
+        try:
+            meta["url"] = driver.current_url
+            meta["title"] = driver.title
+        except Exception as e:
+            meta["page_error"] = str(e)
+        try:
+            files['screenshot.png'] = driver.get_screenshot_as_png()
+        except Exception as e:
+            meta["screenshot_error"] = str(e)
+        try:
+            files['dom.html'] = driver.page_source.encode('utf-8')
+        except Exception as e:
+            meta["dom_error"] = str(e)
+        files['console.json'] = json.dumps(_drain_log(driver, 'browser'), ensure_ascii=False, indent=1).encode('utf-8')
+        if performance is None:
+            performance = _drain_log(driver, 'performance')
+        files['network.har'] = json.dumps(build_har(performance), ensure_ascii=False).encode('utf-8')
+
+        meta["capture_ms"] = round((time.time() - started) * 1000)
+        files['meta.json'] = json.dumps(meta, ensure_ascii=False, indent=1).encode('utf-8')
+
+        path = self.path_for(job_id)
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                for name in SNAPSHOT_FILES:
+                    if name in files:
+                        zipf.writestr(name, files[name])
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(buffer.getvalue())
+            tmp_path.replace(path)
+            self._prune()
+
+        logger.info("Failure snapshot stored for job %s in %sms (%s bytes)", job_id, meta["capture_ms"], path.stat().st_size)
+        return path
+
+    def get(self, job_id):
+        path = self.path_for(job_id)
+        return path if path.exists() else None
+
+    def read_member(self, job_id, name):
+        """Return one file from a job's snapshot, or None"""
+        path = self.get(job_id)
+        if not path or name not in SNAPSHOT_FILES:
+            return None
+        with zipfile.ZipFile(path) as zipf:
+            try:
+                return zipf.read(name)
+            except KeyError:
+                return None
+
+    def _prune(self):
+        snapshots = sorted(self.directory.glob('*.zip'), key=lambda p: p.stat().st_mtime, reverse=True)
+        now = time.time()
+        for i, path in enumerate(snapshots):
+            if i >= self.max_snapshots or now - path.stat().st_mtime > self.max_age_seconds:
+                try:
+                    path.unlink()
+                except OSError as e:
+                    logger.warning("Could not prune snapshot %s: %s", path.name, str(e))
+
+
+snapshot_store = SnapshotStore()
@@ -0,0 +1,250 @@
+import time
+import logging
+import threading
+
+from browser_tracker import browser_tracker
+from diagnostics import drain_browser_logs
+from log_config import job_id_var
+from profiles import profile_template
+from settings import (
+    DRIVER_POOL_SIZE, DRIVER_MAX_USES, PORTAL_URLS, BROWSER_MAX_SESSION_AGE,
+    DRIVER_PARK_ENABLED, DRIVER_RECYCLE_WAIT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DriverPool:
+    """
+    Keeps pre-launched Chrome sessions ready so a job does not pay for the
+    browser start on its critical path.
+
+    Idle drivers are handed out by acquire(); release() either resets and
+    returns a driver to the pool or quits it, and the pool refills itself in
+    the background.
+
+    Idle drivers are parked on a portal's landing page (`landings`, as
+    (servicio, url, weight) tuples), so a job for that portal finds the SPA
+    already bootstrapped; the adapter checks the page is still fresh before
+    skipping its navigation (see PortalAdapter.landing_ready). Resetting and
+    parking a returned driver happens in the background, off the finished
+    job's critical path.
+    """
+
+    def __init__(self, factory, size=None, max_uses=DRIVER_MAX_USES, max_age=BROWSER_MAX_SESSION_AGE,
+                 landings=(), park=DRIVER_PARK_ENABLED):
+        self.factory = factory
+        self.size = size or DRIVER_POOL_SIZE or 1
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.landings = tuple(landings) if park else ()
+        self._idle = []
+        self._uses = {}
+        self._launched_at = {}
+        self._in_use = 0
+        self._launching = 0
+        self._recycling = 0
+        self._lock = threading.Condition()
+        self._closed = False
+        self.last_error = None
+        self.launched = 0
+        self.landing_reused = 0
+        self.landing_stale = 0
+
+    def _launch(self):
+        started = time.time()
+        try:
+            driver = self.factory()
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error("Driver launch failed: %s", str(e))
+            raise
+        self.last_error = None
+        self.launched += 1
+        self._launched_at[id(driver)] = time.monotonic()
+        logger.info("Driver launched in %.1fs", time.time() - started)
+        return driver
+
+    def _expired(self, driver):
+        launched_at = self._launched_at.get(id(driver))
+        return launched_at is not None and time.monotonic() - launched_at > self.max_age
+
+    def warm(self):
+        """Launch drivers until `size` are idle; blocking, meant for background threads"""
+        while True:
+            with self._lock:
+                if self._closed or len(self._idle) + self._launching + self._recycling >= self.size:
+                    return
+                self._launching += 1
+            try:
+                driver = self._launch()
+                self._park(driver)
+            except Exception:
+                return
+            finally:
+                with self._lock:
+                    self._launching -= 1
+            with self._lock:
+                if self._closed:
+                    self._quit(driver)
+                    return
+                self._uses[id(driver)] = 0
+                self._idle.append(driver)
+                self._lock.notify_all()
+
+    def _refill_async(self):
+        threading.Thread(target=self.warm, name="driver-pool-refill", daemon=True).start()
+
+    def _take(self, servicio):
+        """Pop the idle driver parked on servicio's landing page, else one parked nowhere, else any"""
+        def rank(driver):
+            parked = getattr(driver, 'parked', None)
+            if parked and parked["servicio"] == servicio:
+                return 0
+            return 2 if parked else 1
+        if not self._idle:
+            return None
+        driver = min(reversed(self._idle), key=rank)
+        self._idle.remove(driver)
+        return driver
+
+    def acquire(self, cancel_token=None, servicio=None):
+        """Take an idle driver, launching one in-thread if the pool is empty"""
+        if cancel_token:
+            cancel_token.check()
+        with self._lock:
+            # A driver coming back from its last job is worth a short wait
+            waited = time.monotonic()
+            while not self._idle and self._recycling and time.monotonic() - waited < DRIVER_RECYCLE_WAIT:
+                self._lock.wait(0.5)
+                if cancel_token:
+                    cancel_token.check()
+            driver = self._take(servicio)
+            self._in_use += 1
+        # Sessions past their lifetime are retired here rather than mid-job
+        while driver is not None and self._expired(driver):
+            logger.info("Retiring driver older than %ss", self.max_age)
+            self._quit(driver)
+            with self._lock:
+                driver = self._take(servicio)
+        try:
+            if driver is None:
+                logger.info("Driver pool empty, launching a driver on demand")
+                driver = self._launch()
+                self._uses[id(driver)] = 0
+        except BaseException:
+            with self._lock:
+                self._in_use -= 1
+            raise
+        self._uses[id(driver)] += 1
+        browser_tracker.assign(driver, job_id_var.get())
+        self._refill_async()
+        return driver
+
+    def release(self, driver, reuse=True):
+        """Return a driver after a job; it is quit instead if reuse is unsafe"""
+        with self._lock:
+            self._in_use = max(0, self._in_use - 1)
+        uses = self._uses.get(id(driver), 0)
+        browser_tracker.assign(driver, None)
+        if reuse and not self._closed and uses < self.max_uses and not self._expired(driver):
+            with self._lock:
+                self._recycling += 1
+            threading.Thread(target=self._recycle, args=(driver,), name="driver-pool-recycle", daemon=True).start()
+            return
+        self.discard(driver)
+
+    def _recycle(self, driver):
+        """Reset a returned driver and park it, then put it back in the pool"""
+        reusable = False
+        try:
+            reusable = self._reset(driver)
+            if reusable:
+                self._park(driver)
+        finally:
+            with self._lock:
+                self._recycling -= 1
+                if reusable and not self._closed and len(self._idle) < self.size:
+                    self._idle.append(driver)
+                    self._lock.notify_all()
+                    return
+                self._lock.notify_all()
+        self.discard(driver)
+
+    def _park(self, driver):
+        """Load the landing page of the portal with the fewest idle drivers waiting on it, for its weight"""
+        driver.parked = None
+        if not self.landings:
+            return
+        with self._lock:
+            parked = [getattr(d, 'parked', None) for d in self._idle]
+        servicio, url, _ = min(self.landings, key=lambda landing: sum(
+            1 for p in parked if p and p["servicio"] == landing[0]) / landing[2])
+        try:
+            driver.get(url)
+            driver.parked = {"servicio": servicio, "at": time.monotonic()}
+        except Exception as e:
+            logger.warning("Could not park a driver on %s: %s", url, str(e))
+
+    def note_landing(self, reused):
+        """Count a job that found its parked landing page fresh (reused) or had to navigate"""
+        with self._lock:
+            if reused:
+                self.landing_reused += 1
+            else:
+                self.landing_stale += 1
+
+    def discard(self, driver):
+        """Quit a driver and top the pool back up"""
+        self._quit(driver)
+        if not self._closed:
+            self._refill_async()
+
+    def _quit(self, driver):
+        self._uses.pop(id(driver), None)
+        self._launched_at.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.warning("Error quitting driver: %s", str(e))
+        browser_tracker.unregister(driver)
+        profile_template.discard(driver)
+
+    def _reset(self, driver):
+        """Drop cookies and storage left by the previous job"""
+        driver.parked = None
+        try:
+            driver.get("about:blank")
+            driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            for url in PORTAL_URLS.values():
+                origin = "/".join(url.split("/")[:3])
+                driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+            drain_browser_logs(driver)
+            return True
+        except Exception as e:
+            logger.warning("Driver reset failed, discarding it: %s", str(e))
+            return False
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._lock.notify_all()
+        for driver in idle:
+            self._quit(driver)
+
+    def status(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "launching": self._launching,
+                "recycling": self._recycling,
+                "parked": {servicio: sum(1 for d in self._idle if (getattr(d, 'parked', None) or {}).get("servicio") == servicio)
+                           for servicio, _, _ in self.landings},
+                "landing_reused": self.landing_reused,
+                "landing_stale": self.landing_stale,
+                "launched_total": self.launched,
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,185 @@
+import time
+import queue
+import shutil
+import logging
+import threading
+from pathlib import Path
+
+from settings import (
+    DOWNLOADS_DIR, RESULTS_DIR, JANITOR_SWEEP_INTERVAL, JANITOR_MAX_FILE_AGE,
+    JANITOR_MAX_DOWNLOADS_MB,
+)
+
+logger = logging.getLogger(__name__)
+
+# File types the browser flows leave behind
+SWEEP_SUFFIXES = {'.crdownload', '.tmp', '.part', '.pdf', '.xml', '.zip'}
+
+
+class Janitor:
+    """
+    Single background worker that owns all file cleanup.
+
+    Request threads only enqueue work. Each job downloads into its own
+    directory, so cleanup is scoped to that job instead of wiping the shared
+    Downloads folder. The worker also sweeps orphaned files by age and keeps
+    the download area under a size limit, skipping directories of jobs that
+    are still running.
+    """
+
+    def __init__(self, roots=(DOWNLOADS_DIR, RESULTS_DIR), sweep_interval=JANITOR_SWEEP_INTERVAL,
+                 max_age=JANITOR_MAX_FILE_AGE, max_bytes=JANITOR_MAX_DOWNLOADS_MB * 1024 * 1024):
+        self.roots = [Path(root).resolve() for root in roots]
+        self.sweep_interval = sweep_interval
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue()
+        self._active = set()
+        self._active_lock = threading.Lock()
+        self._thread = None
+        self.deleted_files = 0
+        self.deleted_bytes = 0
+        self.last_sweep = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="janitor", daemon=True)
+            self._thread.start()
+            # Leftovers from a previous crash or restart
+            self.request_sweep()
+
+    # -- request-thread API (never blocks on I/O) --
+
+    def job_directory(self, root, job_id):
+        """Directory for one job's files; protected from sweeping until released"""
+        root = Path(root).resolve()
+        path = (root / str(job_id)).resolve()
+        # Job ids come from clients; the directory must be a child of the root
+        if path.parent != root:
+            raise ValueError(f"Invalid job id: {job_id!r}")
+        with self._active_lock:
+            self._active.add(path)
+        return path
+
+    def release_job(self, *paths):
+        """Job finished: stop protecting its directories and delete them"""
+        with self._active_lock:
+            for path in paths:
+                self._active.discard(Path(path).resolve())
+        self._queue.put(('delete', paths))
+
+    def delete(self, *paths):
+        self._queue.put(('delete', paths))
+
+    def request_sweep(self):
+        self._queue.put(('sweep', None))
+
+    # -- worker --
+
+    def _run(self):
+        next_sweep = time.monotonic() + self.sweep_interval
+        while True:
+            try:
+                task, arg = self._queue.get(timeout=max(0.0, next_sweep - time.monotonic()))
+            except queue.Empty:
+                task, arg = 'sweep', None
+            try:
+                if task == 'delete':
+                    for path in arg:
+                        self._remove(Path(path))
+                elif task == 'sweep':
+                    self.sweep()
+            except Exception as e:
+                logger.error("Janitor task %s failed: %s", task, str(e))
+            if task == 'sweep' or time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + self.sweep_interval
+
+    def _is_active(self, path):
+        with self._active_lock:
+            return any(path == active or active in path.parents for active in self._active)
+
+    def _contained(self, path):
+        """True for paths strictly inside one of the janitor's roots"""
+        path = path.resolve()
+        return any(root in path.parents for root in self.roots)
+
+    def _remove(self, path):
+        if not self._contained(path):
+            logger.error("Janitor refused to delete %s, outside %s", path, [str(root) for root in self.roots])
+            return
+        try:
+            if path.is_dir():
+                size = sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+                shutil.rmtree(path)
+            elif path.exists():
+                size = path.stat().st_size
+                path.unlink()
+            else:
+                return
+            self.deleted_files += 1
+            self.deleted_bytes += size
+            logger.debug("Janitor deleted %s", path)
+        except OSError as e:
+            logger.warning("Janitor could not delete %s: %s", path, str(e))
+
+    def _candidates(self):
+        """Sweepable files under the roots as (mtime, size, path), oldest first"""
+        files = []
+        for root in self.roots:
+            if not root.exists():
+                continue
+            for path in root.rglob('*'):
+                try:
+                    if path.is_file() and path.suffix.lower() in SWEEP_SUFFIXES and not self._is_active(path):
+                        stat = path.stat()
+                        files.append((stat.st_mtime, stat.st_size, path))
+                except OSError:
+                    continue
+        files.sort()
+        return files
+
+    def sweep(self):
+        """Age-based sweep of orphaned files, then enforce the size limit"""
+        now = time.time()
+        files = self._candidates()
+        kept = []
+        for mtime, size, path in files:
+            if now - mtime > self.max_age:
+                self._remove(path)
+            else:
+                kept.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in kept)
+        for mtime, size, path in kept:
+            if total <= self.max_bytes:
+                break
+            logger.warning("Download area over %s bytes, removing %s", self.max_bytes, path.name)
+            self._remove(path)
+            total -= size
+
+        # Drop empty per-job directories that are no longer in use
+        for root in self.roots:
+            if not root.exists():
+                continue
+            for path in sorted(root.iterdir()):
+                if path.is_dir() and not self._is_active(path) and not any(path.iterdir()):
+                    try:
+                        path.rmdir()
+                    except OSError:
+                        pass
+
+        self.last_sweep = time.time()
+
+    def status(self):
+        with self._active_lock:
+            active = len(self._active)
+        return {
+            "active_jobs": active,
+            "queued_tasks": self._queue.qsize(),
+            "deleted_files": self.deleted_files,
+            "deleted_bytes": self.deleted_bytes,
+            "last_sweep": self.last_sweep,
+        }
+
+
+janitor = Janitor()
@@ -0,0 +1,435 @@
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import importlib
+import threading
+import multiprocessing
+from pathlib import Path
+
+import portals
+from archive import invoice_archive
+from janitor import janitor
+from jobs import Job, JobCancelled, DuplicateJob
+from log_config import job_context, job_level_var
+from scheduler import LANES, job_scheduler
+from settings import (
+    QUEUE_BACKEND, QUEUE_DB, QUEUE_POLL_INTERVAL, QUEUE_MAX_ATTEMPTS, RESULTS_DIR,
+    REPLICA_ID, REPLICA_HEARTBEAT_INTERVAL, REPLICA_TIMEOUT,
+)
+from workers import result_error
+
+logger = logging.getLogger(__name__)
+
+# Shared job queue (multi-replica mode).
+#
+# With QUEUE_BACKEND set, a request no longer runs its job in the replica
+# that received it. The job is put on a queue every replica reads; each
+# replica's dispatcher claims jobs while its scheduler has free slots, runs
+# them as usual and stores the invoice in the archive, which all replicas
+# share. The requesting replica then serves the invoice from the archive.
+# Replicas heartbeat into the queue, and jobs claimed by a replica that
+# stopped heartbeating are queued again for the others.
+
+# Finished entries nobody collected (the requester died) are dropped after this
+FINISHED_RETENTION = 3600
+
+
+class JobLost(Exception):
+    """A job that left the shared queue without a result"""
+
+
+class QueueBackend:
+    """
+    Storage of the shared queue. Anything with an atomic claim can back it;
+    on Redis, for example: a sorted set of queued ids scored by lane and
+    deadline, a hash per job for spec/status/result, and a hash of replica
+    heartbeats.
+    """
+
+    def enqueue(self, spec):
+        """Queue a job spec (a JSON-able dict with job_id, lane and deadline); DuplicateJob if its id is queued"""
+        raise NotImplementedError
+
+    def claim(self, replica_id):
+        """Atomically take the most urgent queued spec for this replica, or None"""
+        raise NotImplementedError
+
+    def finish(self, job_id, result):
+        raise NotImplementedError
+
+    def poll(self, job_id):
+        """(status, result) of a job; status is queued, running or done, or None if unknown"""
+        raise NotImplementedError
+
+    def forget(self, job_id):
+        """Drop a job once its requester has its result"""
+        raise NotImplementedError
+
+    def request_cancel(self, job_id, reason):
+        raise NotImplementedError
+
+    def cancel_requests(self, job_ids):
+        """{job_id: reason} for the given jobs whose requester cancelled them"""
+        raise NotImplementedError
+
+    def heartbeat(self, replica_id, info):
+        raise NotImplementedError
+
+    def requeue_orphans(self, timeout, max_attempts):
+        """Queue again the jobs of replicas silent for `timeout` seconds; returns their ids"""
+        raise NotImplementedError
+
+    def status(self):
+        raise NotImplementedError
+
+
+class SQLiteQueue(QueueBackend):
+    """Queue in an SQLite file, for replicas on one host or sharing a volume"""
+
+    def __init__(self, path=QUEUE_DB):
+        self.path = Path(path)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        # Opened on first use so importing this module stays free of disk access
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS queue_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    spec TEXT NOT NULL,
+                    lane_rank INTEGER NOT NULL,
+                    deadline REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    replica_id TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    cancel_reason TEXT,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS queue_jobs_next ON queue_jobs (status, lane_rank, deadline);
+                CREATE TABLE IF NOT EXISTS replicas (
+                    replica_id TEXT PRIMARY KEY,
+                    heartbeat_at REAL NOT NULL,
+                    info TEXT
+                );
+            """)
+        return self._conn
+
+    def _transaction(self, work):
+        # BEGIN IMMEDIATE takes the write lock up front, so claims from
+        # several processes never hand out the same row
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                value = work(db)
+                db.execute("COMMIT")
+                return value
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, spec):
+        now = time.time()
+
+        def work(db):
+            # Client-chosen job ids may repeat once the earlier job is done
+            db.execute("DELETE FROM queue_jobs WHERE job_id = ? AND status = 'done'", (spec["job_id"],))
+            db.execute(
+                "INSERT INTO queue_jobs (job_id, spec, lane_rank, deadline, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (spec["job_id"], json.dumps(spec), LANES.index(spec["lane"]), spec["deadline"], now, now),
+            )
+        try:
+            self._transaction(work)
+        except sqlite3.IntegrityError:
+            # Another replica holds an unfinished job with this id
+            raise DuplicateJob(f"Job {spec['job_id']} is already running") from None
+
+    def claim(self, replica_id):
+        def work(db):
+            row = db.execute(
+                "SELECT job_id, spec FROM queue_jobs WHERE status = 'queued' "
+                "ORDER BY lane_rank, deadline, created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE queue_jobs SET status = 'running', replica_id = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE job_id = ?",
+                (replica_id, time.time(), row["job_id"]),
+            )
+            return json.loads(row["spec"])
+        return self._transaction(work)
+
+    def finish(self, job_id, result):
+        with self._lock:
+            self._db().execute(
+                "UPDATE queue_jobs SET status = 'done', result = ?, updated_at = ? WHERE job_id = ?",
+                (json.dumps(result), time.time(), job_id),
+            )
+
+    def poll(self, job_id):
+        with self._lock:
+            row = self._db().execute("SELECT status, result FROM queue_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None, None
+        return row["status"], json.loads(row["result"]) if row["result"] else None
+
+    def forget(self, job_id):
+        with self._lock:
+            self._db().execute("DELETE FROM queue_jobs WHERE job_id = ?", (job_id,))
+
+    def request_cancel(self, job_id, reason):
+        def work(db):
+            # A job nobody claimed yet is simply finished as cancelled
+            db.execute(
+                "UPDATE queue_jobs SET status = 'done', result = ?, updated_at = ? "
+                "WHERE job_id = ? AND status = 'queued'",
+                (json.dumps({"cancel_reason": reason, "error": None}), time.time(), job_id),
+            )
+            db.execute("UPDATE queue_jobs SET cancel_reason = ? WHERE job_id = ? AND status = 'running'",
+                       (reason, job_id))
+        self._transaction(work)
+
+    def cancel_requests(self, job_ids):
+        if not job_ids:
+            return {}
+        placeholders = ", ".join("?" * len(job_ids))
+        with self._lock:
+            rows = self._db().execute(
+                f"SELECT job_id, cancel_reason FROM queue_jobs WHERE job_id IN ({placeholders}) "
+                "AND cancel_reason IS NOT NULL",
+                list(job_ids),
+            ).fetchall()
+        return {row["job_id"]: row["cancel_reason"] for row in rows}
+
+    def heartbeat(self, replica_id, info):
+        with self._lock:
+            self._db().execute("INSERT OR REPLACE INTO replicas VALUES (?, ?, ?)",
+                               (replica_id, time.time(), json.dumps(info)))
+
+    def requeue_orphans(self, timeout, max_attempts):
+        now = time.time()
+
+        def work(db):
+            db.execute("DELETE FROM replicas WHERE heartbeat_at < ?", (now - 10 * timeout,))
+            db.execute("DELETE FROM queue_jobs WHERE status = 'done' AND updated_at < ?", (now - FINISHED_RETENTION,))
+            orphans = db.execute(
+                "SELECT job_id, attempts FROM queue_jobs WHERE status = 'running' AND replica_id NOT IN "
+                "(SELECT replica_id FROM replicas WHERE heartbeat_at >= ?)",
+                (now - timeout,),
+            ).fetchall()
+            for row in orphans:
+                if row["attempts"] >= max_attempts:
+                    result = {"error": f"Job lost with its replica {row['attempts']} times", "cancel_reason": None}
+                    db.execute("UPDATE queue_jobs SET status = 'done', result = ?, updated_at = ? WHERE job_id = ?",
+                               (json.dumps(result), now, row["job_id"]))
+                else:
+                    db.execute("UPDATE queue_jobs SET status = 'queued', replica_id = NULL, updated_at = ? "
+                               "WHERE job_id = ?", (now, row["job_id"]))
+            return [row["job_id"] for row in orphans]
+        return self._transaction(work)
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM queue_jobs GROUP BY status").fetchall())
+            replicas = db.execute("SELECT replica_id, heartbeat_at, info FROM replicas").fetchall()
+        return {
+            "jobs": counts,
+            "replicas": [
+                {"replica_id": row["replica_id"], "heartbeat_age": round(now - row["heartbeat_at"], 1),
+                 **json.loads(row["info"] or '{}')}
+                for row in replicas
+            ],
+        }
+
+
+def load_backend(name=QUEUE_BACKEND):
+    """The configured backend: "sqlite", or "module:Class" naming a QueueBackend"""
+    if name == 'sqlite':
+        return SQLiteQueue()
+    module_name, _, class_name = name.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class SharedJobQueue:
+    """Runs jobs through the shared queue: submits them, and executes the ones this replica claims"""
+
+    def __init__(self, backend_name=QUEUE_BACKEND, replica_id=REPLICA_ID):
+        self.enabled = bool(backend_name)
+        self.backend_name = backend_name
+        self.replica_id = replica_id
+        self._backend = None
+        self._backend_lock = threading.Lock()
+        self._runner = None
+        self._thread = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.requeued = 0
+
+    @property
+    def backend(self):
+        with self._backend_lock:
+            if self._backend is None:
+                self._backend = load_backend(self.backend_name)
+            return self._backend
+
+    # -- requesting side --
+
+    def run(self, job, data):
+        """Queue the job, wait for whichever replica runs it and return a local copy of its ZIP"""
+        remaining = job.token.remaining()
+        self.backend.enqueue({
+            "job_id": job.id,
+            "servicio": job.servicio,
+            "accion": job.accion,
+            "lane": job.lane,
+            "tenant": job.tenant,
+            "deadline": time.time() + remaining if remaining is not None else time.time() + 86400,
+            "timeout": remaining,
+            "log_level": job_level_var.get(),
+            "data": data,
+        })
+        job.status = "queued"
+        try:
+            while True:
+                status, result = self.backend.poll(job.id)
+                if status == 'done':
+                    break
+                if status is None:
+                    raise JobLost(f"Job {job.id} disappeared from the shared queue")
+                if status == 'running':
+                    job.status = "running"
+                job.token.sleep(QUEUE_POLL_INTERVAL)
+        except JobCancelled as e:
+            self.backend.request_cancel(job.id, e.reason)
+            raise
+
+        self.backend.forget(job.id)
+        job.accion = result.get("accion", job.accion)
+        job.steps = result.get("steps") or []
+        job.cfdi = result.get("cfdi")
+        job.has_diagnostics = result.get("has_diagnostics", False)
+        job.http_errors = result.get("http_errors")
+        error = result_error(result)
+        if error is not None:
+            if isinstance(error, JobCancelled):
+                job.token.cancel(error.reason)
+            raise error
+        if not result.get("invoice_id"):
+            return None
+
+        # Callers own (and later release) a ZIP in their result dir; it must
+        # not be the one the job ran in, should this replica have run it
+        invoice = invoice_archive.get(result["invoice_id"])
+        source = invoice_archive.artifact_path(invoice, 'zip') if invoice else None
+        if source is None:
+            raise Exception(f"Invoice {result['invoice_id']} of job {job.id} is missing from the archive")
+        result_dir = janitor.job_directory(RESULTS_DIR, f"{job.id}-queued")
+        result_dir.mkdir(parents=True, exist_ok=True)
+        zip_path = result_dir / invoice["artifacts"]["zip"]["name"]
+        shutil.copyfile(source, zip_path)
+        return zip_path
+
+    # -- executing side --
+
+    def start(self, runner):
+        """Claim and run queued jobs with runner(job, data) -> ZIP path, heartbeating meanwhile"""
+        if not self.enabled or multiprocessing.parent_process() is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._runner = runner
+            self._thread = threading.Thread(target=self._run, name="job-queue", daemon=True)
+            self._thread.start()
+        logger.info("Replica %s reading the shared job queue (%s)", self.replica_id, self.backend_name)
+
+    def _run(self):
+        last_beat = 0
+        while True:
+            try:
+                now = time.monotonic()
+                if now - last_beat >= REPLICA_HEARTBEAT_INTERVAL:
+                    last_beat = now
+                    self.backend.heartbeat(self.replica_id, {"inflight": len(self._inflight),
+                                                             "capacity": job_scheduler.capacity})
+                    requeued = self.backend.requeue_orphans(REPLICA_TIMEOUT, QUEUE_MAX_ATTEMPTS)
+                    if requeued:
+                        self.requeued += len(requeued)
+                        logger.warning("Re-queued %s jobs of silent replicas: %s", len(requeued), requeued)
+
+                with self._lock:
+                    inflight = dict(self._inflight)
+                for job_id, reason in self.backend.cancel_requests(list(inflight)).items():
+                    inflight[job_id].token.cancel(reason)
+
+                # Claim only what the local scheduler can start right away
+                while len(self._inflight) < job_scheduler.capacity:
+                    spec = self.backend.claim(self.replica_id)
+                    if spec is None:
+                        break
+                    self._execute(spec)
+            except Exception as e:
+                logger.error("Shared job queue failed: %s", str(e))
+            time.sleep(QUEUE_POLL_INTERVAL)
+
+    def _execute(self, spec):
+        timeout = max(1.0, spec["deadline"] - time.time())
+        job = Job(spec["job_id"], servicio=spec["servicio"], accion=spec["accion"], timeout=timeout,
+                  lane=spec["lane"], tenant=spec["tenant"])
+        with self._lock:
+            self._inflight[job.id] = job
+        threading.Thread(target=self._execute_job, args=(job, spec), name=f"queued-{job.id}", daemon=True).start()
+
+    def _execute_job(self, job, spec):
+        result = {"invoice_id": None, "error": None, "cancel_reason": None, "replica_id": self.replica_id}
+        try:
+            with job_context(job.id, job.servicio, spec["log_level"]):
+                logger.info("Running queued job %s for the %s lane", job.id, job.lane)
+                zip_path = self._runner(job, spec["data"])
+                if zip_path is not None:
+                    try:
+                        invoice = invoice_archive.store(zip_path, spec["data"], job.servicio, job.id, metadata=job.cfdi)
+                        result["invoice_id"] = invoice["invoice_id"]
+                    finally:
+                        janitor.release_job(zip_path.parent)
+        except JobCancelled as e:
+            result["cancel_reason"] = e.reason
+        except Exception as e:
+            result["error"] = str(e)
+            result["rejected"] = type(e).__name__ if isinstance(e, portals.PortalRejected) else None
+        finally:
+            with self._lock:
+                self._inflight.pop(job.id, None)
+
+        result["accion"] = job.accion
+        result["steps"] = [dict(step) for step in job.steps]
+        result["cfdi"] = job.cfdi
+        result["has_diagnostics"] = job.has_diagnostics
+        result["http_errors"] = job.http_errors
+        self.executed += 1
+        self.backend.finish(job.id, result)
+
+    def status(self):
+        if not self.enabled:
+            return None
+        status = self.backend.status()
+        status.update(replica_id=self.replica_id, inflight=len(self._inflight),
+                      executed=self.executed, requeued=self.requeued)
+        return status
+
+
+job_queue = SharedJobQueue()
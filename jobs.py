@@ -0,0 +1,209 @@
+import re
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+
+from scheduler import INTERACTIVE, DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+# Default wall-clock budget for a job, kept below gunicorn's 300 s worker timeout
+DEFAULT_JOB_TIMEOUT = 240
+
+# How long finished jobs stay queryable through /jobs/<id>
+FINISHED_JOB_TTL = 3600
+
+# Client-chosen job ids end up in paths, SQLite keys and the shared queue;
+# they may only use the characters diagnostics.path_for keeps
+JOB_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class InvalidJobId(ValueError):
+    """A client-supplied job id with characters or a length we do not accept"""
+
+
+class DuplicateJob(ValueError):
+    """A client-supplied job id that an unfinished job still uses"""
+
+
+class JobCancelled(BaseException):
+    """
+    Raised inside a running job once its cancel token fires.
+
+    Derives from BaseException on purpose: ServiceStore has many broad
+    `except Exception` fallbacks that must not swallow a cancellation.
+    """
+
+    def __init__(self, reason="cancelled"):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    """Cooperative cancellation flag shared between a job and its controllers"""
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None
+        self.deadline = time.monotonic() + timeout if timeout else None
+        # Waits and sleeps check the token constantly, so this doubles as a
+        # progress marker for hang detection
+        self.last_check = time.monotonic()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def remaining(self):
+        """Seconds left before the deadline, or None when there is no deadline"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def cancel(self, reason="cancelled"):
+        """Fire the token; returns False if it was already cancelled"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+
+        logger.info("Cancel token fired: %s", reason)
+        for callback in callbacks:
+            try:
+                callback(reason)
+            except Exception as e:
+                logger.error("Cancel callback failed: %s", str(e))
+        return True
+
+    def add_callback(self, callback):
+        """Register callback(reason); runs immediately if already cancelled"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self.reason)
+
+    def check(self):
+        """Raise JobCancelled if the token fired or the deadline passed"""
+        self.last_check = time.monotonic()
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        if self._event.is_set():
+            raise JobCancelled(self.reason)
+
+    def sleep(self, seconds):
+        """Interruptible replacement for time.sleep"""
+        self.check()
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        self._event.wait(seconds)
+        self.check()
+
+
+class Job:
+    """Bookkeeping for one invoice request"""
+
+    def __init__(self, job_id, servicio=None, accion=None, timeout=DEFAULT_JOB_TIMEOUT,
+                 lane=INTERACTIVE, tenant=DEFAULT_TENANT):
+        self.id = job_id
+        self.servicio = servicio
+        self.accion = accion
+        # Scheduling lane and tenant (see scheduler.py)
+        self.lane = lane
+        self.tenant = tenant
+        self.token = CancelToken(timeout)
+        self.status = "pending"
+        self.error = None
+        self.created_at = datetime.now()
+        self.finished_at = None
+        self.has_diagnostics = False
+        # Fields of the issued CFDI, read from its XML once downloaded
+        self.cfdi = None
+        # 429 / 5xx answers from the portal, fed back to its rate limit
+        self.http_errors = None
+        # Per-step timings, filled in by the portal adapter while it runs
+        self.steps = []
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "servicio": self.servicio,
+            "accion": self.accion,
+            "lane": self.lane,
+            "tenant": self.tenant,
+            "status": self.status,
+            "error": self.error,
+            "cancel_reason": self.token.reason,
+            "diagnostics": f"/jobs/{self.id}/diagnostics" if self.has_diagnostics else None,
+            "steps": self.steps,
+            "cfdi": self.cfdi,
+            "http_errors": self.http_errors,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class JobRegistry:
+    """Thread-safe index of live and recently finished jobs"""
+
+    def __init__(self, finished_ttl=FINISHED_JOB_TTL):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.finished_ttl = finished_ttl
+
+    def create(self, job_id=None, **kwargs):
+        if job_id is not None and not JOB_ID_PATTERN.match(str(job_id)):
+            raise InvalidJobId("job_id must be 1-64 letters, digits, '-' or '_'")
+        job_id = job_id or uuid.uuid4().hex
+        with self._lock:
+            self._prune()
+            existing = self._jobs.get(job_id)
+            if existing and not existing.finished:
+                raise DuplicateJob(f"Job {job_id} is already running")
+            job = Job(job_id, **kwargs)
+            self._jobs[job_id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active(self):
+        """Number of jobs not finished yet"""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def cancel(self, job_id, reason="api"):
+        """Cancel a running job; returns the job or None if unknown"""
+        job = self.get(job_id)
+        if job and not job.finished:
+            job.token.cancel(reason)
+        return job
+
+    def finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished_at = datetime.now()
+
+    def _prune(self):
+        now = datetime.now()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and (now - job.finished_at).total_seconds() > self.finished_ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+job_registry = JobRegistry()
@@ -0,0 +1,242 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+from portals import AlreadyIssued
+from settings import JOURNAL_DB, JOURNAL_ABANDON_AFTER, JOURNAL_RETENTION_DAYS
+
+logger = logging.getLogger(__name__)
+
+# Write-ahead job journal.
+#
+# Every flow step is recorded before it runs and again when it ends, with
+# the job id and the ticket it works on. Once a step that issues the
+# invoice has clicked its submit, the ticket is marked issued (a step that
+# fails before clicking leaves it alone): should the job then die
+# (container restart, killed worker, failed download), nobody knows whether
+# the portal created the invoice, so the ticket is never submitted again.
+# Later jobs for it take the portal's `descargar` path instead, and jobs
+# left unfinished by a restart are handed to the retry scheduler for that.
+#
+# The journal also keeps a ticket index: the state a portal last showed for
+# a ticket (open or invoiced), and every ticket a job delivered. Requests to
+# issue an invoiced ticket go straight to the cheaper download flow.
+
+INVOICED = 'invoiced'
+# Step event of an issuing step whose submit was dispatched to the page
+CLICKED = 'clicked'
+OPEN = 'open'
+
+# Request fields that identify the ticket on a portal
+KEY_FIELDS = ('ticket', 'folio_factura', 'caja', 'fecha_compra', 'rfc')
+
+# Request fields kept to resume a job (the ticket and the fiscal data)
+TRANSIENT_FIELDS = ('job_id', 'timeout', 'refresh', 'webhook_url')
+
+DESCARGAR = 'descargar'
+
+
+def ticket_key(servicio, data):
+    """Stable identity of a portal ticket"""
+    fields = "\x1f".join(str(data.get(field, '')).strip().upper() for field in KEY_FIELDS)
+    return hashlib.sha256(f"{servicio}\x1f{fields}".encode()).hexdigest()
+
+
+class JobJournal:
+    """Step transitions of every job, written before the step acts"""
+
+    def __init__(self, path=JOURNAL_DB, abandon_after=JOURNAL_ABANDON_AFTER, retention_days=JOURNAL_RETENTION_DAYS):
+        self.path = Path(path)
+        self.abandon_after = abandon_after
+        self.retention = retention_days * 86400
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        # Opened on first use (per process) so importing this module stays free of disk access
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # Each transition must be on disk before the browser acts on it
+            self._conn.execute("PRAGMA synchronous=FULL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS journal_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    servicio TEXT NOT NULL,
+                    accion TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    issued INTEGER NOT NULL DEFAULT 0,
+                    last_step TEXT,
+                    started_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS journal_jobs_key ON journal_jobs (key, issued, status);
+                CREATE INDEX IF NOT EXISTS journal_jobs_status ON journal_jobs (status, updated_at);
+                CREATE TABLE IF NOT EXISTS journal_steps (
+                    job_id TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS journal_steps_job ON journal_steps (job_id);
+                CREATE TABLE IF NOT EXISTS ticket_states (
+                    key TEXT PRIMARY KEY,
+                    servicio TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            """)
+        return self._conn
+
+    def begin(self, job_id, servicio, accion, data):
+        now = time.time()
+        record = {k: v for k, v in data.items() if k not in TRANSIENT_FIELDS}
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO journal_jobs (job_id, key, servicio, accion, data, status, started_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, 'running', ?, ?)",
+                (job_id, ticket_key(servicio, data), servicio, accion, json.dumps(record), now, now),
+            )
+
+    def step(self, job_id, step, event, issues=False):
+        """Record a step transition (started, clicked, done, skipped, failed); `issues` marks the ticket issued once clicked"""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                db.execute("INSERT INTO journal_steps VALUES (?, ?, ?, ?)", (job_id, step, event, now))
+                issued = 1 if issues and event == CLICKED else 0
+                db.execute(
+                    "UPDATE journal_jobs SET last_step = ?, issued = MAX(issued, ?), updated_at = ? WHERE job_id = ?",
+                    (step, issued, now, job_id),
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def finish(self, job_id, status):
+        """Close a job; a completed one settles every earlier unfinished job for its ticket"""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("UPDATE journal_jobs SET status = ?, updated_at = ? WHERE job_id = ?", (status, now, job_id))
+            if status == 'completed':
+                db.execute(
+                    "UPDATE journal_jobs SET status = 'settled', updated_at = ? WHERE key = "
+                    "(SELECT key FROM journal_jobs WHERE job_id = ?) AND status NOT IN ('completed', 'settled')",
+                    (now, job_id),
+                )
+                db.execute(
+                    "INSERT OR REPLACE INTO ticket_states (key, servicio, state, updated_at) "
+                    "SELECT key, servicio, ?, ? FROM journal_jobs WHERE job_id = ?",
+                    (INVOICED, now, job_id),
+                )
+
+    def remember(self, servicio, data, state):
+        """Record the state the portal showed for a ticket; an open ticket was not issued after all"""
+        key, now = ticket_key(servicio, data), time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO ticket_states (key, servicio, state, updated_at) VALUES (?, ?, ?, ?)",
+                       (key, servicio, state, now))
+            if state == OPEN:
+                db.execute(
+                    "UPDATE journal_jobs SET status = 'settled', updated_at = ? "
+                    "WHERE key = ? AND issued = 1 AND status NOT IN ('running', 'completed', 'settled')",
+                    (now, key),
+                )
+
+    def ticket_state(self, servicio, data):
+        """The state last seen for a ticket, or None"""
+        with self._lock:
+            row = self._db().execute("SELECT state FROM ticket_states WHERE key = ?",
+                                     (ticket_key(servicio, data),)).fetchone()
+        return row["state"] if row else None
+
+    def issued(self, servicio, data):
+        """The latest job that may have issued this ticket's invoice without delivering it, or None"""
+        with self._lock:
+            row = self._db().execute(
+                "SELECT job_id, accion, status, last_step, updated_at FROM journal_jobs "
+                "WHERE key = ? AND issued = 1 AND status NOT IN ('completed', 'settled') "
+                "ORDER BY updated_at DESC LIMIT 1",
+                (ticket_key(servicio, data),),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def resume_action(self, adapter_cls, accion, data):
+        """
+        The action to run for the request: `descargar` instead of issuing a
+        ticket that is invoiced, or that an earlier job may have issued
+        already. Portals without a download path refuse the latter unless
+        the request says resubmit.
+        """
+        if accion != adapter_cls.default_action:
+            return accion
+        previous = self.issued(adapter_cls.servicio, data)
+        if previous is None:
+            if DESCARGAR in adapter_cls.actions and self.ticket_state(adapter_cls.servicio, data) == INVOICED:
+                logger.info("Ticket is invoiced already; downloading instead")
+                return DESCARGAR
+            return accion
+        if DESCARGAR in adapter_cls.actions:
+            logger.warning("Ticket may already be issued by job %s (stopped after %s, %s); downloading instead",
+                           previous["job_id"], previous["last_step"], previous["status"])
+            return DESCARGAR
+        if data.get('resubmit'):
+            return accion
+        raise AlreadyIssued(
+            f"Job {previous['job_id']} may already have issued this invoice (stopped after {previous['last_step']}); "
+            "check the email or send resubmit=true to submit it again"
+        )
+
+    def interrupted(self):
+        """
+        Claim jobs that stopped after issuing without finishing (their
+        process died); returns them with their request data. Each job is
+        handed out once.
+        """
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM journal_steps WHERE at < ?", (now - self.retention,))
+            db.execute("DELETE FROM journal_jobs WHERE updated_at < ?", (now - self.retention,))
+            db.execute("DELETE FROM ticket_states WHERE updated_at < ?", (now - self.retention,))
+            rows = db.execute(
+                "SELECT * FROM journal_jobs WHERE status = 'running' AND updated_at < ?",
+                (now - self.abandon_after,),
+            ).fetchall()
+            claimed = []
+            for row in rows:
+                status = 'interrupted' if row["issued"] else 'abandoned'
+                if db.execute("UPDATE journal_jobs SET status = ? WHERE job_id = ? AND status = 'running'",
+                              (status, row["job_id"])).rowcount and row["issued"]:
+                    claimed.append(dict(row, data=json.loads(row["data"])))
+        return claimed
+
+    def steps(self, job_id):
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT step, event, at FROM journal_steps WHERE job_id = ? ORDER BY rowid", (job_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def status(self):
+        with self._lock:
+            db = self._db()
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM journal_jobs GROUP BY status").fetchall())
+            tickets = dict(db.execute("SELECT state, COUNT(*) FROM ticket_states GROUP BY state").fetchall())
+        return {"jobs": counts, "tickets": tickets}
+
+
+job_journal = JobJournal()
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import contextvars
+import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Queue-based logging backend.
+#
+# Request threads only build a LogRecord and put it on an in-memory queue;
+# message formatting, JSON encoding and file/stderr I/O happen on a single
+# listener thread. Log calls use %-style arguments so nothing is formatted
+# unless a record is actually emitted.
+
+LOG_FILE = os.environ.get('LOG_FILE', 'invoice_service.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+
+# Fraction of jobs that are logged at DEBUG without being asked to
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0'))
+
+# Third-party loggers that stay at WARNING even for DEBUG jobs
+QUIET_LOGGERS = ('selenium', 'urllib3', 'werkzeug')
+
+# Per-job context, attached to every record emitted on the job's thread
+job_id_var = contextvars.ContextVar('job_id', default=None)
+servicio_var = contextvars.ContextVar('servicio', default=None)
+step_var = contextvars.ContextVar('step', default=None)
+job_level_var = contextvars.ContextVar('job_level', default=None)
+
+_listener = None
+_handlers = ()
+
+
+class JobAwareLogger(logging.Logger):
+    """
+    Logger whose effective level can be lowered for a single job.
+
+    Loggers with an explicitly configured level (e.g. selenium, urllib3) keep
+    it, so a DEBUG job does not dump every WebDriver HTTP call. Outside such
+    jobs the check is the stock one, so disabled debug calls cost nothing.
+    """
+
+    def isEnabledFor(self, level):
+        job_level = job_level_var.get()
+        if job_level is not None and level >= job_level and not self._has_own_level():
+            return not self.disabled
+        return super().isEnabledFor(level)
+
+    def _has_own_level(self):
+        logger = self
+        while logger.parent is not None:
+            if logger.level:
+                return True
+            logger = logger.parent
+        return False
+
+
+def _adopt_loggers():
+    """Turn loggers created before this module was imported into job-aware ones"""
+    for logger in list(logging.Logger.manager.loggerDict.values()):
+        if type(logger) is logging.Logger:
+            logger.__class__ = JobAwareLogger
+
+
+# Module loggers are created at import time, often before setup_logging runs
+logging.setLoggerClass(JobAwareLogger)
+_adopt_loggers()
+
+
+class JobContextFilter(logging.Filter):
+    """Attach the current job's id, servicio and step to every record"""
+
+    def filter(self, record):
+        record.job_id = job_id_var.get()
+        record.servicio = servicio_var.get()
+        record.step = step_var.get()
+        return True
+
+
+class ContextQueueHandler(QueueHandler):
+    """Enqueue the record without formatting it; JobContextFilter has attached the job context"""
+
+    def prepare(self, record):
+        return record
+
+
+class WorkerQueueHandler(ContextQueueHandler):
+    """
+    Handler for worker processes: records cross a process boundary, so the
+    message and traceback are rendered here and the record made picklable.
+    """
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        event = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "job_id": getattr(record, 'job_id', None),
+            "servicio": getattr(record, 'servicio', None),
+            "step": getattr(record, 'step', None),
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            event["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            event["exc"] = record.exc_text
+        if record.processName != 'MainProcess':
+            event["process"] = record.processName
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+def setup_logging(worker_queue=None):
+    """
+    Route all logging through the queue listener; idempotent.
+
+    Worker processes pass the supervisor's log queue instead: their records
+    are written by the web process's handlers (see listen_to_workers).
+    """
+    global _listener, _handlers
+    if _listener is not None:
+        return
+    if worker_queue is None and multiprocessing.parent_process() is not None:
+        # A worker re-importing app.py; workers.worker_main configures logging
+        return
+
+    if worker_queue is not None:
+        handler = WorkerQueueHandler(worker_queue)
+        _listener = handler
+    else:
+        formatter = JsonFormatter()
+        file_handler = RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True, encoding='utf-8'
+        )
+        file_handler.setFormatter(formatter)
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(formatter)
+        _handlers = (file_handler, stream_handler)
+
+        log_queue = queue.SimpleQueue()
+        _listener = QueueListener(log_queue, *_handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        handler = ContextQueueHandler(log_queue)
+
+    handler.addFilter(JobContextFilter())
+    # Plain loggers created since (e.g. by a library that reset the logger class)
+    _adopt_loggers()
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def listen_to_workers(worker_queue):
+    """Write records sent by worker processes with this process's handlers"""
+    listener = QueueListener(worker_queue, *_handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def resolve_job_level(requested=None):
+    """Level for one job: explicit request, random DEBUG sampling, or None (global level)"""
+    if requested:
+        level = logging.getLevelName(str(requested).upper())
+        if isinstance(level, int):
+            return level
+    if LOG_DEBUG_SAMPLE_RATE and random.random() < LOG_DEBUG_SAMPLE_RATE:
+        return logging.DEBUG
+    return None
+
+
+@contextmanager
+def job_context(job_id, servicio=None, level=None):
+    """Tag every log record emitted inside the block with the job's identity"""
+    tokens = [
+        (job_id_var, job_id_var.set(job_id)),
+        (servicio_var, servicio_var.set(servicio)),
+        (step_var, step_var.set(None)),
+        (job_level_var, job_level_var.set(level)),
+    ]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def set_step(step):
+    """Record the flow step the current job is in"""
+    step_var.set(step)
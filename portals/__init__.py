@@ -0,0 +1,87 @@
+import os
+import logging
+import importlib
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Portal adapter registry.
+#
+# Adapters are imported on first use, so a deployment only loads (and warms)
+# the portals it serves. ENABLED_PORTALS restricts the set, e.g.
+# ENABLED_PORTALS=farmaciadelahorro.
+
+PORTAL_MODULES = {
+    'farmaciaguadalajara': 'portals.guadalajara',
+    'farmaciadelahorro': 'portals.ahorro',
+}
+
+# Response formats (`formato`) and the invoice files each one needs
+FORMATOS = {
+    'zip': ('pdf', 'xml'),
+    'pdf': ('pdf',),
+    'xml': ('xml',),
+    'json': ('xml',),
+}
+DEFAULT_FORMATO = 'zip'
+
+_enabled_env = os.environ.get('ENABLED_PORTALS', '').strip()
+ENABLED_PORTALS = tuple(
+    name.strip().lower() for name in _enabled_env.split(',') if name.strip()
+) if _enabled_env else tuple(PORTAL_MODULES)
+
+_adapters = {}
+_lock = threading.Lock()
+
+
+class UnknownPortal(ValueError):
+    """The requested servicio has no adapter or is disabled in this deployment"""
+
+
+class PortalRejected(Exception):
+    """The portal refused the request's data (a validation message shown on the page)"""
+
+
+class TicketNotYetAvailable(PortalRejected):
+    """The portal does not know the ticket yet (same-day purchases); worth retrying later"""
+
+
+class AlreadyIssued(PortalRejected):
+    """An earlier job may have issued this ticket's invoice; submitting again could duplicate it"""
+
+
+# Flow that only checks the ticket with the portal (see preflight.py)
+PREFLIGHT = 'preflight'
+
+
+def register(adapter_cls):
+    """Class decorator used by adapter modules"""
+    _adapters[adapter_cls.servicio] = adapter_cls
+    return adapter_cls
+
+
+def get_adapter(servicio):
+    """Return the adapter class for a servicio, importing its module if needed"""
+    servicio = (servicio or '').lower()
+    if servicio not in ENABLED_PORTALS or servicio not in PORTAL_MODULES:
+        raise UnknownPortal(f"Unsupported servicio: {servicio or None}")
+    with _lock:
+        if servicio not in _adapters:
+            importlib.import_module(PORTAL_MODULES[servicio])
+        return _adapters[servicio]
+
+
+def formato_files(data):
+    """Invoice files the request's formato needs"""
+    return FORMATOS.get((data.get('formato') or DEFAULT_FORMATO).lower(), FORMATOS[DEFAULT_FORMATO])
+
+
+def enabled_adapters():
+    """Load and return the adapters enabled for this deployment"""
+    adapters = []
+    for servicio in ENABLED_PORTALS:
+        try:
+            adapters.append(get_adapter(servicio))
+        except Exception as e:
+            logger.error("Could not load portal adapter %s: %s", servicio, str(e))
+    return adapters
@@ -0,0 +1,107 @@
+from selenium.webdriver.common.by import By
+
+from portals import register
+from portals.base import PortalAdapter
+from portals.flow import (
+    Navigate, FillBatch, ClickFirstMatch, Branch, CaptureDownload,
+    SWAL_ERROR, SWAL_DISMISS_CANDIDATES, needs,
+)
+from settings import PORTAL_URLS
+
+LOWER = "translate(text(), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')"
+
+CONTINUAR_CANDIDATES = (
+    (By.XPATH, "//button[contains(@class, 'btn btn-primary') and contains(@class, 'buttonSubmit') and contains(text(), 'Continuar')]"),
+    (By.XPATH, "//button[contains(@class, 'buttonSubmit') and contains(text(), 'Continuar')]"),
+    (By.XPATH, "//button[contains(@class, 'heightButton') and contains(text(), 'Continuar')]"),
+    (By.XPATH, "//button[contains(@class, 'btn-primary') and contains(text(), 'Continuar')]"),
+    (By.XPATH, "//button[contains(text(), 'Continuar')]"),
+    (By.XPATH, f"//button[contains({LOWER}, 'continuar')]"),
+)
+
+
+def download_candidates(kind):
+    """Fallback selectors for the 'Descargar PDF' / 'Descargar XML' links"""
+    label = f"Descargar {kind.upper()}"
+    return (
+        (By.XPATH, f"//a[contains(@class, 'btn btn-danger') and contains(@class, 'heightButton') and contains(text(), '{label}')]"),
+        (By.XPATH, f"//a[.//i[contains(@class, 'bi-filetype-{kind}')] and contains(text(), '{label}')]"),
+        (By.XPATH, f"//a[contains(text(), '{label}')]"),
+        (By.XPATH, f"//a[.//i[contains(@class, 'bi-filetype-{kind}')]]"),
+        (By.XPATH, f"//a[contains(@href, '.{kind}') and contains(@class, 'btn-danger')]"),
+        (By.XPATH, f"//a[contains({LOWER}, 'descargar') and contains({LOWER}, '{kind}')]"),
+    )
+
+
+# After Continuar the portal shows the fiscal form of an open ticket or the
+# download links of an invoiced one; an error popup says why the ticket was
+# not found
+LOOKUP_RESULT = SWAL_ERROR + """
+var links = document.querySelectorAll('a');
+for (var i = 0; i < links.length; i++) {
+    if (/descargar/i.test(links[i].textContent) && __visible(links[i])) return {state: 'invoiced'};
+}
+var form = document.getElementById('ConfirmarCorreo');
+if (form && __visible(form)) return {state: 'open'};
+return false;
+"""
+
+
+# Both actions start by looking the ticket up, and end by downloading the
+# files the requested formato needs. A ticket that turns out to be invoiced
+# already is downloaded in the same session instead of failing facturar.
+LOOKUP_STEPS = (
+    Navigate(),
+    FillBatch('first_section', ('rfc', 'ticket')),
+    ClickFirstMatch('continuar', ('continuar',), clicks=('native', 'js')),
+)
+
+DOWNLOAD_STEPS = (
+    ClickFirstMatch('download_pdf', download_candidates('pdf'), timeout=30, when=needs('pdf')),
+    ClickFirstMatch('download_xml', download_candidates('xml'), timeout=30, when=needs('xml')),
+    CaptureDownload(),
+)
+
+
+@register
+class AhorroAdapter(PortalAdapter):
+    """Farmacias del Ahorro (masfacturaweb): PDF and XML downloaded separately and zipped"""
+
+    servicio = 'farmaciadelahorro'
+    url = PORTAL_URLS['farmaciadelahorro']
+
+    actions = ('facturar', 'descargar')
+    flows = {
+        'facturar': LOOKUP_STEPS + (
+            Branch('lookup', LOOKUP_RESULT, routes={'invoiced': 'descargar'}, timeout=30),
+            FillBatch('second_section', ('email', 'regimen_fiscal', 'uso_cfdi')),
+            ClickFirstMatch('dismiss_popups', SWAL_DISMISS_CANDIDATES, timeout=0, optional=True),
+            ClickFirstMatch('confirm', CONTINUAR_CANDIDATES, timeout=30),
+            ClickFirstMatch('generar', ('generar',), clicks=('native', 'js'), issues=True),
+        ) + DOWNLOAD_STEPS,
+        'descargar': LOOKUP_STEPS + (
+            Branch('lookup', LOOKUP_RESULT, timeout=30, rejections={
+                'open': "The ticket has not been invoiced yet; request it with facturar",
+            }),
+            ClickFirstMatch('dismiss_popups', SWAL_DISMISS_CANDIDATES, timeout=0, optional=True),
+        ) + DOWNLOAD_STEPS,
+    }
+
+    required_fields = {
+        'facturar': ('ticket', 'rfc', 'email', 'regimen_fiscal', 'uso_cfdi'),
+        'descargar': ('ticket', 'rfc'),
+    }
+
+    landing_fields = ('rfc', 'ticket')
+
+    selectors = {
+        'rfc': 'TextRfc',
+        'ticket': 'inputAddress',
+        'continuar': 'btnContinuar',
+        'email': 'ConfirmarCorreo',
+        'regimen_fiscal': 'inputRF',
+        'uso_cfdi': 'inputState',
+        'generar': 'GenerarFactura',
+    }
+
+    artifacts = ('pdf', 'xml')
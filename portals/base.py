@@ -0,0 +1,275 @@
+import re
+import time
+import logging
+import threading
+
+from selenium.common.exceptions import TimeoutException
+
+import sat
+from portals import PortalRejected, TicketNotYetAvailable
+from portals.flow import Reroute
+from jobs import DEFAULT_JOB_TIMEOUT
+from journal import job_journal
+from log_config import set_step
+from settings import DRIVER_PARK_TTL, DRIVER_PARK_MIN_COOKIE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Portal messages meaning the ticket has not reached the invoicing system
+# yet, e.g. "El ticket aun no esta disponible, intente en 24 horas"
+NOT_YET_AVAILABLE_PATTERNS = (
+    r'a[uú]n no (est[aá]|se encuentra)',
+    r'no (est[aá]|se encuentra) disponible',
+    r'intent(e|elo|ar)\s+(m[aá]s tarde|nuevamente|de nuevo|en \d+)',
+    r'\b(24|48|72)\s*(hrs?|horas)\b',
+    r'no ha sido (procesad|registrad|sincronizad)',
+)
+
+
+class PortalAdapter:
+    """
+    One pharmacy portal: its URL, the fields each action needs, the page
+    selectors it relies on, the files it produces and the ordered steps of
+    each flow.
+
+    An adapter is created per job around a ServiceStore, which provides the
+    browser and the generic Selenium helpers (waits, fills, download
+    handling). Attribute lookups the adapter does not define fall through to
+    the store, so steps can call `self.sending_file`, `self._sleep`,
+    `self.driver` and so on.
+
+    Flows are declarative step tuples (see portals/flow.py), compiled once
+    per class and run by `run`, which times every step and counts its
+    browser round trips in `self.timings`.
+    """
+
+    # Identity
+    servicio = None
+    url = None
+
+    # Actions and their ordered flow steps
+    actions = ('facturar',)
+    default_action = 'facturar'
+    flows = {}
+
+    _compiled = False
+    _compile_lock = threading.Lock()
+
+    # Request fields required per action
+    required_fields = {}
+
+    # Fields the portal checks in the `preflight` flow (empty: no preflight)
+    preflight_fields = ()
+
+    # Rejection messages classified as TicketNotYetAvailable
+    not_yet_available_patterns = NOT_YET_AVAILABLE_PATTERNS
+
+    # Element ids / selectors used by the flows
+    selectors = {}
+
+    # Files the portal produces for the invoice
+    artifacts = ('zip',)
+
+    # Fields that must be empty and ready on the landing page before a job
+    # may skip navigating (empty: pooled drivers are not parked here), and
+    # how long a parked page stays usable
+    landing_fields = ()
+    landing_ttl = DRIVER_PARK_TTL
+
+    # Scheduling hints used by the driver pool and job runner
+    pool_size = 1
+    timeout = DEFAULT_JOB_TIMEOUT
+
+    # Politeness limits enforced by the job scheduler: concurrent sessions,
+    # new sessions per minute and how many may start back to back
+    max_sessions = 2
+    rate_per_minute = 12
+    burst = 3
+
+    def __init__(self, store, job_id=None):
+        self.store = store
+        # Set for jobs whose steps go to the job journal
+        self.job_id = job_id
+        self.timings = []
+        self.round_trips = 0
+        self.accion = None
+
+    def __getattr__(self, name):
+        # Only reached for names the adapter itself does not define
+        store = self.__dict__.get('store')
+        if store is None:
+            raise AttributeError(name)
+        return getattr(store, name)
+
+    @classmethod
+    def missing_fields(cls, data, accion):
+        """Required fields absent from the request for this action"""
+        required = list(cls.required_fields.get(accion, ()))
+        if data.get('send_email', False):
+            required += ['email', 'email_confirm']
+        return [field for field in required if field not in data]
+
+    @classmethod
+    def rejection(cls, message):
+        """The exception for a message the portal showed while refusing the request"""
+        if any(re.search(pattern, message, re.IGNORECASE) for pattern in cls.not_yet_available_patterns):
+            return TicketNotYetAvailable(message)
+        return PortalRejected(message)
+
+    @classmethod
+    def describe(cls):
+        return {
+            "servicio": cls.servicio,
+            "url": cls.url,
+            "actions": list(cls.actions),
+            "required_fields": {accion: list(fields) for accion, fields in cls.required_fields.items()},
+            "steps": {accion: [step.describe() for step in steps] for accion, steps in cls.flows.items()},
+            "artifacts": list(cls.artifacts),
+            "preflight_fields": list(cls.preflight_fields),
+            "timeout": cls.timeout,
+        }
+
+    @classmethod
+    def compile(cls):
+        """Compile every flow step into its browser script (idempotent)"""
+        if cls._compiled:
+            return
+        with cls._compile_lock:
+            if '_compiled' in cls.__dict__:
+                return
+            count = 0
+            for steps in cls.flows.values():
+                for step in steps:
+                    step.compile(cls)
+                    count += 1
+            cls._compiled = True
+        logger.info("Compiled %s flow steps for %s", count, cls.servicio)
+
+    # -- helpers used by the steps --
+
+    def budget(self, timeout):
+        """A step's wait limit, clamped to what is left of the job's budget"""
+        remaining = self.cancel_token.remaining()
+        if remaining is None:
+            return timeout
+        return min(timeout, remaining)
+
+    def poll(self, condition, timeout):
+        """Poll condition() until it returns something truthy, within budget"""
+        try:
+            return self._wait(self.budget(timeout)).until(lambda driver: condition())
+        except TimeoutException:
+            # Report an exhausted job budget as the deadline, not a step timeout
+            self.cancel_token.check()
+            raise
+
+    def command(self, method, *args):
+        """Issue one WebDriver command, counted against the current step"""
+        self.round_trips += 1
+        return method(*args)
+
+    def option_value(self, field, value):
+        """The portal's <option> value for a SAT catalog field; other fields pass through"""
+        if field not in sat.CATALOG_FIELDS or value is None:
+            return value
+        mapped = sat.catalog_index().option_value(self.servicio, field, str(value).strip().upper())
+        return value if mapped is None else mapped
+
+    def record_options(self, field, options):
+        """Keep a catalog select's options for the next `python sat.py refresh`"""
+        if field in sat.CATALOG_FIELDS:
+            sat.record_options(self.servicio, field, options)
+
+    def checkpoint(self, step, event):
+        """Journal a step transition before acting on it (see journal.py)"""
+        if self.job_id:
+            job_journal.step(self.job_id, step.name, event, issues=step.issues)
+
+    def landing_ready(self, step):
+        """
+        True when the pooled driver was parked on this portal's landing page
+        (see driver_pool.py) and the page is still fresh: young enough, no
+        portal cookie about to expire, Angular stable and the first fields
+        empty and enabled.
+        """
+        parked = getattr(self.driver, 'parked', None)
+        if not parked or parked["servicio"] != self.servicio or not step.landing_script:
+            return False
+        # A parked page serves one job
+        self.driver.parked = None
+        fresh = time.monotonic() - parked["at"] < self.landing_ttl
+        if fresh:
+            expiries = [c["expiry"] for c in self.command(self.driver.get_cookies) if c.get("expiry")]
+            fresh = all(expiry > time.time() + DRIVER_PARK_MIN_COOKIE_TTL for expiry in expiries)
+        fresh = fresh and self.command(self.driver.execute_script, step.landing_script) is True
+        if self.driver_pool:
+            self.driver_pool.note_landing(fresh)
+        return fresh
+
+    def remember_state(self, data, state):
+        """Record what the portal says about the ticket, so later requests pick the right flow"""
+        job_journal.remember(self.servicio, data, state)
+
+    def script(self, step, *args):
+        """Run a step's compiled script"""
+        return self.command(self.driver.execute_script, step.script, *args)
+
+    def run(self, data, accion):
+        """
+        Execute the action's flow; returns the invoice ZIP path from its
+        download step. A step may reroute the job to another action, whose
+        flow then continues after the step of the same name; `self.accion`
+        is the action that ran last.
+        """
+        self.compile()
+        self.accion = accion
+        steps = self.flows[accion]
+        position = 0
+        result = None
+        while position < len(steps):
+            step = steps[position]
+            position += 1
+            set_step(step.name)
+            self.cancel_token.check()
+            record = {"step": step.name, "kind": step.kind, "status": "running",
+                      "seconds": None, "round_trips": 0}
+            self.timings.append(record)
+            if step.when and not step.when(data):
+                record["status"] = "skipped"
+                continue
+
+            self.round_trips = 0
+            self.checkpoint(step, 'started')
+            started = time.monotonic()
+            try:
+                value = step.execute(self, data)
+                record["status"] = "done"
+            except TimeoutException:
+                if not step.optional:
+                    record["status"] = "failed"
+                    logger.error("Step %s timed out", step.name)
+                    raise
+                record["status"] = "skipped"
+                value = None
+            except BaseException as e:
+                record["status"] = "failed"
+                logger.error("Step %s failed: %s", step.name, str(e))
+                # Page state is captured by the failure snapshot (see diagnostics.py)
+                raise
+            finally:
+                record["seconds"] = round(time.monotonic() - started, 3)
+                record["round_trips"] = self.round_trips
+                self.checkpoint(step, record["status"])
+
+            logger.info("Step %s %s in %.2fs (%s round trips)",
+                        step.name, record["status"], record["seconds"], record["round_trips"])
+            if isinstance(value, Reroute):
+                if value.accion != self.accion:
+                    logger.info("Switching from %s to %s after %s: %s", self.accion, value.accion, step.name, value.reason)
+                    self.accion = value.accion
+                    steps = self.flows[value.accion]
+                    position = [s.name for s in steps].index(step.name) + 1
+                continue
+            if value is not None:
+                result = value
+        return result
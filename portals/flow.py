@@ -0,0 +1,427 @@
+import json
+import logging
+
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.action_chains import ActionChains
+
+from portals import formato_files
+
+logger = logging.getLogger(__name__)
+
+# Declarative flow steps executed by PortalAdapter.run.
+#
+# Each step is compiled once per adapter class (at startup, see
+# startup._run) into a single browser script with its selectors inlined.
+# Polling a step or applying it is then one execute_script round trip,
+# instead of one WebDriver command per element, attribute and event.
+
+# Helpers prepended to every compiled script
+RUNTIME = """
+var __find = function (how, sel) {
+    if (how === 'id') return document.getElementById(sel);
+    if (how === 'css') return document.querySelector(sel);
+    return document.evaluate(sel, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+};
+var __visible = function (el) {
+    if (!el) return false;
+    var style = window.getComputedStyle(el);
+    return style.visibility !== 'hidden' && style.display !== 'none' && el.getClientRects().length > 0;
+};
+var __enabled = function (el) {
+    return !el.disabled && !el.hasAttribute('disabled') && el.getAttribute('aria-disabled') !== 'true';
+};
+var __fire = function (el, types) {
+    types.forEach(function (type) { el.dispatchEvent(new Event(type, {bubbles: true})); });
+};
+"""
+
+# Angular Material buttons expect the full pointer sequence, and submit
+# buttons the form's submit event
+EVENTS_CLICK = """
+var element = arguments[0];
+['mousedown', 'mouseup', 'click'].forEach(function (type) {
+    element.dispatchEvent(new MouseEvent(type, {bubbles: true, cancelable: true, view: window}));
+});
+if (element.type === 'submit') {
+    var form = element.closest('form');
+    if (form) {
+        form.dispatchEvent(new Event('submit', {bubbles: true, cancelable: true}));
+    }
+}
+"""
+
+# Conditions shared by the portal flows
+SWAL_CLOSED = """
+var popup = document.querySelector('.swal2-container');
+return !popup || !__visible(popup);
+"""
+
+# Prefix for conditions: an error or warning popup fails the step with its text
+SWAL_ERROR = """
+var icon = document.querySelector('.swal2-icon-error, .swal2-icon-warning');
+if (icon && __visible(icon)) {
+    var text = ['.swal2-title', '.swal2-html-container', '.swal2-content'].map(function (sel) {
+        var el = document.querySelector(sel);
+        return el ? el.textContent.trim() : '';
+    }).filter(Boolean).join(' - ');
+    return 'Portal message: ' + (text || 'error');
+}
+"""
+
+# A landing page a pooled driver loaded while idle is usable when it is
+# still the portal's page, Angular is stable, no popup is open and the first
+# fields are there, enabled and empty
+LANDING_READY = """
+var fields = %s;
+if (document.readyState !== 'complete' || location.href.indexOf(%s) !== 0) return false;
+var popup = document.querySelector('.swal2-container');
+if (popup && __visible(popup)) return false;
+if (window.getAllAngularTestabilities &&
+    !window.getAllAngularTestabilities().every(function (t) { return t.isStable(); })) return false;
+for (var i = 0; i < fields.length; i++) {
+    var el = __find(fields[i][0], fields[i][1]);
+    if (!el || !__visible(el) || !__enabled(el) || el.value) return false;
+}
+return true;
+"""
+
+SWAL_CONFIRM_CANDIDATES = (
+    (By.CSS_SELECTOR, "button.swal2-confirm"),
+    (By.XPATH, "//div[contains(@class, 'swal2-container')]//button[contains(text(), 'Aceptar')]"),
+    (By.XPATH, "//div[contains(@class, 'swal2-container')]//button[@type='button']"),
+)
+
+SWAL_DISMISS_CANDIDATES = (
+    (By.CSS_SELECTOR, ".swal2-container .swal2-close"),
+    (By.CSS_SELECTOR, ".swal2-container .swal2-confirm"),
+    (By.CSS_SELECTOR, ".swal2-container .swal2-cancel"),
+)
+
+_HOW = {By.ID: 'id', By.CSS_SELECTOR: 'css', By.XPATH: 'xpath'}
+
+
+def locator(target, selectors):
+    """Normalise a (By, value) pair or an adapter selector key (an element id)"""
+    if isinstance(target, str):
+        return By.ID, selectors[target]
+    by, value = target
+    if by == By.CLASS_NAME:
+        return By.CSS_SELECTOR, '.' + value
+    if by not in _HOW:
+        raise ValueError(f"Unsupported locator strategy for compiled steps: {by}")
+    return by, value
+
+
+def needs(kind):
+    """`when` predicate: run the step only if the request's formato needs this file"""
+    def predicate(data):
+        return kind in formato_files(data)
+    return predicate
+
+
+class Step:
+    """
+    One declarative step.
+
+    `timeout` is the step's own wait limit; it is clamped to what is left of
+    the job's budget when the step runs. `when(data)` skips the step when it
+    returns false, and an `optional` step that times out is skipped instead
+    of failing the flow. A step that `issues` the invoice (the final submit)
+    is the point of no return recorded by the job journal once its click
+    has been dispatched.
+    """
+
+    kind = None
+
+    def __init__(self, name, timeout=15, when=None, optional=False, issues=False):
+        self.name = name
+        self.timeout = timeout
+        self.when = when
+        self.optional = optional
+        self.issues = issues
+        self.script = None
+
+    def compile(self, adapter_cls):
+        """Build the step's browser script; runs once per adapter class"""
+        body = self.build(adapter_cls)
+        self.script = RUNTIME + body if body else None
+        return self
+
+    def build(self, adapter_cls):
+        return None
+
+    def execute(self, adapter, data):
+        raise NotImplementedError
+
+    def describe(self):
+        return {"name": self.name, "kind": self.kind, "timeout": self.timeout, "optional": self.optional,
+                "issues": self.issues}
+
+
+class Navigate(Step):
+    """
+    Open the portal (or `url`) and wait for the document to load. A pooled
+    driver parked on the portal's landing page skips this when the page is
+    still fresh (see PortalAdapter.landing_ready).
+    """
+
+    kind = 'navigate'
+
+    def __init__(self, name='navigate', url=None, timeout=30, **kwargs):
+        super().__init__(name, timeout=timeout, **kwargs)
+        self.url = url
+        self.landing_script = None
+
+    def build(self, adapter_cls):
+        if self.url is None and adapter_cls.landing_fields:
+            spec = [[_HOW[by], value] for by, value in (locator(key, adapter_cls.selectors)
+                                                       for key in adapter_cls.landing_fields)]
+            self.landing_script = RUNTIME + LANDING_READY % (json.dumps(spec), json.dumps(adapter_cls.url))
+        return "return document.readyState === 'complete';"
+
+    def execute(self, adapter, data):
+        if self.url is None and adapter.landing_ready(self):
+            logger.info("Landing page loaded while the driver was idle is still fresh, not navigating")
+            return
+        url = self.url or adapter.url
+        logger.info("Navigating to %s", url)
+        adapter.command(adapter.driver.get, url)
+        adapter.poll(lambda: adapter.script(self), self.timeout)
+
+        # Debug: Print page elements if in debug mode
+        if logger.isEnabledFor(logging.DEBUG):
+            adapter.debug_page_elements()
+
+
+class FillBatch(Step):
+    """
+    Fill several fields in one round trip.
+
+    `fields` are adapter selector keys; each value comes from the request
+    data under the same key unless overridden in `values`. Text inputs get
+    their value and input/change/blur events, selects are checked for the
+    option first, checkboxes are toggled to the wanted state. The batch
+    waits until every field is present and enabled, then applies all of
+    them at once; a text field whose value does not stick is retyped.
+    """
+
+    kind = 'fill-batch'
+
+    def __init__(self, name, fields, values=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.fields = tuple(fields)
+        self.values = values or {}
+        self.locators = {}
+
+    def build(self, adapter_cls):
+        self.locators = {key: locator(key, adapter_cls.selectors) for key in self.fields}
+        spec = [[key, _HOW[by], value] for key, (by, value) in self.locators.items()]
+        return """
+var fields = %s;
+var values = arguments[0];
+var elements = {};
+for (var i = 0; i < fields.length; i++) {
+    var el = __find(fields[i][1], fields[i][2]);
+    if (!el || !__enabled(el)) return null;
+    elements[fields[i][0]] = el;
+}
+var result = {invalid: [], mismatched: [], options: {}};
+fields.forEach(function (f) {
+    var el = elements[f[0]], value = values[f[0]];
+    if (el.tagName === 'SELECT') {
+        result.options[f[0]] = Array.prototype.map.call(el.options, function (o) { return [o.value, o.text.trim()]; });
+        var known = Array.prototype.some.call(el.options, function (o) { return o.value === String(value); });
+        if (!known) { result.invalid.push(f[0]); return; }
+        el.value = String(value);
+        __fire(el, ['change']);
+    } else if (el.type === 'checkbox' || el.type === 'radio') {
+        if (el.checked !== !!value) el.click();
+    } else {
+        if (el.focus) el.focus();
+        var setter = Object.getOwnPropertyDescriptor(Object.getPrototypeOf(el), 'value').set;
+        setter.call(el, String(value));
+        __fire(el, ['input', 'change', 'blur']);
+        if (el.value !== String(value)) result.mismatched.push(f[0]);
+    }
+});
+return result;
+""" % json.dumps(spec)
+
+    def execute(self, adapter, data):
+        values = {key: adapter.option_value(key, self.values.get(key, data.get(key))) for key in self.fields}
+        logger.info("Filling %s", ", ".join(self.fields))
+        result = adapter.poll(lambda: adapter.script(self, values), self.timeout)
+
+        for key, options in result.get('options', {}).items():
+            adapter.record_options(key, options)
+        if result['invalid']:
+            raise ValueError(
+                "No option for " + ", ".join(f"{key}={values[key]!r}" for key in result['invalid'])
+            )
+        for key in result['mismatched']:
+            logger.warning("Value for %s did not stick, retyping it", key)
+            element = adapter.command(adapter.driver.find_element, *self.locators[key])
+            adapter._simple_clear_and_fill(element, str(values[key]))
+
+
+class ClickFirstMatch(Step):
+    """
+    Click the first candidate that is visible and enabled.
+
+    All candidates are checked in the same poll, so a flow no longer waits
+    out one timeout per fallback selector. `text` additionally requires the
+    element's text to contain it (case-insensitive). `clicks` is the order
+    of click strategies tried on the matched element.
+    """
+
+    kind = 'click-first-match'
+
+    CLICKS = ('native', 'js', 'actions', 'events')
+
+    def __init__(self, name, candidates, text=None, clicks=CLICKS, **kwargs):
+        super().__init__(name, **kwargs)
+        self.candidates = tuple(candidates)
+        self.text = text
+        self.clicks = tuple(clicks)
+
+    def build(self, adapter_cls):
+        spec = []
+        for target in self.candidates:
+            by, value = locator(target, adapter_cls.selectors)
+            spec.append([_HOW[by], value])
+        return """
+var candidates = %s;
+var text = %s;
+for (var i = 0; i < candidates.length; i++) {
+    var el;
+    try { el = __find(candidates[i][0], candidates[i][1]); } catch (e) { continue; }
+    if (!el || !__visible(el) || !__enabled(el)) continue;
+    if (text && (el.textContent || '').toLowerCase().indexOf(text) < 0) continue;
+    el.scrollIntoView({block: 'center'});
+    return [i, el];
+}
+return null;
+""" % (json.dumps(spec), json.dumps(self.text.lower() if self.text else None))
+
+    def execute(self, adapter, data):
+        index, element = adapter.poll(lambda: adapter.script(self), self.timeout)
+        logger.info("%s: matched candidate %s", self.name, index + 1)
+
+        for strategy in self.clicks:
+            try:
+                self._click(adapter, element, strategy)
+                logger.info("✓ %s clicked using %s", self.name, strategy)
+                if self.issues:
+                    # The submit reached the page; the portal may issue the invoice from here
+                    adapter.checkpoint(self, 'clicked')
+                return
+            except Exception as e:
+                logger.warning("%s click failed for %s: %s", strategy, self.name, str(e))
+        raise Exception(f"Could not click {self.name} with any strategy")
+
+    def _click(self, adapter, element, strategy):
+        driver = adapter.driver
+        if strategy == 'native':
+            adapter.command(element.click)
+        elif strategy == 'js':
+            adapter.command(driver.execute_script, "arguments[0].click();", element)
+        elif strategy == 'events':
+            adapter.command(driver.execute_script, EVENTS_CLICK, element)
+        elif strategy == 'actions':
+            adapter.command(ActionChains(driver).move_to_element(element).pause(0.5).click().perform)
+        else:
+            raise ValueError(f"Unknown click strategy: {strategy}")
+
+
+class AwaitCondition(Step):
+    """
+    Poll a JavaScript condition.
+
+    The body returns true when the condition holds, false to keep waiting,
+    or a string to fail the step immediately with that message (e.g. a
+    validation error shown by the portal), raised as the adapter classifies
+    it (PortalRejected or TicketNotYetAvailable).
+    """
+
+    kind = 'await-condition'
+
+    def __init__(self, name, condition, **kwargs):
+        super().__init__(name, **kwargs)
+        self.condition = condition
+
+    def build(self, adapter_cls):
+        return self.condition
+
+    def execute(self, adapter, data):
+        result = adapter.poll(lambda: adapter.script(self), self.timeout)
+        if isinstance(result, str):
+            raise adapter.rejection(result)
+
+
+class Reroute:
+    """Returned by a step to continue the job with another action's flow"""
+
+    def __init__(self, accion, reason):
+        self.accion = accion
+        self.reason = reason
+
+
+class Branch(AwaitCondition):
+    """
+    Poll a condition that tells which state the portal is in.
+
+    The body returns {state: name} once the page settles (or a string to
+    fail, as in AwaitCondition). The state is recorded in the ticket index
+    (see journal.py); a state in `routes` continues the job with that
+    action's flow, after the step of the same name, in the same browser
+    session, and one in `rejections` refuses the request with its message.
+    """
+
+    kind = 'branch'
+
+    def __init__(self, name, condition, routes=None, rejections=None, **kwargs):
+        super().__init__(name, condition, **kwargs)
+        self.routes = routes or {}
+        self.rejections = rejections or {}
+
+    def execute(self, adapter, data):
+        result = adapter.poll(lambda: adapter.script(self), self.timeout)
+        if isinstance(result, str):
+            raise adapter.rejection(result)
+        state = result['state']
+        logger.info("%s: portal shows the ticket as %s", self.name, state)
+        adapter.remember_state(data, state)
+        if state in self.rejections:
+            raise adapter.rejection(self.rejections[state])
+        if state in self.routes:
+            return Reroute(self.routes[state], f"ticket is {state}")
+        return None
+
+    def describe(self):
+        return dict(super().describe(), routes=self.routes)
+
+
+class CaptureDownload(Step):
+    """
+    Wait for the adapter's artifacts in the job's download directory and
+    return the path of the invoice ZIP, zipping PDF and XML when the portal
+    delivers them separately. Separate files are only waited for when the
+    request's formato needs them.
+    """
+
+    kind = 'capture-download'
+
+    def __init__(self, name='download', timeout=60, **kwargs):
+        super().__init__(name, timeout=timeout, **kwargs)
+
+    def execute(self, adapter, data):
+        timeout = adapter.budget(self.timeout)
+        if 'zip' in adapter.artifacts:
+            return adapter.sending_file(timeout)
+
+        kinds = tuple(kind for kind in adapter.artifacts if kind in formato_files(data))
+        pdf_file, xml_file = adapter._wait_for_both_downloads(timeout, kinds=kinds)
+        zip_file_path = adapter._create_zip_from_files(pdf_file, xml_file)
+        adapter._cleanup_individual_files(pdf_file, xml_file)
+        logger.info("✓ Invoice ZIP created successfully: %s", zip_file_path)
+        return zip_file_path
@@ -0,0 +1,118 @@
+from selenium.webdriver.common.by import By
+
+from portals import register, PREFLIGHT
+from portals.base import PortalAdapter
+from portals.flow import (
+    Navigate, FillBatch, ClickFirstMatch, AwaitCondition, CaptureDownload,
+    SWAL_CLOSED, SWAL_ERROR, SWAL_CONFIRM_CANDIDATES, SWAL_DISMISS_CANDIDATES,
+)
+from settings import PORTAL_URLS
+
+
+def wants_email(data):
+    return data.get('send_email', False)
+
+
+# Angular Material "Validar Folio" FAB
+VALIDAR_FOLIO_CANDIDATES = (
+    (By.XPATH, "//button[@mat-fab='' and @extended='' and @type='submit' and contains(@class, 'primary')]"),
+    (By.XPATH, "//button[contains(@class, 'mdc-fab') and contains(@class, 'mat-mdc-fab') and contains(@class, 'mdc-fab--extended') and @type='submit']"),
+    (By.XPATH, "//span[@class='mdc-button__label' and normalize-space(text())='Validar Folio']/parent::button"),
+    (By.XPATH, "//button[contains(@class, 'mat-accent') and @type='submit' and contains(@class, 'mdc-fab--extended')]"),
+    (By.CSS_SELECTOR, "button.mdc-fab.mat-mdc-fab.mdc-fab--extended[type='submit']"),
+    (By.XPATH, "//button[@type='submit' and contains(@class, 'primary')]"),
+)
+
+# The folio was accepted once the terms popup shows up; a mat-error or an
+# error popup means it was not
+VALIDATION_RESULT = SWAL_ERROR + """
+var error = document.querySelector('mat-error, .mat-mdc-form-field-error, .alert-danger');
+if (error && __visible(error) && error.textContent.trim()) {
+    return 'Form validation failed: ' + error.textContent.trim();
+}
+var confirm = document.querySelector('.swal2-confirm');
+return !!(confirm && __visible(confirm));
+"""
+
+# Terms popup after validation; older builds used other button classes
+TERMS_CONFIRM_CANDIDATES = (
+    (By.CLASS_NAME, "swal2-confirm"),
+    (By.CLASS_NAME, "swal2-styled"),
+    (By.CLASS_NAME, "swal2-default-outline"),
+    (By.CLASS_NAME, "btn-confirm"),
+    (By.CLASS_NAME, "btn-ok"),
+)
+
+OBTENER_FACTURA_CANDIDATES = (
+    (By.XPATH, "//span[@class='mdc-button__label' and normalize-space(text())='Obtener Factura']/parent::button"),
+    (By.XPATH, "//button[@type='submit' and contains(@class, 'mdc-fab--extended') and contains(@class, 'mat-mdc-fab')]"),
+    (By.XPATH, "//button[@type='submit' and contains(., 'Obtener Factura')]"),
+    (By.XPATH, "//button[contains(text(), 'Obtener Factura')]"),
+)
+
+
+# The folio check the portal runs before asking for fiscal data; on its own
+# it is the preflight flow
+VALIDATION_STEPS = (
+    Navigate(),
+    FillBatch('first_section', ('folio_factura', 'caja', 'fecha_compra', 'ticket')),
+    ClickFirstMatch('validar_folio', VALIDAR_FOLIO_CANDIDATES, timeout=20,
+                    clicks=('actions', 'events', 'js')),
+    AwaitCondition('validation', VALIDATION_RESULT, timeout=20),
+)
+
+
+@register
+class GuadalajaraAdapter(PortalAdapter):
+    """Farmacias Guadalajara: Angular Material SPA, the portal issues a ZIP"""
+
+    servicio = 'farmaciaguadalajara'
+    url = PORTAL_URLS['farmaciaguadalajara']
+
+    actions = ('facturar',)
+    flows = {
+        PREFLIGHT: VALIDATION_STEPS,
+        'facturar': VALIDATION_STEPS + (
+            ClickFirstMatch('popup', TERMS_CONFIRM_CANDIDATES),
+            AwaitCondition('popup_closed', SWAL_CLOSED),
+            FillBatch('second_section', ('rfc', 'codigo_postal', 'razon_social', 'regimen_fiscal', 'uso_cfdi')),
+            FillBatch('email_opt_in', ('email_checkbox',), values={'email_checkbox': True}, when=wants_email),
+            FillBatch('email', ('email', 'email_confirm'), when=wants_email),
+            ClickFirstMatch('dismiss_popups', SWAL_DISMISS_CANDIDATES, timeout=0, optional=True),
+            ClickFirstMatch('obtener_factura', OBTENER_FACTURA_CANDIDATES, text='obtener factura',
+                            clicks=('events', 'actions', 'native'), issues=True),
+            ClickFirstMatch('confirmation', SWAL_CONFIRM_CANDIDATES, timeout=30,
+                            clicks=('js', 'actions', 'native', 'events')),
+            AwaitCondition('confirmation_closed', SWAL_CLOSED),
+            CaptureDownload(),
+        ),
+    }
+
+    required_fields = {
+        'facturar': (
+            'folio_factura', 'caja', 'fecha_compra', 'ticket',
+            'rfc', 'codigo_postal', 'razon_social', 'regimen_fiscal', 'uso_cfdi',
+        ),
+    }
+
+    preflight_fields = ('folio_factura', 'caja', 'fecha_compra', 'ticket')
+
+    landing_fields = ('folio_factura',)
+
+    selectors = {
+        'folio_factura': 'folioFactura',
+        'caja': 'caja',
+        'fecha_compra': 'fechaCompra',
+        'ticket': 'ticket',
+        'rfc': 'rfc',
+        'codigo_postal': 'codigoPostal',
+        'razon_social': 'razonSocial',
+        'regimen_fiscal': 'regimenFiscal',
+        'uso_cfdi': 'usoCfdi',
+        'email_checkbox': 'envioCorreo-input',
+        'email': 'correo',
+        'email_confirm': 'correoConfirm',
+        'politicas': 'politicasPr-input',
+    }
+
+    artifacts = ('zip',)
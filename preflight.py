@@ -0,0 +1,83 @@
+import time
+import hashlib
+import logging
+import threading
+
+from settings import PREFLIGHT_CACHE_TTL, PREFLIGHT_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Ticket preflight results.
+#
+# A portal with a `preflight` flow (Guadalajara's folio check) can tell
+# whether folio, caja, fecha and ticket are valid before any fiscal data is
+# typed. Outcomes of that check - from POST /validate-ticket or from a full
+# job that failed at it - are kept for a short TTL, so a bad ticket is
+# turned away without a browser until the entry expires.
+
+
+class PreflightCache:
+    """Short-lived verdicts on the ticket fields of a portal"""
+
+    def __init__(self, ttl=PREFLIGHT_CACHE_TTL, max_entries=PREFLIGHT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.rejected = 0
+
+    def key(self, adapter_cls, data):
+        """Entry key for the request's ticket fields, or None if the portal has no preflight"""
+        if not adapter_cls.preflight_fields:
+            return None
+        fields = "\x1f".join(str(data.get(field, '')).strip().upper() for field in adapter_cls.preflight_fields)
+        return adapter_cls.servicio, hashlib.sha256(fields.encode()).hexdigest()
+
+    def get(self, adapter_cls, data):
+        """{"valid": bool, "message": str|None, "retryable": bool, "checked_at": float} while fresh, else None"""
+        key = self.key(adapter_cls, data)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry["_at"] > self.ttl:
+                del self._entries[key]
+                return None
+            self.hits += 1
+            if not entry["valid"]:
+                self.rejected += 1
+            return {k: v for k, v in entry.items() if not k.startswith('_')}
+
+    def record(self, adapter_cls, data, valid, message=None, retryable=False):
+        """Keep a verdict; `retryable` marks tickets the portal does not know yet"""
+        key = self.key(adapter_cls, data)
+        if key is None:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._prune()
+            self._entries[key] = {
+                "valid": valid, "message": message, "retryable": retryable,
+                "checked_at": time.time(), "_at": time.monotonic(),
+            }
+        logger.info("Preflight %s for %s: %s", "passed" if valid else "rejected", adapter_cls.servicio, message or "ok")
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [k for k, entry in self._entries.items() if now - entry["_at"] > self.ttl]:
+            del self._entries[key]
+        # Still full: drop the oldest entries
+        excess = len(self._entries) - self.max_entries + 1
+        if excess > 0:
+            for key in sorted(self._entries, key=lambda k: self._entries[k]["_at"])[:excess]:
+                del self._entries[key]
+
+    def status(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "rejected": self.rejected}
+
+
+preflight_cache = PreflightCache()
@@ -0,0 +1,210 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+import subprocess
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+
+import portals
+from browser_tracker import browser_tracker
+from settings import (
+    PROFILE_TEMPLATE_ENABLED, BROWSER_PROFILES_DIR, PROFILE_TEMPLATE_REFRESH, PROFILE_TEMPLATE_SETTLE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Warm Chrome profile template.
+#
+# A fresh Chrome profile has an empty HTTP cache, so every new driver
+# downloads the Guadalajara Angular bundles and the Ahorro page's scripts,
+# styles and fonts again before its first paint. A background thread loads
+# each enabled portal once in a throwaway profile, keeps only its HTTP and
+# code caches as a read-only template version, and repeats that
+# periodically. Every driver launch gets its own copy of the current
+# version (a reflink, i.e. copy-on-write, where the filesystem supports it),
+# deleted when the driver quits: cookies, storage and history are never in
+# the template and nothing written by one session reaches another.
+
+# What is kept from the warmed profile
+KEEP = ('Default/Cache', 'Default/Code Cache')
+
+# Older template versions are kept this long for copies still reading them
+VERSIONS_KEPT = 2
+
+
+def copy_tree(source, target):
+    """Copy-on-write clone where the filesystem supports reflinks, a plain copy elsewhere"""
+    try:
+        subprocess.run(['cp', '-a', '--reflink=auto', str(source), str(target)],
+                       check=True, capture_output=True, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.copytree(source, target, symlinks=True)
+
+
+def tree_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+class ProfileTemplate:
+    """Versioned profile template and the per-driver copies made from it"""
+
+    def __init__(self, directory=BROWSER_PROFILES_DIR, enabled=PROFILE_TEMPLATE_ENABLED,
+                 refresh=PROFILE_TEMPLATE_REFRESH, settle=PROFILE_TEMPLATE_SETTLE):
+        self.directory = Path(directory)
+        self.versions = self.directory / 'template'
+        self.sessions = self.directory / 'sessions'
+        self.enabled = enabled
+        self.refresh = refresh
+        self.settle = settle
+        self._thread = None
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.build_seconds = None
+        self.last_error = None
+
+    def current(self):
+        """Directory of the current template version, or None before the first build"""
+        try:
+            path = (self.versions / 'current').resolve(strict=True)
+        except (OSError, RuntimeError):
+            return None
+        return path if path.is_dir() else None
+
+    # -- per-driver copies --
+
+    def checkout(self):
+        """A private copy of the template for one Chrome; None (Chrome's own empty profile) without one"""
+        if not self.enabled:
+            return None
+        template = self.current()
+        if template is None:
+            return None
+        # Named after the owning process so copies of killed workers can be swept
+        path = self.sessions / f"{os.getpid()}-{uuid.uuid4().hex}"
+        try:
+            self.sessions.mkdir(parents=True, exist_ok=True)
+            copy_tree(template, path)
+        except Exception as e:
+            logger.warning("Could not copy the profile template, starting with an empty profile: %s", str(e))
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        return path
+
+    def discard(self, driver):
+        """Delete the profile copy of a driver that has quit"""
+        path = getattr(driver, 'profile_dir', None)
+        if path:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def sweep(self):
+        """Delete copies left behind by processes that died"""
+        if not self.sessions.exists():
+            return
+        for path in self.sessions.iterdir():
+            pid = path.name.split('-', 1)[0]
+            if not pid.isdigit() or self._alive(int(pid)):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    # -- template builds --
+
+    def start(self):
+        """Build the template and keep it fresh; runs in the web process only"""
+        if not self.enabled or multiprocessing.parent_process() is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="profile-template", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+                self.build()
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error("Profile template build failed: %s", str(e))
+            time.sleep(self.refresh)
+
+    def build(self):
+        """Load every enabled portal in a scratch profile and publish its caches as a new version"""
+        from service_store import ServiceStore
+
+        started = time.time()
+        self.versions.mkdir(parents=True, exist_ok=True)
+        scratch = self.versions / f"building-{os.getpid()}-{uuid.uuid4().hex}"
+        try:
+            # Fulfilled requests never reach Chrome's HTTP cache, so the asset cache stays out of the build
+            driver = ServiceStore.setup_stealth_driver(user_data_dir=scratch, intercept=False)
+            try:
+                for adapter in portals.enabled_adapters():
+                    # get() returns after the load event; lazy chunks and fonts follow shortly
+                    driver.get(adapter.url)
+                    time.sleep(self.settle)
+            finally:
+                driver.quit()
+                browser_tracker.unregister(driver)
+
+            version = self.versions / f"v{int(started)}-{uuid.uuid4().hex[:8]}"
+            version.mkdir()
+            for relative in KEEP:
+                source = scratch / relative
+                if source.exists():
+                    (version / relative).parent.mkdir(parents=True, exist_ok=True)
+                    source.rename(version / relative)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        # Switch the pointer atomically; copies in progress keep reading the old version
+        link = self.versions / f"current-{uuid.uuid4().hex}"
+        os.symlink(version.name, link)
+        os.replace(link, self.versions / 'current')
+        self._prune(version)
+
+        self.builds += 1
+        self.build_seconds = round(time.time() - started, 1)
+        self.last_error = None
+        logger.info("Profile template %s built in %.1fs (%.1f MB)",
+                    version.name, self.build_seconds, tree_size(version) / (1024 * 1024))
+
+    def _prune(self, latest):
+        versions = sorted((p for p in self.versions.iterdir() if p.name.startswith('v') and p.is_dir()),
+                          key=lambda p: p.stat().st_mtime, reverse=True)
+        for path in versions[VERSIONS_KEPT:]:
+            if path != latest:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def status(self):
+        template = self.current()
+        built_at = template.stat().st_mtime if template else None
+        return {
+            "enabled": self.enabled,
+            "version": template.name if template else None,
+            "built_at": datetime.fromtimestamp(built_at).isoformat() if built_at else None,
+            "age_seconds": round(time.time() - built_at) if built_at else None,
+            "size_mb": round(tree_size(template) / (1024 * 1024), 1) if template else None,
+            "builds": self.builds,
+            "build_seconds": self.build_seconds,
+            "sessions": sum(1 for _ in self.sessions.iterdir()) if self.sessions.exists() else 0,
+            "last_error": self.last_error,
+        }
+
+
+profile_template = ProfileTemplate()
@@ -0,0 +1,373 @@
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import ipaddress
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from pathlib import Path
+from urllib.parse import urlparse
+
+import portals
+from archive import invoice_archive
+from janitor import janitor
+from jobs import JobCancelled, job_registry
+from journal import TRANSIENT_FIELDS, DESCARGAR, ticket_key, job_journal
+from log_config import job_context
+from scheduler import RETRY, DEFAULT_TENANT
+from settings import (
+    RETRY_DB, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_MAX_AGE,
+    RETRY_OFF_PEAK_HOURS, RETRY_POLL_INTERVAL, RETRY_WEBHOOK_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Deferred retries.
+#
+# Tickets bought the same day are often not in the portal's invoicing
+# system yet. A job refused with TicketNotYetAvailable is not answered with
+# an error the client has to retry blindly: the request goes into an SQLite
+# delayed queue and is re-run with exponential backoff, in off-peak hours
+# and only while no other job is running, until it succeeds or reaches
+# RETRY_MAX_AGE. The outcome is kept at /retries/<id> and, when the request
+# gave a webhook_url, POSTed there.
+
+#
+# Jobs the job journal finds cut off after issuing an invoice (see
+# journal.py) are queued here too, as a download due right away.
+
+# A claim older than this belongs to a process that died mid-attempt
+STALE_CLAIM = 900
+
+
+class InvalidWebhook(ValueError):
+    """A webhook_url that is not an http(s) URL of a public host"""
+
+
+def check_webhook_url(url):
+    """
+    Refuse webhook URLs that would make us POST into our own network: the
+    host must resolve, and only to public addresses (no loopback, private,
+    link-local or cloud metadata ones).
+    """
+    parsed = urlparse(str(url))
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise InvalidWebhook("webhook_url must be an http(s) URL")
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port, proto=socket.IPPROTO_TCP)
+    except (OSError, ValueError, UnicodeError):
+        raise InvalidWebhook(f"webhook_url host {parsed.hostname} cannot be resolved") from None
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        address = getattr(address, 'ipv4_mapped', None) or address
+        if not address.is_global or address.is_multicast:
+            raise InvalidWebhook(f"webhook_url host {parsed.hostname} is not a public address")
+
+
+def parse_hours(spec):
+    """(start, end) hours from "22-7", or None for any hour"""
+    if not spec or not spec.strip():
+        return None
+    start, end = (int(part) % 24 for part in spec.split('-', 1))
+    return start, end
+
+
+class RetryScheduler:
+    """Persistent delayed queue of requests waiting for their ticket to reach the portal"""
+
+    def __init__(self, path=RETRY_DB, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 max_age=RETRY_MAX_AGE, off_peak=RETRY_OFF_PEAK_HOURS, poll_interval=RETRY_POLL_INTERVAL):
+        self.path = Path(path)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+        self.off_peak = parse_hours(off_peak)
+        self.poll_interval = poll_interval
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._runner = None
+        self.attempts = 0
+        self.completed = 0
+
+    def _db(self):
+        # Opened on first use so importing this module stays free of disk access
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS retries (
+                    retry_id TEXT PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    servicio TEXT NOT NULL,
+                    accion TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    webhook_url TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    last_error TEXT,
+                    job_id TEXT,
+                    invoice_id TEXT
+                );
+                CREATE INDEX IF NOT EXISTS retries_due ON retries (status, next_at);
+                CREATE INDEX IF NOT EXISTS retries_key ON retries (key, status);
+            """)
+        return self._conn
+
+    # -- timing --
+
+    def _off_peak_from(self, at):
+        """The first moment at or after `at` inside the off-peak window"""
+        if self.off_peak is None:
+            return at
+        start, end = self.off_peak
+        moment = datetime.fromtimestamp(at)
+        hour = moment.hour
+        inside = start <= hour < end if start < end else hour >= start or hour < end
+        if inside:
+            return at
+        opening = moment.replace(hour=start, minute=0, second=0, microsecond=0)
+        if opening < moment:
+            opening += timedelta(days=1)
+        return opening.timestamp()
+
+    def next_attempt(self, attempts, now=None):
+        """When attempt number attempts + 1 runs: exponential backoff, then the off-peak window"""
+        now = time.time() if now is None else now
+        delay = min(self.base_delay * 2 ** attempts, self.max_delay)
+        return self._off_peak_from(now + delay)
+
+    # -- queue --
+
+    def key(self, servicio, data):
+        # A second request for the same ticket joins the retry already scheduled for it
+        return ticket_key(servicio, data)
+
+    def schedule(self, servicio, accion, data, error, webhook_url=None, at=None):
+        """Queue the request for a later attempt (at `at`, default after backoff); returns the (possibly existing) retry"""
+        key = self.key(servicio, data)
+        existing = self.pending(servicio, data)
+        if existing:
+            if webhook_url and not existing["webhook_url"]:
+                with self._lock:
+                    self._db().execute("UPDATE retries SET webhook_url = ? WHERE retry_id = ?",
+                                       (webhook_url, existing["retry_id"]))
+            return self.get(existing["retry_id"])
+
+        now = time.time()
+        record = {
+            "retry_id": uuid.uuid4().hex,
+            "key": key,
+            "servicio": servicio,
+            "accion": accion,
+            "data": json.dumps({k: v for k, v in data.items() if k not in TRANSIENT_FIELDS}),
+            "webhook_url": webhook_url,
+            "status": "scheduled",
+            "next_at": self.next_attempt(0, now) if at is None else at,
+            "expires_at": now + self.max_age,
+            "created_at": now,
+            "updated_at": now,
+            "last_error": error,
+        }
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO retries (retry_id, key, servicio, accion, data, webhook_url, status, next_at, "
+                "expires_at, created_at, updated_at, last_error) VALUES (:retry_id, :key, :servicio, :accion, "
+                ":data, :webhook_url, :status, :next_at, :expires_at, :created_at, :updated_at, :last_error)",
+                record,
+            )
+        logger.info("Scheduled retry %s for %s, first attempt at %s", record["retry_id"], servicio,
+                    datetime.fromtimestamp(record["next_at"]).isoformat(timespec='minutes'))
+        self._wakeup.set()
+        return self.get(record["retry_id"])
+
+    def pending(self, servicio, data):
+        """The scheduled or running retry for the same ticket, or None"""
+        with self._lock:
+            row = self._db().execute(
+                "SELECT * FROM retries WHERE key = ? AND status IN ('scheduled', 'running') LIMIT 1",
+                (self.key(servicio, data),),
+            ).fetchone()
+        return self._public(row)
+
+    def get(self, retry_id):
+        with self._lock:
+            row = self._db().execute("SELECT * FROM retries WHERE retry_id = ?", (retry_id,)).fetchone()
+        return self._public(row)
+
+    def _public(self, row):
+        # The stored request holds fiscal data; only its ticket is shown
+        if row is None:
+            return None
+        record = {k: row[k] for k in row.keys() if k not in ('key', 'data')}
+        record["ticket"] = json.loads(row["data"]).get('ticket')
+        for field in ('next_at', 'expires_at', 'created_at', 'updated_at'):
+            record[field] = datetime.fromtimestamp(row[field]).isoformat()
+        record["invoice"] = f"/invoices/{row['invoice_id']}" if row["invoice_id"] else None
+        return record
+
+    def _claim_due(self):
+        """Mark the most overdue retry as running; returns its row, or None"""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("UPDATE retries SET status = 'scheduled' WHERE status = 'running' AND updated_at < ?",
+                       (now - STALE_CLAIM,))
+            row = db.execute(
+                "SELECT * FROM retries WHERE status = 'scheduled' AND next_at <= ? ORDER BY next_at LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            # Another web process may claim the same row; only one UPDATE wins
+            claimed = db.execute(
+                "UPDATE retries SET status = 'running', updated_at = ? WHERE retry_id = ? AND status = 'scheduled'",
+                (now, row["retry_id"]),
+            ).rowcount
+        return row if claimed else None
+
+    def _update(self, retry_id, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{field} = :{field}" for field in fields)
+        with self._lock:
+            self._db().execute(f"UPDATE retries SET {assignments} WHERE retry_id = :retry_id",
+                               dict(fields, retry_id=retry_id))
+
+    # -- running --
+
+    def start(self, runner):
+        """Run due retries in the background with runner(job, data) -> invoice ZIP path"""
+        if multiprocessing.parent_process() is not None:
+            # Worker processes re-import app.py; retries run in the web process
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._runner = runner
+            self._thread = threading.Thread(target=self._run, name="retries", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self._recover()
+                # Interactive requests keep the browsers; retries wait for a quiet moment
+                while job_registry.active() == 0:
+                    row = self._claim_due()
+                    if row is None:
+                        break
+                    self._attempt(row)
+            except Exception as e:
+                logger.error("Retry scheduler failed: %s", str(e))
+
+    def _recover(self):
+        """Queue downloads for invoices issued by jobs a restart cut off"""
+        for job in job_journal.interrupted():
+            servicio = job["servicio"]
+            try:
+                actions = portals.get_adapter(servicio).actions
+            except portals.UnknownPortal:
+                continue
+            if DESCARGAR not in actions:
+                logger.warning("Job %s may have issued an invoice on %s before it stopped (after %s); "
+                               "the portal has no download path", job["job_id"], servicio, job["last_step"])
+                continue
+            retry = self.schedule(servicio, DESCARGAR, job["data"],
+                                  f"Job {job['job_id']} stopped after {job['last_step']}", at=time.time())
+            logger.warning("Job %s stopped after issuing on %s; downloading the invoice as retry %s",
+                           job["job_id"], servicio, retry["retry_id"])
+
+    def _attempt(self, row):
+        retry_id, servicio, accion = row["retry_id"], row["servicio"], row["accion"]
+        data = json.loads(row["data"])
+        attempts = row["attempts"] + 1
+        self.attempts += 1
+        job = job_registry.create(servicio=servicio, accion=accion, timeout=portals.get_adapter(servicio).timeout,
+                                  lane=RETRY, tenant=str(data.get('tenant') or DEFAULT_TENANT))
+        self._update(retry_id, job_id=job.id, attempts=attempts)
+        logger.info("Retry %s: attempt %s as job %s", retry_id, attempts, job.id)
+
+        try:
+            with job_context(job.id, servicio):
+                zip_path = self._runner(job, data)
+                try:
+                    invoice = invoice_archive.store(zip_path, data, servicio, job.id, metadata=job.cfdi)
+                finally:
+                    janitor.release_job(zip_path.parent)
+        except portals.TicketNotYetAvailable as e:
+            job_registry.finish(job, "failed", str(e))
+            self._reschedule(row, attempts, str(e))
+            return
+        except portals.PortalRejected as e:
+            # The ticket is there now, but the portal refuses the data
+            job_registry.finish(job, "failed", str(e))
+            self._update(retry_id, status="failed", last_error=str(e))
+            self.notify(retry_id, "retry.failed")
+            return
+        except (Exception, JobCancelled) as e:
+            error = e.reason if isinstance(e, JobCancelled) else str(e)
+            job_registry.finish(job, "cancelled" if isinstance(e, JobCancelled) else "failed", error)
+            logger.error("Retry %s: attempt %s failed: %s", retry_id, attempts, error)
+            self._reschedule(row, attempts, error)
+            return
+
+        job_registry.finish(job, "completed")
+        self.completed += 1
+        self._update(retry_id, status="completed", last_error=None, invoice_id=invoice["invoice_id"])
+        logger.info("Retry %s: invoice %s issued after %s attempts", retry_id, invoice["invoice_id"], attempts)
+        self.notify(retry_id, "invoice.completed", cfdi=job.cfdi)
+
+    def _reschedule(self, row, attempts, error):
+        next_at = self.next_attempt(attempts)
+        if next_at > row["expires_at"]:
+            self._update(row["retry_id"], status="expired", last_error=error)
+            logger.warning("Retry %s expired after %s attempts: %s", row["retry_id"], attempts, error)
+            self.notify(row["retry_id"], "retry.expired")
+            return
+        self._update(row["retry_id"], status="scheduled", next_at=next_at, last_error=error)
+
+    def notify(self, retry_id, event, cfdi=None):
+        """POST the outcome to the request's webhook_url, if it gave one"""
+        retry = self.get(retry_id)
+        if not retry or not retry["webhook_url"]:
+            return
+        try:
+            # Checked again: the name may resolve elsewhere by now
+            check_webhook_url(retry["webhook_url"])
+        except InvalidWebhook as e:
+            logger.error("Webhook for retry %s refused: %s", retry_id, str(e))
+            return
+        import requests
+
+        payload = {"event": event, "retry": retry, "cfdi": cfdi}
+        try:
+            # Redirects are not followed; they could lead to an internal address
+            response = requests.post(retry["webhook_url"], json=payload, timeout=RETRY_WEBHOOK_TIMEOUT,
+                                     allow_redirects=False)
+            logger.info("Webhook for retry %s answered %s", retry_id, response.status_code)
+        except Exception as e:
+            logger.error("Webhook for retry %s failed: %s", retry_id, str(e))
+
+    def status(self):
+        with self._lock:
+            rows = self._db().execute("SELECT status, COUNT(*) FROM retries GROUP BY status").fetchall()
+        return {
+            "by_status": {status: count for status, count in rows},
+            "attempts": self.attempts,
+            "completed": self.completed,
+            "off_peak_hours": "%d-%d" % self.off_peak if self.off_peak else None,
+        }
+
+
+retry_scheduler = RetryScheduler()
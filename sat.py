@@ -0,0 +1,303 @@
+import re
+import sys
+import json
+import logging
+import threading
+from datetime import datetime
+
+from settings import SAT_CATALOG_PATH, CATALOG_CAPTURES_DIR
+
+logger = logging.getLogger(__name__)
+
+# SAT catalogs used to check fiscal data before a browser is spent on it.
+#
+# Subsets of the CFDI 4.0 catalogs c_RegimenFiscal and c_UsoCFDI: which
+# taxpayer types (física / moral) may use each code, and which régimen
+# fiscal each uso CFDI is allowed with. A portal rejects these combinations
+# anyway, but only after the whole form has been filled.
+#
+# Portals do not necessarily use the SAT codes as <option> values, nor
+# offer every code. sat_catalog.json maps each SAT code to the option value
+# of every portal; it is rebuilt offline (`python sat.py refresh`) from the
+# option lists the flows capture while filling the selects. CatalogIndex
+# flattens both into sets and dicts once, so a request is checked with a
+# handful of hash lookups.
+
+CATALOG_VERSION = 'CFDI-4.0'
+
+FISICA = 'fisica'
+MORAL = 'moral'
+
+# c_RegimenFiscal: code -> (description, taxpayer types)
+REGIMENES = {
+    '601': ("General de Ley Personas Morales", {MORAL}),
+    '603': ("Personas Morales con Fines no Lucrativos", {MORAL}),
+    '605': ("Sueldos y Salarios e Ingresos Asimilados a Salarios", {FISICA}),
+    '606': ("Arrendamiento", {FISICA}),
+    '607': ("Régimen de Enajenación o Adquisición de Bienes", {FISICA}),
+    '608': ("Demás ingresos", {FISICA}),
+    '610': ("Residentes en el Extranjero sin Establecimiento Permanente en México", {FISICA, MORAL}),
+    '611': ("Ingresos por Dividendos (socios y accionistas)", {FISICA}),
+    '612': ("Personas Físicas con Actividades Empresariales y Profesionales", {FISICA}),
+    '614': ("Ingresos por intereses", {FISICA}),
+    '615': ("Régimen de los ingresos por obtención de premios", {FISICA}),
+    '616': ("Sin obligaciones fiscales", {FISICA}),
+    '620': ("Sociedades Cooperativas de Producción que optan por diferir sus ingresos", {MORAL}),
+    '621': ("Incorporación Fiscal", {FISICA}),
+    '622': ("Actividades Agrícolas, Ganaderas, Silvícolas y Pesqueras", {MORAL}),
+    '623': ("Opcional para Grupos de Sociedades", {MORAL}),
+    '624': ("Coordinados", {MORAL}),
+    '625': ("Régimen de las Actividades Empresariales con ingresos a través de Plataformas Tecnológicas", {FISICA}),
+    '626': ("Régimen Simplificado de Confianza", {FISICA, MORAL}),
+}
+
+_BUSINESS = frozenset({'601', '603', '606', '612', '620', '621', '622', '623', '624', '625', '626'})
+_DEDUCTIONS = frozenset({'605', '606', '607', '608', '611', '612', '614', '615', '625'})
+_ANY = frozenset({
+    '601', '603', '605', '606', '607', '608', '610', '611', '612', '614', '615', '616',
+    '620', '621', '622', '623', '624', '625', '626',
+})
+
+# c_UsoCFDI: code -> (description, taxpayer types, allowed régimen fiscal codes)
+USOS = {
+    'G01': ("Adquisición de mercancías", {FISICA, MORAL}, _BUSINESS),
+    'G02': ("Devoluciones, descuentos o bonificaciones", {FISICA, MORAL}, _BUSINESS),
+    'G03': ("Gastos en general", {FISICA, MORAL}, _BUSINESS),
+    'I01': ("Construcciones", {FISICA, MORAL}, _BUSINESS),
+    'I02': ("Mobiliario y equipo de oficina por inversiones", {FISICA, MORAL}, _BUSINESS),
+    'I03': ("Equipo de transporte", {FISICA, MORAL}, _BUSINESS),
+    'I04': ("Equipo de computo y accesorios", {FISICA, MORAL}, _BUSINESS),
+    'I05': ("Dados, troqueles, moldes, matrices y herramental", {FISICA, MORAL}, _BUSINESS),
+    'I06': ("Comunicaciones telefónicas", {FISICA, MORAL}, _BUSINESS),
+    'I07': ("Comunicaciones satelitales", {FISICA, MORAL}, _BUSINESS),
+    'I08': ("Otra maquinaria y equipo", {FISICA, MORAL}, _BUSINESS),
+    'D01': ("Honorarios médicos, dentales y gastos hospitalarios", {FISICA}, _DEDUCTIONS),
+    'D02': ("Gastos médicos por incapacidad o discapacidad", {FISICA}, _DEDUCTIONS),
+    'D03': ("Gastos funerales", {FISICA}, _DEDUCTIONS),
+    'D04': ("Donativos", {FISICA}, _DEDUCTIONS),
+    'D05': ("Intereses reales efectivamente pagados por créditos hipotecarios (casa habitación)", {FISICA}, _DEDUCTIONS),
+    'D06': ("Aportaciones voluntarias al SAR", {FISICA}, _DEDUCTIONS),
+    'D07': ("Primas por seguros de gastos médicos", {FISICA}, _DEDUCTIONS),
+    'D08': ("Gastos de transportación escolar obligatoria", {FISICA}, _DEDUCTIONS),
+    'D09': ("Depósitos en cuentas para el ahorro, primas que tengan como base planes de pensiones", {FISICA}, _DEDUCTIONS),
+    'D10': ("Pagos por servicios educativos (colegiaturas)", {FISICA}, _DEDUCTIONS),
+    'S01': ("Sin efectos fiscales", {FISICA, MORAL}, _ANY),
+    'CP01': ("Pagos", {FISICA, MORAL}, _ANY),
+    'CN01': ("Nómina", {FISICA}, frozenset({'605'})),
+}
+
+# Generic RFCs: público en general and residentes en el extranjero
+GENERIC_RFCS = ('XAXX010101000', 'XEXX010101000')
+
+RFC_PATTERN = re.compile(r'^([A-ZÑ&]{3,4})(\d{2})(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])([A-Z\d]{2}[A\d])$')
+CODIGO_POSTAL_PATTERN = re.compile(r'^\d{5}$')
+
+
+def normalize_rfc(rfc):
+    return (rfc or '').strip().upper()
+
+
+def taxpayer_type(rfc):
+    """'moral' for 12-character RFCs, 'fisica' for 13, None when malformed"""
+    match = RFC_PATTERN.match(normalize_rfc(rfc))
+    if not match:
+        return None
+    return MORAL if len(match.group(1)) == 3 else FISICA
+
+
+# Request fields backed by a SAT catalog, and their <select> option values per portal
+CATALOG_FIELDS = ('regimen_fiscal', 'uso_cfdi')
+
+OPTION_CODE_PATTERN = re.compile(r'^\s*([A-Z]{1,2}\d{2}|\d{3})\b')
+
+
+class CatalogIndex:
+    """SAT catalogs and portal option maps flattened for O(1) checks"""
+
+    def __init__(self, portals=None, version=None):
+        self.version = version
+        self.regimen_kinds = {code: frozenset(kinds) for code, (_, kinds) in REGIMENES.items()}
+        self.uso_kinds = {code: frozenset(kinds) for code, (_, kinds, _) in USOS.items()}
+        self.allowed = frozenset(
+            (regimen, uso) for uso, (_, _, regimenes) in USOS.items() for regimen in regimenes
+        )
+        # servicio -> field -> SAT code -> option value; fields without a
+        # captured option list fall back to the SAT code itself
+        self.portals = {
+            servicio: {field: dict(options) for field, options in fields.items() if options}
+            for servicio, fields in (portals or {}).items()
+        }
+
+    def option_value(self, servicio, field, code):
+        """Value of the portal's <option> for a SAT code (None if the portal does not offer it)"""
+        options = self.portals.get(servicio, {}).get(field)
+        if options is None:
+            return code
+        return options.get(code)
+
+    def validate(self, data, servicio=None):
+        """
+        Errors in the fiscal fields present in `data` (rfc, codigo_postal,
+        regimen_fiscal, uso_cfdi), including codes the portal does not
+        offer when `servicio` is given; an empty list means they are
+        consistent. Absent fields are not checked, that is missing_fields' job.
+        """
+        errors = []
+        kind = rfc = None
+        if 'rfc' in data:
+            rfc = normalize_rfc(data['rfc'])
+            kind = taxpayer_type(rfc)
+            if kind is None:
+                errors.append(f"Invalid RFC format: {data['rfc']}")
+            elif rfc in GENERIC_RFCS:
+                kind = None
+
+        if 'codigo_postal' in data and not CODIGO_POSTAL_PATTERN.match(str(data['codigo_postal']).strip()):
+            errors.append(f"Invalid codigo_postal: {data['codigo_postal']}")
+
+        regimen = str(data['regimen_fiscal']).strip() if 'regimen_fiscal' in data else None
+        if regimen is not None:
+            kinds = self.regimen_kinds.get(regimen)
+            if kinds is None:
+                errors.append(f"Unknown regimen_fiscal: {regimen}")
+                regimen = None
+            elif kind and kind not in kinds:
+                errors.append(f"regimen_fiscal {regimen} does not apply to a persona {kind}")
+
+        uso = str(data['uso_cfdi']).strip().upper() if 'uso_cfdi' in data else None
+        if uso is not None:
+            kinds = self.uso_kinds.get(uso)
+            if kinds is None:
+                errors.append(f"Unknown uso_cfdi: {uso}")
+                uso = None
+            else:
+                if kind and kind not in kinds:
+                    errors.append(f"uso_cfdi {uso} does not apply to a persona {kind}")
+                if regimen and (regimen, uso) not in self.allowed:
+                    errors.append(f"uso_cfdi {uso} is not allowed with regimen_fiscal {regimen}")
+
+        if servicio:
+            for field, code in (('regimen_fiscal', regimen), ('uso_cfdi', uso)):
+                if code and self.option_value(servicio, field, code) is None:
+                    errors.append(f"{servicio} does not offer {field} {code}")
+
+        return errors
+
+    def status(self):
+        return {
+            "version": self.version,
+            "catalog": CATALOG_VERSION,
+            "portals": {
+                servicio: {field: len(options) for field, options in fields.items()}
+                for servicio, fields in self.portals.items()
+            },
+        }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def load_index(path=SAT_CATALOG_PATH):
+    """Build the index from the catalog file; a missing or broken file leaves the SAT codes as option values"""
+    global _index
+    try:
+        with open(path) as f:
+            catalog = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not read SAT catalog %s: %s", path, str(e))
+        catalog = {}
+    index = CatalogIndex(catalog.get('portals'), catalog.get('version'))
+    with _index_lock:
+        _index = index
+    logger.info("SAT catalog index %s loaded", index.version)
+    return index
+
+
+def catalog_index():
+    """The process-wide index, loaded on first use"""
+    return _index or load_index()
+
+
+def validate_fiscal(data, servicio=None):
+    return catalog_index().validate(data, servicio)
+
+
+# -- option list capture and offline refresh --
+
+_captured = {}
+
+
+def record_options(servicio, field, options):
+    """Keep the option list a flow saw on a portal select for the next refresh"""
+    options = [list(option) for option in options]
+    key = (servicio, field)
+    if _captured.get(key) == options:
+        return
+    _captured[key] = options
+    try:
+        CATALOG_CAPTURES_DIR.mkdir(parents=True, exist_ok=True)
+        path = CATALOG_CAPTURES_DIR / f"{servicio}.{field}.json"
+        path.write_text(json.dumps({
+            "servicio": servicio,
+            "field": field,
+            "captured_at": datetime.now().isoformat(),
+            "options": options,
+        }))
+    except OSError as e:
+        logger.warning("Could not save captured options for %s %s: %s", servicio, field, str(e))
+
+
+def option_code(value, text, catalog):
+    """SAT code an <option> stands for, from its value or its label ("601 - General de Ley...")"""
+    for candidate in (value, text):
+        candidate = (candidate or '').strip().upper()
+        if candidate in catalog:
+            return candidate
+        match = OPTION_CODE_PATTERN.match(candidate)
+        if match and match.group(1) in catalog:
+            return match.group(1)
+    return None
+
+
+def refresh(captures_dir=CATALOG_CAPTURES_DIR, path=SAT_CATALOG_PATH):
+    """Rebuild the catalog file from captured option lists; returns the new catalog"""
+    catalogs = {'regimen_fiscal': REGIMENES, 'uso_cfdi': USOS}
+    try:
+        with open(path) as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        catalog = {}
+    portals = catalog.get('portals', {})
+
+    for capture_path in sorted(captures_dir.glob('*.json')):
+        capture = json.loads(capture_path.read_text())
+        if capture['field'] not in catalogs:
+            continue
+        options = {}
+        for value, text in capture['options']:
+            code = option_code(value, text, catalogs[capture['field']])
+            if code:
+                options[code] = value
+        portals.setdefault(capture['servicio'], {})[capture['field']] = dict(sorted(options.items()))
+
+    catalog = {
+        "version": datetime.now().strftime('%Y%m%d%H%M%S'),
+        "catalog": CATALOG_VERSION,
+        "portals": portals,
+    }
+    with open(path, 'w') as f:
+        json.dump(catalog, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    return catalog
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['refresh']:
+        sys.exit("usage: python sat.py refresh [captures_dir]")
+    from pathlib import Path
+    built = refresh(Path(sys.argv[2]) if len(sys.argv) > 2 else CATALOG_CAPTURES_DIR)
+    print(f"SAT catalog {built['version']}: " + ", ".join(
+        f"{servicio} {field}={len(options)}"
+        for servicio, fields in built['portals'].items() for field, options in fields.items()
+    ))
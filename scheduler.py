@@ -0,0 +1,315 @@
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+
+import portals
+from settings import (
+    WORKER_PROCESSES, SCHEDULER_INTERACTIVE_RESERVED, SCHEDULER_TENANT_WEIGHTS, SCHEDULER_LANE_SLA,
+    PORTAL_MAX_SESSIONS, PORTAL_RATE_PER_MINUTE, PORTAL_MIN_RATE_FRACTION, PORTAL_SLOWDOWN_FACTOR,
+    PORTAL_BACKOFF_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Job admission.
+#
+# Point-of-sale requests, month-end bulk reissues and deferred retries all
+# need one of the few browser sessions. Jobs wait here for a slot in one of
+# three lanes, served in priority order: interactive, then batch, then
+# retry. Some slots are reserved for interactive work so a batch burst can
+# never take every browser. Inside a lane, tenants are served by weighted
+# fair queuing (virtual start/finish tags per tenant, one unit of work per
+# job), and each tenant's jobs go out earliest deadline first.
+#
+# A job is only admitted while its portal is under its session cap and has
+# a token in its bucket, so parallel jobs never hammer one portal from our
+# IP. Portals that answer 429/5xx or slow down get a lower rate (and, for
+# 429, a pause) until clean jobs win it back.
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+RETRY = 'retry'
+LANES = (INTERACTIVE, BATCH, RETRY)
+
+DEFAULT_TENANT = 'default'
+
+# Recent queue waits kept per lane for the percentiles in status()
+WAIT_SAMPLES = 500
+
+
+def parse_weights(spec):
+    """{"pos": 3.0, ...} from "pos=3,backoffice=1"; malformed entries are skipped"""
+    weights = {}
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        try:
+            weights[name.strip()] = float(value)
+        except ValueError:
+            continue
+    return {name: value for name, value in weights.items() if name and value > 0}
+
+
+class PortalLimit:
+    """Token bucket and session cap for one portal, slowed down when the portal pushes back"""
+
+    def __init__(self, servicio, max_sessions, rate_per_minute, burst):
+        self.servicio = servicio
+        self.max_sessions = max_sessions
+        self.limit = rate_per_minute / 60.0
+        self.rate = self.limit
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.sessions = 0
+        self.paused_until = 0.0
+        # Consecutive jobs that saw 429s; each one doubles the pause
+        self.strikes = 0
+        # Moving average of the browser time of clean jobs, per action
+        # (a preflight takes a fraction of an issue or a download)
+        self.typical_seconds = {}
+        self.backoffs = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, now):
+        self._refill(now)
+        return self.sessions < self.max_sessions and self.tokens >= 1 and now >= self.paused_until
+
+    def start(self):
+        self.tokens -= 1
+        self.sessions += 1
+
+    def finish(self, job, now):
+        """Session over: adapt the rate to what the job saw"""
+        self.sessions -= 1
+        steps = job.steps or ()
+        if not steps:
+            return
+        errors = job.http_errors or {}
+        seconds = sum(step.get("seconds") or 0 for step in steps)
+        # Only clean jobs are timed: a failed one may have stopped early or waited out a timeout
+        clean = all(step.get("status") in ('done', 'skipped') for step in steps)
+        typical = self.typical_seconds.get(job.accion)
+        slow = clean and bool(typical) and seconds > PORTAL_SLOWDOWN_FACTOR * typical
+        self._refill(now)
+        if errors.get("429") or errors.get("5xx") or slow:
+            self.rate = max(self.limit * PORTAL_MIN_RATE_FRACTION, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self.backoffs += 1
+            if errors.get("429"):
+                self.strikes += 1
+                self.paused_until = now + PORTAL_BACKOFF_SECONDS * 2 ** min(self.strikes - 1, 5)
+            logger.warning("Backing off %s to %.1f sessions/min (429: %s, 5xx: %s, %.0fs job)",
+                           self.servicio, self.rate * 60, errors.get("429", 0), errors.get("5xx", 0), seconds)
+            return
+        self.strikes = 0
+        self.rate = min(self.limit, self.rate + self.limit * 0.1)
+        if clean:
+            self.typical_seconds[job.accion] = seconds if typical is None else 0.8 * typical + 0.2 * seconds
+
+    def status(self, now):
+        self._refill(now)
+        return {
+            "sessions": self.sessions,
+            "max_sessions": self.max_sessions,
+            "rate_per_minute": round(self.rate * 60, 2),
+            "limit_per_minute": round(self.limit * 60, 2),
+            "tokens": round(self.tokens, 2),
+            "paused_seconds": round(max(0.0, self.paused_until - now), 1),
+            "typical_job_seconds": {accion: round(seconds, 1) for accion, seconds in self.typical_seconds.items()},
+            "backoffs": self.backoffs,
+        }
+
+
+class _Waiter:
+    def __init__(self, job, seq):
+        self.job = job
+        self.lane = job.lane
+        self.tenant = job.tenant
+        self.deadline = job.token.deadline if job.token.deadline is not None else float('inf')
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class JobScheduler:
+    """Slots for browser jobs, handed out by lane priority, tenant weight and deadline"""
+
+    def __init__(self, capacity=None, reserved=SCHEDULER_INTERACTIVE_RESERVED,
+                 weights=SCHEDULER_TENANT_WEIGHTS, sla=SCHEDULER_LANE_SLA):
+        self.capacity = capacity or WORKER_PROCESSES or 1
+        # With a single slot nothing can be reserved without starving the other lanes
+        self.reserved = max(0, min(reserved, self.capacity - 1))
+        self.weights = parse_weights(weights)
+        self.sla = parse_weights(sla)
+        self._max_sessions = parse_weights(PORTAL_MAX_SESSIONS)
+        self._rates = parse_weights(PORTAL_RATE_PER_MINUTE)
+        self._limits = {}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = {lane: [] for lane in LANES}
+        self._running = {lane: 0 for lane in LANES}
+        # Fair queuing state per lane: virtual clock, each tenant's last finish
+        # tag and the (start, finish) tags of its queued jobs, in arrival order
+        self._clock = {lane: 0.0 for lane in LANES}
+        self._finish = {lane: {} for lane in LANES}
+        self._tags = {lane: {} for lane in LANES}
+        self._granted = {lane: 0 for lane in LANES}
+        self._breaches = {lane: 0 for lane in LANES}
+        self._waits = {lane: deque(maxlen=WAIT_SAMPLES) for lane in LANES}
+
+    def acquire(self, job):
+        """Block until the job gets a slot, without ignoring its cancellation"""
+        waiter = _Waiter(job, next(self._seq))
+        with self._cond:
+            self._enqueue(waiter)
+            self._dispatch()
+            try:
+                while not waiter.granted:
+                    job.status = "queued"
+                    self._cond.wait(0.5)
+                    if not waiter.granted:
+                        job.token.check()
+                        # Buckets refill and pauses end with time alone
+                        self._dispatch()
+            except BaseException:
+                if waiter.granted:
+                    self._release(job)
+                else:
+                    self._dequeue(waiter)
+                raise
+
+            waited = time.monotonic() - waiter.enqueued
+            self._waits[waiter.lane].append(waited)
+            if waited > self.sla.get(waiter.lane, float('inf')):
+                self._breaches[waiter.lane] += 1
+        logger.info("Job %s admitted to the %s lane after %.2fs in queue (tenant %s)",
+                    job.id, waiter.lane, waited, waiter.tenant)
+
+    def release(self, job):
+        with self._cond:
+            self._release(job)
+
+    def _release(self, job):
+        limit = self._limits.get(job.servicio)
+        if limit:
+            limit.finish(job, time.monotonic())
+        self._running[job.lane] -= 1
+        self._dispatch()
+
+    def _limit(self, servicio):
+        """The portal's PortalLimit, built from its adapter on first use; None for unknown portals"""
+        limit = self._limits.get(servicio)
+        if limit is None:
+            try:
+                adapter_cls = portals.get_adapter(servicio)
+            except portals.UnknownPortal:
+                return None
+            limit = self._limits[servicio] = PortalLimit(
+                servicio,
+                int(self._max_sessions.get(servicio, adapter_cls.max_sessions)),
+                self._rates.get(servicio, adapter_cls.rate_per_minute),
+                adapter_cls.burst,
+            )
+        return limit
+
+    def _enqueue(self, waiter):
+        lane, tenant = waiter.lane, waiter.tenant
+        start = max(self._clock[lane], self._finish[lane].get(tenant, 0.0))
+        finish = start + 1.0 / self.weights.get(tenant, 1.0)
+        self._finish[lane][tenant] = finish
+        self._tags[lane].setdefault(tenant, deque()).append((start, finish))
+        self._waiting[lane].append(waiter)
+
+    def _dequeue(self, waiter):
+        """Drop a cancelled waiter and give its tenant the unused tag back"""
+        lane, tenant = waiter.lane, waiter.tenant
+        self._waiting[lane].remove(waiter)
+        tags = self._tags[lane][tenant]
+        start, _ = tags.pop()
+        self._finish[lane][tenant] = start
+        if not tags:
+            del self._tags[lane][tenant]
+
+    def _dispatch(self):
+        """Grant free slots to the next waiters; called with the lock held"""
+        granted = False
+        while True:
+            waiter = self._next()
+            if waiter is None:
+                break
+            limit = self._limit(waiter.job.servicio)
+            if limit:
+                limit.start()
+            self._running[waiter.lane] += 1
+            self._granted[waiter.lane] += 1
+            waiter.granted = True
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _next(self):
+        free = self.capacity - sum(self._running.values())
+        if free <= 0:
+            return None
+        # Slots the interactive lane may still claim from its reservation
+        held_back = max(0, self.reserved - self._running[INTERACTIVE])
+        now = time.monotonic()
+        ready = {}
+        for lane in LANES:
+            # Jobs for a portal at its limit wait without blocking other portals
+            eligible = []
+            for waiter in self._waiting[lane]:
+                servicio = waiter.job.servicio
+                if servicio not in ready:
+                    limit = self._limit(servicio)
+                    ready[servicio] = limit is None or limit.ready(now)
+                if ready[servicio]:
+                    eligible.append(waiter)
+            if not eligible:
+                continue
+            if lane != INTERACTIVE and free <= held_back:
+                return None
+            return self._pick(lane, eligible)
+        return None
+
+    def _pick(self, lane, eligible):
+        """Weighted fair choice among the lane's tenants; earliest deadline within a tenant"""
+        tags = self._tags[lane]
+        tenant = min({w.tenant for w in eligible}, key=lambda name: tags[name][0][1])
+        start, _ = tags[tenant].popleft()
+        if not tags[tenant]:
+            del tags[tenant]
+        self._clock[lane] = start
+        waiter = min((w for w in eligible if w.tenant == tenant), key=lambda w: (w.deadline, w.seq))
+        self._waiting[lane].remove(waiter)
+        return waiter
+
+    def status(self):
+        with self._cond:
+            lanes = {}
+            now = time.monotonic()
+            for lane in LANES:
+                waits = sorted(self._waits[lane])
+                lanes[lane] = {
+                    "waiting": len(self._waiting[lane]),
+                    "running": self._running[lane],
+                    "admitted": self._granted[lane],
+                    "oldest_wait_seconds": round(max((now - w.enqueued for w in self._waiting[lane]), default=0), 2),
+                    "wait_p50_seconds": round(waits[len(waits) // 2], 2) if waits else None,
+                    "wait_p95_seconds": round(waits[int(len(waits) * 0.95)], 2) if waits else None,
+                    "sla_seconds": self.sla.get(lane),
+                    "sla_breaches": self._breaches[lane],
+                }
+            portal_limits = {servicio: limit.status(now) for servicio, limit in self._limits.items()}
+            for servicio, limit in portal_limits.items():
+                limit["waiting"] = sum(1 for lane in LANES for w in self._waiting[lane] if w.job.servicio == servicio)
+            return {"capacity": self.capacity, "interactive_reserved": self.reserved,
+                    "lanes": lanes, "portals": portal_limits}
+
+
+job_scheduler = JobScheduler()
@@ -0,0 +1,597 @@
+import os
+import time
+import shutil
+import logging
+from datetime import datetime
+from pathlib import Path
+import zipfile #Create a zip file for PDF and XML
+
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.chrome.service import Service
+
+from asset_cache import asset_cache
+from browser_tracker import browser_tracker
+from jobs import CancelToken
+from log_config import set_step
+from profiles import profile_template
+from settings import DOWNLOADS_DIR, CHROMEDRIVER_PATH
+
+logger = logging.getLogger(__name__)
+
+
+class CancellableWait(WebDriverWait):
+    """WebDriverWait that checks a cancel token on every poll"""
+
+    def __init__(self, driver, timeout, cancel_token, poll_frequency=0.25):
+        super().__init__(driver, timeout, poll_frequency=poll_frequency)
+        self._cancel_token = cancel_token
+
+    def _guard(self, method):
+        def guarded(driver):
+            self._cancel_token.check()
+            return method(driver)
+        return guarded
+
+    def until(self, method, message=""):
+        return super().until(self._guard(method), message)
+
+    def until_not(self, method, message=""):
+        return super().until_not(self._guard(method), message)
+
+
+class ServiceStore:
+    #def __init__(self, download_directory="~/Downloads"):
+    def __init__(self, download_directory=DOWNLOADS_DIR, cancel_token=None, driver_pool=None):
+        self.download_directory = os.path.abspath(download_directory)
+        Path(self.download_directory).mkdir(parents=True, exist_ok=True)
+        self.driver = None
+        self.cancel_token = cancel_token or CancelToken()
+        self.driver_pool = driver_pool
+
+    def setup_stealth_driver(user_data_dir=None, intercept=True):
+        chrome_options = Options()
+
+        # Start from a private copy of the warm profile template (see profiles.py)
+        profile_dir = None if user_data_dir else profile_template.checkout()
+        if user_data_dir or profile_dir:
+            chrome_options.add_argument(f"--user-data-dir={user_data_dir or profile_dir}")
+
+        # Anti-detection options
+        chrome_options.add_argument("--disable-blink-features=AutomationControlled")
+        chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+        chrome_options.add_experimental_option('useAutomationExtension', False)
+        chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36")
+
+        # Performance options
+        chrome_options.add_argument("--no-sandbox")
+        chrome_options.add_argument("--disable-dev-shm-usage")
+        chrome_options.add_argument("--disable-gpu")
+
+        # Block tracking
+        chrome_options.add_argument("--disable-extensions")
+        chrome_options.add_argument("--disable-plugins")
+
+        # Keep console and network events for failure snapshots
+        chrome_options.set_capability("goog:loggingPrefs", {"browser": "ALL", "performance": "ALL"})
+
+        # Railway provides chromedriver at this path
+        service = Service(CHROMEDRIVER_PATH)
+        try:
+            driver = webdriver.Chrome(service=service, options=chrome_options)
+        except Exception:
+            if profile_dir:
+                shutil.rmtree(profile_dir, ignore_errors=True)
+            raise
+        driver.profile_dir = profile_dir
+        #driver = webdriver.Chrome(options=chrome_options)
+        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+
+        # Record the chromedriver pid so the reaper can clean up after crashes
+        browser_tracker.register(driver)
+
+        # Portal scripts, styles, images and fonts come from the shared asset cache
+        if intercept:
+            asset_cache.attach(driver)
+
+        return driver
+
+    def setup_driver(self, servicio=None):
+        """Setup Chrome WebDriver with download preferences; pooled drivers parked on servicio's page come first"""
+#        chrome_options = Options()
+
+        if self.driver_pool:
+            self.driver = self.driver_pool.acquire(self.cancel_token, servicio)
+        else:
+            self.driver = ServiceStore.setup_stealth_driver()
+
+        # Pooled drivers are shared between jobs, so point downloads at this
+        # job's directory at checkout rather than through launch-time prefs
+        self.driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+            "behavior": "allow",
+            "downloadPath": self.download_directory,
+        })
+
+    def close_driver(self, reuse=False):
+        """Close the WebDriver, or hand it back to the pool when reuse is safe"""
+        driver, self.driver = self.driver, None
+        if not driver:
+            return
+        if self.driver_pool:
+            self.driver_pool.release(driver, reuse=reuse)
+        else:
+            driver.quit()
+            browser_tracker.unregister(driver)
+            profile_template.discard(driver)
+
+    def _sleep(self, seconds):
+        """Sleep that wakes up (and raises JobCancelled) as soon as the job is cancelled"""
+        self.cancel_token.sleep(seconds)
+
+    def _wait(self, timeout):
+        """WebDriverWait bound to this job's cancel token"""
+        return CancellableWait(self.driver, timeout, self.cancel_token)
+
+    def debug_page_elements(self):
+        """Debug method to find all buttons and their attributes"""
+        # Each element costs several WebDriver round trips; skip unless DEBUG is on
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        try:
+            buttons = self.driver.find_elements(By.TAG_NAME, "button")
+            inputs = self.driver.find_elements(By.XPATH, "//input[@type='submit' or @type='button']")
+
+            logger.debug("=== DEBUG: Found buttons ===")
+            for i, button in enumerate(buttons):
+                text = button.text.strip()
+                button_id = button.get_attribute("id")
+                button_class = button.get_attribute("class")
+                button_type = button.get_attribute("type")
+                logger.debug("Button %s: text='%s', id='%s', class='%s', type='%s'", i, text, button_id, button_class, button_type)
+
+            logger.debug("=== DEBUG: Found input buttons ===")
+            for i, input_elem in enumerate(inputs):
+                value = input_elem.get_attribute("value")
+                input_id = input_elem.get_attribute("id")
+                input_class = input_elem.get_attribute("class")
+                input_type = input_elem.get_attribute("type")
+                logger.debug("Input %s: value='%s', id='%s', class='%s', type='%s'", i, value, input_id, input_class, input_type)
+
+        except Exception as e:
+            logger.error("Debug error: %s", str(e))
+
+    def _simple_clear_and_fill(self, element, value):
+        """Simple method to clear and fill without duplication"""
+        try:
+            logger.debug("Clearing and filling field with: '%s'", value)
+
+            # Method 1: Standard clear
+            element.clear()
+            self._sleep(0.1)
+
+            # Method 2: Select all and delete (cross-platform)
+            try:
+                element.send_keys(Keys.CONTROL + "a")  # Ctrl+A on Windows/Linux
+                element.send_keys(Keys.DELETE)
+            except:
+                try:
+                    element.send_keys(Keys.COMMAND + "a")  # Cmd+A on Mac
+                    element.send_keys(Keys.DELETE)
+                except:
+                    pass  # If both fail, continue with other methods
+
+            self._sleep(0.1)
+
+            # Method 3: JavaScript clear (most reliable)
+            self.driver.execute_script("arguments[0].value = '';", element)
+            self.driver.execute_script("arguments[0].setAttribute('value', '');", element)
+            self._sleep(0.1)
+
+            # Verify field is empty
+            current_value = element.get_attribute('value')
+            if current_value:
+                logger.warning("Field still contains '%s' after clearing attempts", current_value)
+                # Force clear with focus and selection
+                element.click()
+                self.driver.execute_script("""
+                    arguments[0].focus();
+                    arguments[0].select();
+                    arguments[0].value = '';
+                """, element)
+
+            # Now fill with the value
+            element.send_keys(value)
+            self._sleep(0.2)
+
+            # Verify the value and check for duplication
+            final_value = element.get_attribute('value')
+            logger.debug("Field value after filling: '%s'", final_value)
+
+            if final_value != value:
+                if value in final_value and len(final_value) > len(value):
+                    logger.warning("Duplication detected! Expected: '%s', Got: '%s'", value, final_value)
+                    # Fix duplication by setting value directly
+                    self.driver.execute_script("arguments[0].value = arguments[1];", element, value)
+                    logger.info("Duplication fixed with JavaScript")
+                else:
+                    logger.warning("Unexpected value. Expected: '%s', Got: '%s'", value, final_value)
+
+            # Trigger Angular change events
+            self.driver.execute_script("""
+                var element = arguments[0];
+                var events = ['input', 'change', 'blur'];
+                events.forEach(function(eventType) {
+                    var event = new Event(eventType, {bubbles: true});
+                    element.dispatchEvent(event);
+                });
+            """, element)
+
+            logger.debug("Successfully filled field with: '%s'", value)
+
+        except Exception as e:
+            logger.error("Error in _simple_clear_and_fill: %s", str(e))
+            raise
+
+    def sending_file(self, timeout=60):
+        """
+        Check if there is exactly one .zip file in Downloads directory,
+        return its path for sending to client, and prepare for deletion after sending
+        """
+        set_step("download")
+        start_time = time.time()
+        #download_dir = Path(os.path.expanduser("~/Downloads"))
+        download_dir = Path(self.download_directory)
+        logger.info("Checking for ZIP file in directory: %s", download_dir)
+
+        while time.time() - start_time < timeout:
+            try:
+                # Get all ZIP files in the directory
+                zip_files = list(download_dir.glob("*.zip"))
+
+                # Check if there's exactly one ZIP file
+                if len(zip_files) == 1:
+                    zip_file = zip_files[0]
+
+                    # Verify file is complete and readable
+                    try:
+                        file_size = zip_file.stat().st_size
+                        if file_size > 1024:  # File should be at least 1KB
+                            logger.info("ZIP file found: %s (%s bytes)", zip_file, file_size)
+                            return str(zip_file)
+                        else:
+                            logger.debug("File too small (%s bytes), continuing to wait...", file_size)
+                    except Exception as file_error:
+                        logger.debug("Error checking file: %s", str(file_error))
+
+                elif len(zip_files) == 0:
+                    logger.debug("No ZIP files found yet, continuing to wait...")
+
+                elif len(zip_files) > 1:
+                    logger.warning("Multiple ZIP files found (%s), cannot determine which one to send", len(zip_files))
+                    # List all files for debugging
+                    for i, zip_file in enumerate(zip_files):
+                        logger.warning("  File %s: %s", i+1, zip_file.name)
+                    raise Exception(f"Multiple ZIP files found in directory. Expected exactly 1, found {len(zip_files)}")
+
+                # Check for download in progress
+                temp_files = list(download_dir.glob("*.crdownload"))
+                temp_files.extend(list(download_dir.glob("*.tmp")))
+
+                if temp_files:
+                    logger.debug("Download in progress (%s temp files)...", len(temp_files))
+
+                # Check for any download errors on the page
+                try:
+                    error_elements = self.driver.find_elements(By.XPATH, "//*[contains(@class, 'error') or contains(text(), 'error') or contains(text(), 'Error')]")
+                    for error in error_elements:
+                        if error.is_displayed() and error.text.strip():
+                            error_text = error.text.strip()
+                            if any(word in error_text.lower() for word in ['error', 'failed', 'problema']):
+                                raise Exception(f"Download error detected on page: {error_text}")
+                except Exception:
+                    # Driver might be closed or page changed, continue waiting
+                    pass
+
+                self._sleep(2)  # Check every 2 seconds
+
+            except Exception as check_error:
+                if "Multiple ZIP files" in str(check_error):
+                    raise  # Re-raise this specific error
+                logger.debug("Error during file check: %s", str(check_error))
+                self._sleep(2)
+
+        # Timeout reached
+        current_files = list(download_dir.glob("*.zip"))
+        logger.error("File check timeout after %s seconds", timeout)
+        logger.error("Current ZIP files in directory: %s", len(current_files))
+
+        if len(current_files) == 0:
+            raise TimeoutException(f"No ZIP file found after {timeout} seconds")
+        elif len(current_files) > 1:
+            raise Exception(f"Multiple ZIP files found after timeout. Expected exactly 1, found {len(current_files)}")
+        else:
+            # This shouldn't happen, but just in case
+            raise TimeoutException(f"Unknown error: found {len(current_files)} files but couldn't return path")
+
+
+
+    def _wait_for_both_downloads(self, timeout=60, kinds=('pdf', 'xml')):
+        """
+        Wait for the PDF and/or XML files to be downloaded or verify existing files
+
+        Args:
+            timeout (int): Seconds to wait
+            kinds (tuple): Which files to wait for ('pdf', 'xml' or both)
+
+        Returns:
+            tuple: (pdf_file_path, xml_file_path); None for a kind not waited for
+        """
+        start_time = time.time()
+
+        # Ensure download_directory is properly set and expanded
+        if not hasattr(self, 'download_directory') or not self.download_directory:
+            #self.download_directory = os.path.expanduser("~/Downloads")
+            logger.warning("download_directory was not set, using default: %s", self.download_directory)
+
+        # Expand user path and create Path object
+        expanded_path = os.path.expanduser(self.download_directory)
+        download_dir = Path(expanded_path)
+
+        # Ensure directory exists
+        if not download_dir.exists():
+            logger.error("Download directory does not exist: %s", download_dir)
+            download_dir.mkdir(parents=True, exist_ok=True)
+            logger.info("Created download directory: %s", download_dir)
+
+        logger.info("Checking for %s files in: %s", " and ".join(kind.upper() for kind in kinds), download_dir)
+
+        found = {kind: None for kind in kinds}
+
+        # First, check if files already exist
+        existing = {kind: list(download_dir.glob(f"*.{kind}")) for kind in kinds}
+
+        if all(existing.values()):
+            # Get the most recent files and verify they are complete
+            ready = {
+                kind: self._verify_file_complete(max(files, key=lambda f: f.stat().st_ctime))
+                for kind, files in existing.items()
+            }
+            if all(ready.values()):
+                logger.info("✓ Found existing %s files that are ready", "/".join(kind.upper() for kind in kinds))
+                return ready.get('pdf'), ready.get('xml')
+
+        # If files aren't already complete, wait for them
+        logger.info("Files not found or incomplete, waiting for downloads...")
+
+        # Get initial file sets if we need to wait for new files
+        initial = {kind: set(files) for kind, files in existing.items()}
+
+        while time.time() - start_time < timeout:
+            try:
+                for kind in kinds:
+                    if found[kind]:
+                        continue
+                    # Check for new files of this kind, most recent first
+                    new_files = set(download_dir.glob(f"*.{kind}")) - initial[kind]
+                    if new_files:
+                        candidates = sorted(new_files, key=lambda f: f.stat().st_ctime, reverse=True)
+                        found[kind] = self._verify_file_complete(candidates[0])
+                        if found[kind]:
+                            logger.info("✓ %s file ready: %s", kind.upper(), found[kind].name)
+
+                # If every requested file is found and complete, we're done
+                if all(found.values()):
+                    logger.info("✓ %s downloaded successfully", " and ".join(kind.upper() for kind in kinds))
+                    return found.get('pdf'), found.get('xml')
+
+                # Check for partial downloads
+                temp_files = list(download_dir.glob("*.crdownload"))
+                temp_files.extend(list(download_dir.glob("*.tmp")))
+                temp_files.extend(list(download_dir.glob("*.part")))
+
+                if temp_files:
+                    logger.debug("Downloads in progress (%s temp files)...", len(temp_files))
+
+                # Log progress
+                elapsed = time.time() - start_time
+                if elapsed % 10 < 2:  # Log every ~10 seconds
+                    logger.info("Download progress (%.0fs): %s", elapsed, ", ".join(
+                        f"{kind.upper()} {'✓' if found[kind] else '⏳'}" for kind in kinds
+                    ))
+
+                self._sleep(2)  # Check every 2 seconds
+
+            except Exception as check_error:
+                logger.debug("Error during download check: %s", str(check_error))
+                self._sleep(2)
+
+        # Timeout handling
+        missing = [kind.upper() for kind in kinds if not found[kind]]
+        ready = [kind.upper() for kind in kinds if found[kind]]
+        raise TimeoutException(
+            f"{' and '.join(missing)} not downloaded after {timeout} seconds"
+            + (f" ({', '.join(ready)} ready)" if ready else "")
+        )
+
+    def _verify_file_complete(self, file_path):
+        """
+        Verify that a file is completely downloaded and readable
+        
+        Args:
+            file_path (Path): Path to the file to verify
+            
+        Returns:
+            Path or None: File path if complete, None if still downloading
+        """
+        try:
+            if not file_path.exists():
+                return None
+            
+            # Check file size (should be greater than 0)
+            file_size = file_path.stat().st_size
+            if file_size == 0:
+                logger.debug("File %s is empty, still downloading...", file_path.name)
+                return None
+            
+            # For small files, wait a bit more to ensure completion
+            if file_size < 1024:  # Less than 1KB
+                self._sleep(1)
+                new_size = file_path.stat().st_size
+                if new_size != file_size:
+                    logger.debug("File %s still growing, waiting...", file_path.name)
+                    return None
+            
+            # Try to open the file to ensure it's not locked
+            try:
+                with open(file_path, 'rb') as f:
+                    f.read(100)  # Read first 100 bytes
+                logger.debug("File %s verified complete (%s bytes)", file_path.name, file_size)
+                return file_path
+            except (PermissionError, OSError):
+                logger.debug("File %s still being written...", file_path.name)
+                return None
+                
+        except Exception as e:
+            logger.debug("Error verifying file %s: %s", file_path, str(e))
+            return None
+
+    def _create_zip_from_files(self, pdf_file, xml_file, zip_filename=None):
+        """
+        Create a ZIP file containing the PDF and XML files
+        
+        Args:
+            pdf_file (Path): Path to the PDF file, or None
+            xml_file (Path): Path to the XML file, or None
+            zip_filename (str): Optional custom filename for ZIP
+            
+        Returns:
+            str: Path to the created ZIP file
+        """
+        try:
+            # Ensure we have a valid download directory
+            if not hasattr(self, 'download_directory') or not self.download_directory:
+                #self.download_directory = os.path.expanduser("~/Downloads")
+                self.download_directory = DOWNLOADS_DIR
+            
+            expanded_path = os.path.expanduser(self.download_directory)
+            download_dir_path = Path(expanded_path)
+            
+            # Generate ZIP filename if not provided
+            if not zip_filename:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                # Try to extract ticket/folio info from filenames for better naming
+                ticket_info = self._extract_ticket_info_from_filename((pdf_file or xml_file).name)
+                if ticket_info:
+                    zip_filename = f"factura_{ticket_info}_{timestamp}.zip"
+                else:
+                    zip_filename = f"factura_{timestamp}.zip"
+            
+            # Ensure ZIP filename has .zip extension
+            if not zip_filename.endswith('.zip'):
+                zip_filename += '.zip'
+            
+            # Create ZIP file path in the download directory
+            zip_file_path = download_dir_path / zip_filename
+            
+            logger.info("Creating ZIP file: %s", zip_file_path)
+            
+            with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                # Add the PDF and/or XML file (a formato may only need one)
+                for file in (pdf_file, xml_file):
+                    if file:
+                        zipf.write(file, file.name)
+                        logger.info("Added to ZIP: %s (%s bytes)", file.name, file.stat().st_size)
+            
+            # Verify ZIP file was created successfully
+            if zip_file_path.exists():
+                zip_size = zip_file_path.stat().st_size
+                logger.info("✓ ZIP file created successfully: %s (%s bytes)", zip_filename, zip_size)
+                
+                # Verify ZIP contents
+                with zipfile.ZipFile(zip_file_path, 'r') as zipf:
+                    zip_contents = zipf.namelist()
+                    logger.info("ZIP contents: %s", zip_contents)
+                    
+                    # Test ZIP integrity
+                    bad_file = zipf.testzip()
+                    if bad_file:
+                        raise Exception(f"ZIP file corrupted, bad file: {bad_file}")
+                    else:
+                        logger.info("✓ ZIP file integrity verified")
+                
+                return str(zip_file_path)
+            else:
+                raise Exception("ZIP file was not created")
+                
+        except Exception as e:
+            logger.error("Error creating ZIP file: %s", str(e))
+            raise
+            
+    def _extract_ticket_info_from_filename(self, filename):
+        """
+        Try to extract ticket/folio information from filename for better ZIP naming
+        
+        Args:
+            filename (str): The PDF filename
+            
+        Returns:
+            str or None: Extracted ticket info or None
+        """
+        try:
+            # Common patterns in invoice filenames
+            import re
+            
+            # Look for patterns like "VEMA880823699", ticket numbers, etc.
+            patterns = [
+                r'([A-Z]{4}\d{9})',  # Pattern like VEMA880823699
+                r'(CFC\d+)',         # Pattern like CFC1101217742
+                r'(\d{10,})',        # Long number sequences
+                r'([A-Z]+\d+[A-Z]*\d*)'  # Mixed alphanumeric
+            ]
+            
+            for pattern in patterns:
+                match = re.search(pattern, filename)
+                if match:
+                    return match.group(1)
+            
+            # If no pattern matches, return first part of filename (without extension)
+            base_name = Path(filename).stem
+            if len(base_name) > 5:  # Only if reasonably long
+                return base_name[:15]  # Limit length
+                
+            return None
+            
+        except Exception as e:
+            logger.debug("Error extracting ticket info from filename: %s", str(e))
+            return None
+
+    def _cleanup_individual_files(self, pdf_file, xml_file):
+        """
+        Remove individual PDF and XML files after successful ZIP creation
+        
+        Args:
+            pdf_file (Path): Path to the PDF file
+            xml_file (Path): Path to the XML file
+        """
+        try:
+            logger.info("Cleaning up individual files after ZIP creation...")
+            
+            # Remove PDF file
+            if pdf_file and pdf_file.exists():
+                pdf_file.unlink()
+                logger.info("✓ Removed PDF file: %s", pdf_file.name)
+            
+            # Remove XML file
+            if xml_file and xml_file.exists():
+                xml_file.unlink()
+                logger.info("✓ Removed XML file: %s", xml_file.name)
+            
+            logger.info("✓ Cleanup completed successfully")
+            
+        except Exception as e:
+            logger.warning("Error during cleanup (files may remain): %s", str(e))
+            # Don't raise exception for cleanup errors
@@ -0,0 +1,160 @@
+import os
+import socket
+import tempfile
+from pathlib import Path
+
+# Lightweight, import-time-safe configuration shared by the web layer and the
+# Selenium stack. Nothing in here may import Selenium or other heavy modules.
+
+DOWNLOADS_DIR = Path.home() / 'Downloads'
+
+# Finished invoice files waiting to be streamed to the client
+RESULTS_DIR = Path(os.environ.get('RESULTS_DIR', str(Path(tempfile.gettempdir()) / 'ticketapi_results')))
+
+CHROMEDRIVER_PATH = os.environ.get('CHROMEDRIVER_PATH', '/usr/bin/chromedriver')
+
+PORTAL_URLS = {
+    'farmaciaguadalajara': "https://www.movil.farmaciasguadalajara.com/facturacion/",
+    'farmaciadelahorro': "https://fahorro.masfacturaweb.com.mx/creafactura",
+}
+
+# Driver pool; when unset the size is derived from the enabled portal adapters
+DRIVER_POOL_SIZE = int(os.environ['DRIVER_POOL_SIZE']) if os.environ.get('DRIVER_POOL_SIZE') else None
+DRIVER_MAX_USES = int(os.environ.get('DRIVER_MAX_USES', '20'))
+# Idle pooled drivers wait on a portal's landing page; a job reuses the page
+# if it is younger than DRIVER_PARK_TTL seconds and no portal cookie expires
+# within DRIVER_PARK_MIN_COOKIE_TTL seconds
+DRIVER_PARK_ENABLED = os.environ.get('DRIVER_PARK_ENABLED', '1') == '1'
+DRIVER_PARK_TTL = int(os.environ.get('DRIVER_PARK_TTL', '300'))
+DRIVER_PARK_MIN_COOKIE_TTL = int(os.environ.get('DRIVER_PARK_MIN_COOKIE_TTL', '60'))
+# How long a job waits for a driver being reset and parked before launching a new one
+DRIVER_RECYCLE_WAIT = float(os.environ.get('DRIVER_RECYCLE_WAIT', '20'))
+
+# Readiness thresholds
+MIN_FREE_DISK_MB = int(os.environ.get('MIN_FREE_DISK_MB', '200'))
+PORTAL_PROBE_INTERVAL = int(os.environ.get('PORTAL_PROBE_INTERVAL', '60'))
+PORTAL_PROBE_TIMEOUT = float(os.environ.get('PORTAL_PROBE_TIMEOUT', '5'))
+
+# Failure snapshots
+DIAGNOSTICS_DIR = Path(os.environ.get('DIAGNOSTICS_DIR', str(Path.home() / 'diagnostics')))
+DIAGNOSTICS_MAX_SNAPSHOTS = int(os.environ.get('DIAGNOSTICS_MAX_SNAPSHOTS', '50'))
+DIAGNOSTICS_MAX_AGE_HOURS = int(os.environ.get('DIAGNOSTICS_MAX_AGE_HOURS', '72'))
+DIAGNOSTICS_MAX_HAR_ENTRIES = int(os.environ.get('DIAGNOSTICS_MAX_HAR_ENTRIES', '300'))
+
+# Janitor
+JANITOR_SWEEP_INTERVAL = int(os.environ.get('JANITOR_SWEEP_INTERVAL', '300'))
+JANITOR_MAX_FILE_AGE = int(os.environ.get('JANITOR_MAX_FILE_AGE', '900'))
+JANITOR_MAX_DOWNLOADS_MB = int(os.environ.get('JANITOR_MAX_DOWNLOADS_MB', '500'))
+
+# Worker processes running the Selenium jobs; 0 runs them in the web process.
+# Each worker has its own driver pool of DRIVER_POOL_SIZE drivers.
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', '1'))
+WORKER_HEARTBEAT_INTERVAL = float(os.environ.get('WORKER_HEARTBEAT_INTERVAL', '2'))
+WORKER_HEARTBEAT_TIMEOUT = int(os.environ.get('WORKER_HEARTBEAT_TIMEOUT', '20'))
+WORKER_HANG_TIMEOUT = int(os.environ.get('WORKER_HANG_TIMEOUT', '90'))
+WORKER_START_TIMEOUT = int(os.environ.get('WORKER_START_TIMEOUT', '180'))
+WORKER_MAX_RSS_MB = int(os.environ.get('WORKER_MAX_RSS_MB', '1500'))
+CANCEL_GRACE_PERIOD = float(os.environ.get('CANCEL_GRACE_PERIOD', '1.0'))
+
+# Browser process tracking and reaping
+BROWSER_SESSIONS_DIR = Path(os.environ.get('BROWSER_SESSIONS_DIR', str(Path(tempfile.gettempdir()) / 'ticketapi_sessions')))
+BROWSER_REAP_INTERVAL = int(os.environ.get('BROWSER_REAP_INTERVAL', '60'))
+BROWSER_MAX_SESSION_AGE = int(os.environ.get('BROWSER_MAX_SESSION_AGE', '1800'))
+# Kill Chrome processes reparented to init that no tracked session owns;
+# turn off when running outside a container next to a desktop Chrome
+BROWSER_REAP_ORPHANS = os.environ.get('BROWSER_REAP_ORPHANS', '1') == '1'
+
+# Customer profiles
+CUSTOMERS_DB = Path(os.environ.get('CUSTOMERS_DB', str(Path.home() / 'data' / 'customers.sqlite3')))
+CUSTOMER_CACHE_SIZE = int(os.environ.get('CUSTOMER_CACHE_SIZE', '1024'))
+
+# SAT catalog index: portal option values per SAT code, rebuilt with `python sat.py refresh`
+SAT_CATALOG_PATH = Path(os.environ.get('SAT_CATALOG_PATH', str(Path(__file__).parent / 'sat_catalog.json')))
+CATALOG_CAPTURES_DIR = Path(os.environ.get('CATALOG_CAPTURES_DIR', str(Path.home() / 'data' / 'catalog_captures')))
+
+# Invoice archive (content-addressed files plus an SQLite index)
+ARCHIVE_DIR = Path(os.environ.get('ARCHIVE_DIR', str(Path.home() / 'data' / 'archive')))
+
+# Ticket preflight: how long a portal's verdict on ticket fields is reused
+PREFLIGHT_CACHE_TTL = int(os.environ.get('PREFLIGHT_CACHE_TTL', '300'))
+PREFLIGHT_CACHE_SIZE = int(os.environ.get('PREFLIGHT_CACHE_SIZE', '10000'))
+PREFLIGHT_TIMEOUT = int(os.environ.get('PREFLIGHT_TIMEOUT', '60'))
+
+# Deferred retries of tickets the portal does not know yet (same-day purchases).
+# Attempts back off exponentially from RETRY_BASE_DELAY to RETRY_MAX_DELAY
+# seconds, run only within RETRY_OFF_PEAK_HOURS ("22-7"; empty for any hour)
+# and stop RETRY_MAX_AGE seconds after the original request.
+RETRY_DB = Path(os.environ.get('RETRY_DB', str(Path.home() / 'data' / 'retries.sqlite3')))
+RETRY_BASE_DELAY = int(os.environ.get('RETRY_BASE_DELAY', '1800'))
+RETRY_MAX_DELAY = int(os.environ.get('RETRY_MAX_DELAY', '21600'))
+RETRY_MAX_AGE = int(os.environ.get('RETRY_MAX_AGE', '259200'))
+RETRY_OFF_PEAK_HOURS = os.environ.get('RETRY_OFF_PEAK_HOURS', '22-7')
+RETRY_POLL_INTERVAL = int(os.environ.get('RETRY_POLL_INTERVAL', '60'))
+RETRY_WEBHOOK_TIMEOUT = float(os.environ.get('RETRY_WEBHOOK_TIMEOUT', '10'))
+
+# Job scheduling lanes (interactive, batch, retry; in priority order). Slots
+# are browser sessions: WORKER_PROCESSES, or 1 in the web process.
+# SCHEDULER_INTERACTIVE_RESERVED slots only ever run interactive jobs (at
+# least one slot stays open to the other lanes), tenants share a lane by
+# weight ("pos=3,backoffice=1"; unlisted tenants weigh 1) and each lane
+# reports how often its queue wait exceeds its SLA in seconds.
+SCHEDULER_INTERACTIVE_RESERVED = int(os.environ.get('SCHEDULER_INTERACTIVE_RESERVED', '1'))
+SCHEDULER_TENANT_WEIGHTS = os.environ.get('SCHEDULER_TENANT_WEIGHTS', '')
+SCHEDULER_LANE_SLA = os.environ.get('SCHEDULER_LANE_SLA', 'interactive=10,batch=600,retry=3600')
+
+# Per-portal limits overriding the adapters' defaults ("farmaciaguadalajara=1,...").
+# The rate halves (down to PORTAL_MIN_RATE_FRACTION of its limit) when a job
+# sees 429/5xx answers or a clean job runs PORTAL_SLOWDOWN_FACTOR times slower
+# than usual for its action, 429s also pause the portal for
+# PORTAL_BACKOFF_SECONDS (doubling while they repeat), and clean jobs win the
+# rate back step by step.
+PORTAL_MAX_SESSIONS = os.environ.get('PORTAL_MAX_SESSIONS', '')
+PORTAL_RATE_PER_MINUTE = os.environ.get('PORTAL_RATE_PER_MINUTE', '')
+PORTAL_MIN_RATE_FRACTION = float(os.environ.get('PORTAL_MIN_RATE_FRACTION', '0.1'))
+PORTAL_SLOWDOWN_FACTOR = float(os.environ.get('PORTAL_SLOWDOWN_FACTOR', '2.5'))
+PORTAL_BACKOFF_SECONDS = int(os.environ.get('PORTAL_BACKOFF_SECONDS', '30'))
+
+# Multi-replica mode. With QUEUE_BACKEND set ("sqlite", or "module:Class" for
+# another QueueBackend), jobs go through a queue shared by every replica and
+# results through the invoice archive, so ARCHIVE_DIR, QUEUE_DB and
+# DIAGNOSTICS_DIR must live on storage all replicas mount. A replica whose
+# heartbeat is older than REPLICA_TIMEOUT seconds loses its jobs to the others.
+QUEUE_BACKEND = os.environ.get('QUEUE_BACKEND', '').strip()
+QUEUE_DB = Path(os.environ.get('QUEUE_DB', str(Path.home() / 'data' / 'queue.sqlite3')))
+QUEUE_POLL_INTERVAL = float(os.environ.get('QUEUE_POLL_INTERVAL', '0.25'))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get('QUEUE_MAX_ATTEMPTS', '3'))
+REPLICA_ID = os.environ.get('REPLICA_ID') or os.environ.get('RAILWAY_REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+REPLICA_HEARTBEAT_INTERVAL = float(os.environ.get('REPLICA_HEARTBEAT_INTERVAL', '5'))
+REPLICA_TIMEOUT = int(os.environ.get('REPLICA_TIMEOUT', '30'))
+
+# Job journal: every flow step is written ahead to SQLite, so a job cut off
+# by a restart is known to have (possibly) issued its invoice. Jobs silent
+# for JOURNAL_ABANDON_AFTER seconds count as interrupted.
+JOURNAL_DB = Path(os.environ.get('JOURNAL_DB', str(Path.home() / 'data' / 'journal.sqlite3')))
+JOURNAL_ABANDON_AFTER = int(os.environ.get('JOURNAL_ABANDON_AFTER', '600'))
+JOURNAL_RETENTION_DAYS = int(os.environ.get('JOURNAL_RETENTION_DAYS', '14'))
+
+# Chrome profile template: a profile whose HTTP cache holds the portals'
+# scripts, styles and fonts, rebuilt every PROFILE_TEMPLATE_REFRESH seconds.
+# Each new driver starts from its own copy (reflinked where the filesystem
+# supports it), so no mutable state is shared between sessions.
+PROFILE_TEMPLATE_ENABLED = os.environ.get('PROFILE_TEMPLATE_ENABLED', '1') == '1'
+BROWSER_PROFILES_DIR = Path(os.environ.get('BROWSER_PROFILES_DIR', str(Path(tempfile.gettempdir()) / 'ticketapi_profiles')))
+PROFILE_TEMPLATE_REFRESH = int(os.environ.get('PROFILE_TEMPLATE_REFRESH', '21600'))
+# Seconds a portal page may keep loading lazy bundles and fonts after its load event
+PROFILE_TEMPLATE_SETTLE = float(os.environ.get('PROFILE_TEMPLATE_SETTLE', '3'))
+
+# Shared cache for the portals' static assets (scripts, styles, images and
+# fonts), served to every Chrome session by request interception. Entries
+# follow the responses' cache headers; least recently used ones are evicted
+# past ASSET_CACHE_MB. ASSET_CACHE_HOSTS adds CDN hosts to the portal hosts.
+# It sits in front of each session's own HTTP cache (warmed by the profile
+# template): intercepted assets are answered here first, and the requests it
+# lets through (responses it may not keep, fetch errors) or never intercepts
+# (documents, API calls, other hosts) fall to the HTTP cache. The template is
+# built without interception, as fulfilled requests never reach that cache.
+ASSET_CACHE_ENABLED = os.environ.get('ASSET_CACHE_ENABLED', '1') == '1'
+ASSET_CACHE_DIR = Path(os.environ.get('ASSET_CACHE_DIR', str(Path(tempfile.gettempdir()) / 'ticketapi_assets')))
+ASSET_CACHE_MB = int(os.environ.get('ASSET_CACHE_MB', '200'))
+ASSET_CACHE_HOSTS = os.environ.get('ASSET_CACHE_HOSTS', '')
+ASSET_CACHE_TIMEOUT = int(os.environ.get('ASSET_CACHE_TIMEOUT', '20'))
@@ -0,0 +1,189 @@
+import time
+import shutil
+import logging
+import threading
+import multiprocessing
+from datetime import datetime
+
+import portals
+import sat
+from browser_tracker import browser_tracker
+from janitor import janitor
+from profiles import profile_template
+from settings import (
+    DOWNLOADS_DIR, DRIVER_POOL_SIZE, MIN_FREE_DISK_MB,
+    PORTAL_PROBE_INTERVAL, PORTAL_PROBE_TIMEOUT, WORKER_PROCESSES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Background startup pipeline.
+#
+# app.py only imports Flask and this module, so gunicorn can start accepting
+# connections right away. The heavy stack (Selenium, the driver pool,
+# `requests`) is imported here in a daemon thread, which then pre-launches
+# drivers and keeps probing the portals for /ready. With WORKER_PROCESSES
+# set, the browsers live in supervised worker processes instead (see
+# workers.py) and this process only starts them.
+
+stages = {
+    "imports": "pending",
+    "driver_pool": "pending",
+    "portal_probe": "pending",
+}
+started_at = None
+driver_pool = None
+portal_status = {}
+
+_start_lock = threading.Lock()
+_pool_lock = threading.Lock()
+_thread = None
+
+
+def start():
+    """Kick off the startup pipeline once per process"""
+    global _thread, started_at
+    if multiprocessing.parent_process() is not None:
+        # Worker processes re-import app.py; they must not start another pipeline
+        return
+    with _start_lock:
+        if _thread is not None:
+            return
+        started_at = time.time()
+        janitor.start()
+        browser_tracker.start()
+        sat.load_index()
+        _thread = threading.Thread(target=_run, name="startup", daemon=True)
+        _thread.start()
+
+
+def _run():
+    try:
+        if not WORKER_PROCESSES:
+            load_service_store()
+        adapters = portals.enabled_adapters()
+        for adapter in adapters:
+            adapter.compile()
+        stages["imports"] = "done"
+        # Drivers launched before the first template build start with an empty cache
+        profile_template.start()
+        logger.info("Portal adapters loaded: %s", [adapter.servicio for adapter in adapters])
+        logger.info("Heavy imports loaded in %.1fs", time.time() - started_at)
+    except Exception as e:
+        stages["imports"] = f"failed: {str(e)}"
+        logger.error("Startup imports failed: %s", str(e))
+        return
+
+    if WORKER_PROCESSES:
+        from workers import supervisor
+        supervisor.start()
+        stages["driver_pool"] = "workers"
+    else:
+        try:
+            pool = get_driver_pool()
+            pool.warm()
+            stages["driver_pool"] = "done" if pool.last_error is None else f"failed: {pool.last_error}"
+            logger.info("Driver pool warm-up finished after %.1fs: %s", time.time() - started_at, pool.status())
+        except Exception as e:
+            stages["driver_pool"] = f"failed: {str(e)}"
+            logger.error("Driver pool warm-up failed: %s", str(e))
+
+    while True:
+        probe_portals()
+        stages["portal_probe"] = "done"
+        time.sleep(PORTAL_PROBE_INTERVAL)
+
+
+def load_service_store():
+    """Import the Selenium stack (safe to call from any thread) and return ServiceStore"""
+    from service_store import ServiceStore
+    return ServiceStore
+
+
+def get_driver_pool():
+    """Return the process-wide driver pool, creating it on first use"""
+    global driver_pool
+    with _pool_lock:
+        if driver_pool is None:
+            from driver_pool import DriverPool
+            ServiceStore = load_service_store()
+            adapters = portals.enabled_adapters()
+            size = DRIVER_POOL_SIZE or sum(adapter.pool_size for adapter in adapters) or 1
+            # Idle drivers wait on the landing pages of portals that declare their first fields
+            landings = [(adapter.servicio, adapter.url, adapter.pool_size) for adapter in adapters if adapter.landing_fields]
+            driver_pool = DriverPool(ServiceStore.setup_stealth_driver, size=size, landings=landings)
+        return driver_pool
+
+
+def probe_portals():
+    """Check that each portal answers; results are cached for /ready"""
+    import requests
+
+    for adapter in portals.enabled_adapters():
+        servicio = adapter.servicio
+        started = time.time()
+        try:
+            response = requests.head(adapter.url, timeout=PORTAL_PROBE_TIMEOUT, allow_redirects=True)
+            portal_status[servicio] = {
+                "reachable": response.status_code < 500,
+                "status_code": response.status_code,
+                "latency_ms": round((time.time() - started) * 1000),
+                "checked_at": datetime.now().isoformat(),
+            }
+        except Exception as e:
+            portal_status[servicio] = {
+                "reachable": False,
+                "error": str(e),
+                "checked_at": datetime.now().isoformat(),
+            }
+
+
+def disk_status():
+    try:
+        usage = shutil.disk_usage(DOWNLOADS_DIR if DOWNLOADS_DIR.exists() else DOWNLOADS_DIR.parent)
+        free_mb = usage.free // (1024 * 1024)
+        return {"ok": free_mb >= MIN_FREE_DISK_MB, "free_mb": free_mb, "min_free_mb": MIN_FREE_DISK_MB}
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+
+def readiness():
+    """
+    Readiness report for /ready.
+
+    `ready` requires the Selenium stack, a working driver pool (or at least
+    one ready worker process) and enough disk.
+    Unreachable portals only mark the instance as degraded, since restarting
+    us will not fix them.
+    """
+    pool_status = driver_pool.status() if driver_pool else None
+    worker_status = None
+    if WORKER_PROCESSES:
+        from workers import supervisor
+        worker_status = supervisor.status()
+        pool_ok = worker_status["ready"] > 0
+    else:
+        pool_ok = bool(pool_status) and pool_status["last_error"] is None and pool_status["launched_total"] > 0
+    disk = disk_status()
+    portals_ok = bool(portal_status) and all(p["reachable"] for p in portal_status.values())
+
+    ready = stages["imports"] == "done" and pool_ok and disk["ok"]
+    if not ready:
+        status = "not_ready"
+    elif not portals_ok:
+        status = "degraded"
+    else:
+        status = "ready"
+
+    return ready, {
+        "status": status,
+        "uptime_seconds": round(time.time() - started_at, 1) if started_at else 0,
+        "stages": dict(stages),
+        "driver_pool": pool_status,
+        "workers": worker_status,
+        "disk": disk,
+        "janitor": janitor.status(),
+        "browser_reaper": browser_tracker.status(),
+        "portals": dict(portal_status),
+        "timestamp": datetime.now().isoformat(),
+    }
@@ -0,0 +1,60 @@
+from email.utils import formatdate
+
+import pytest
+
+from asset_cache import freshness, cache_directives, HEURISTIC_MAX
+
+NOW = 1_790_000_000.0
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def test_cache_directives():
+    assert cache_directives('public, max-age=600, IMMUTABLE, s-maxage="60"') == {
+        'public': None, 'max-age': '600', 'immutable': None, 's-maxage': '60'}
+    assert cache_directives(None) == {}
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({'Cache-Control': 'public, max-age=600'}, 600),
+    ({'Cache-Control': 'max-age=600, s-maxage=60'}, 60),
+    ({'Cache-Control': 'max-age=-5'}, 0),
+    ({'Cache-Control': 'max-age=soon'}, 0),
+    ({'Cache-Control': 'max-age=600', 'Vary': 'Accept-Encoding'}, 600),
+])
+def test_max_age(headers, expected):
+    assert freshness(headers, NOW) == expected
+
+
+@pytest.mark.parametrize('headers', [
+    {'Cache-Control': 'no-store'},
+    {'Cache-Control': 'private, max-age=600'},
+    {'Cache-Control': 'no-cache'},
+    {'Cache-Control': 'max-age=600', 'Set-Cookie': 'session=1'},
+    {'Cache-Control': 'max-age=600', 'Vary': 'Accept-Encoding, Cookie'},
+    {},
+])
+def test_responses_a_shared_cache_must_not_store(headers):
+    assert freshness(headers, NOW) is None
+
+
+def test_expires_counts_from_the_date_header():
+    headers = {'Date': http_date(NOW - 100), 'Expires': http_date(NOW + 200)}
+    assert freshness(headers, NOW) == 300
+
+
+def test_invalid_or_past_expires_is_stale():
+    assert freshness({'Expires': '0'}, NOW) == 0
+    assert freshness({'Date': http_date(NOW), 'Expires': http_date(NOW - 60)}, NOW) == 0
+
+
+def test_max_age_wins_over_expires():
+    headers = {'Cache-Control': 'max-age=60', 'Expires': http_date(NOW + 3600)}
+    assert freshness(headers, NOW) == 60
+
+
+def test_last_modified_gives_a_heuristic_lifetime():
+    assert freshness({'Last-Modified': http_date(NOW - 1000)}, NOW) == 100
+    assert freshness({'Last-Modified': http_date(NOW - 10 ** 8)}, NOW) == HEURISTIC_MAX
@@ -0,0 +1,67 @@
+import io
+
+import pytest
+
+from cfdi import parse_stream, CfdiParser, InvalidCFDI
+
+CFDI = b'''<?xml version="1.0" encoding="UTF-8"?>
+<cfdi:Comprobante xmlns:cfdi="http://www.sat.gob.mx/cfd/4"
+    xmlns:cce11="http://www.sat.gob.mx/ComercioExterior11"
+    xmlns:nomina12="http://www.sat.gob.mx/nomina12"
+    xmlns:tfd="http://www.sat.gob.mx/TimbreFiscalDigital"
+    Version="4.0" Fecha="2026-10-01T10:00:00" Total="116.00" Moneda="MXN">
+  <cfdi:Emisor Rfc="FAH850101AB1" Nombre="FARMACIAS DEL AHORRO" RegimenFiscal="601"/>
+  <cfdi:Receptor Rfc="GOMJ800101AB1" Nombre="JUAN GOMEZ" UsoCFDI="G03"/>
+  <cfdi:Conceptos>
+    <cfdi:Concepto ClaveProdServ="51101500" Cantidad="1" Descripcion="PARACETAMOL" Importe="100.00">
+      <cfdi:Impuestos/>
+    </cfdi:Concepto>
+  </cfdi:Conceptos>
+  <cfdi:Complemento>
+    <cce11:ComercioExterior Version="1.1">
+      <cce11:Emisor><cce11:Domicilio Calle="X"/></cce11:Emisor>
+      <cce11:Receptor NumRegIdTrib="123"/>
+      <cce11:Mercancias><cce11:Mercancia NoIdentificacion="1"/></cce11:Mercancias>
+    </cce11:ComercioExterior>
+    <nomina12:Nomina Version="1.2">
+      <nomina12:Emisor RegistroPatronal="B5510768108"/>
+      <nomina12:Receptor Curp="XEXX010101HNEXXXA4" Rfc="XEXX010101000"/>
+    </nomina12:Nomina>
+    <tfd:TimbreFiscalDigital UUID="abcdefab-1234-1234-1234-abcdefabcdef" FechaTimbrado="2026-10-01T10:01:00"/>
+  </cfdi:Complemento>
+</cfdi:Comprobante>
+'''
+
+
+def test_complement_emisor_and_receptor_do_not_overwrite_the_comprobante():
+    metadata = parse_stream(io.BytesIO(CFDI))
+    assert metadata["emisor"] == {'rfc': 'FAH850101AB1', 'nombre': 'FARMACIAS DEL AHORRO', 'regimen_fiscal': '601'}
+    assert metadata["receptor"] == {'rfc': 'GOMJ800101AB1', 'nombre': 'JUAN GOMEZ', 'uso_cfdi': 'G03'}
+    assert metadata["conceptos_count"] == 1
+    assert metadata["conceptos"][0]["descripcion"] == 'PARACETAMOL'
+    assert metadata["uuid"] == 'ABCDEFAB-1234-1234-1234-ABCDEFABCDEF'
+    assert metadata["total"] == '116.00'
+
+
+def test_chunked_feed_reads_the_same_metadata():
+    parser = CfdiParser(max_conceptos=0)
+    for start in range(0, len(CFDI), 7):
+        parser.feed(CFDI[start:start + 7])
+    metadata = parser.close()
+    assert metadata["receptor"]["rfc"] == 'GOMJ800101AB1'
+    assert (metadata["conceptos"], metadata["conceptos_count"]) == ([], 1)
+
+
+def test_cfdi_3_3_namespace_is_read():
+    metadata = parse_stream(io.BytesIO(CFDI.replace(b'/cfd/4', b'/cfd/3')))
+    assert metadata["emisor"]["rfc"] == 'FAH850101AB1'
+
+
+@pytest.mark.parametrize('xml', [
+    b'<Comprobante Total="1"/>',
+    b'<x:Comprobante xmlns:x="urn:other" Total="1"/>',
+    b'<cfdi:Comprobante xmlns:cfdi="http://www.sat.gob.mx/cfd/4"',
+])
+def test_documents_without_a_cfdi_comprobante_are_refused(xml):
+    with pytest.raises(InvalidCFDI):
+        parse_stream(io.BytesIO(xml))
@@ -0,0 +1,38 @@
+import pytest
+
+from janitor import Janitor
+
+
+@pytest.fixture
+def janitor(tmp_path):
+    return Janitor(roots=(tmp_path / 'downloads', tmp_path / 'results'))
+
+
+def test_job_directory_is_a_child_of_the_root(janitor, tmp_path):
+    path = janitor.job_directory(tmp_path / 'downloads', 'abc-123')
+    assert path == (tmp_path / 'downloads' / 'abc-123').resolve()
+
+
+@pytest.mark.parametrize('job_id', ['..', '../x', '../../etc', '/root', 'a/b', '.', ''])
+def test_job_directory_rejects_ids_escaping_the_root(janitor, tmp_path, job_id):
+    with pytest.raises(ValueError):
+        janitor.job_directory(tmp_path / 'downloads', job_id)
+
+
+def test_remove_never_deletes_outside_the_roots(janitor, tmp_path):
+    outside = tmp_path / 'keep'
+    outside.mkdir()
+    (outside / 'file.zip').write_bytes(b'x')
+    janitor._remove(outside)
+    assert (outside / 'file.zip').exists()
+    janitor._remove(tmp_path / 'downloads')
+    assert janitor.deleted_files == 0
+
+
+def test_remove_deletes_job_directories(janitor, tmp_path):
+    path = janitor.job_directory(tmp_path / 'results', 'job1')
+    path.mkdir(parents=True)
+    (path / 'factura.zip').write_bytes(b'zip')
+    janitor._remove(path)
+    assert not path.exists()
+    assert janitor.deleted_bytes == 3
@@ -0,0 +1,36 @@
+import pytest
+
+from job_queue import SQLiteQueue, SharedJobQueue, JobLost
+from jobs import Job, DuplicateJob
+
+
+def spec(job_id, lane='interactive'):
+    return {"job_id": job_id, "lane": lane, "deadline": 0, "data": {}}
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return SQLiteQueue(path=tmp_path / 'queue.sqlite3')
+
+
+def test_duplicate_unfinished_job_id_is_refused(backend):
+    backend.enqueue(spec('job1'))
+    with pytest.raises(DuplicateJob):
+        backend.enqueue(spec('job1'))
+    assert backend.poll('job1') == ('queued', None)
+
+
+def test_job_id_is_free_again_once_done(backend):
+    backend.enqueue(spec('job1'))
+    backend.finish('job1', {"invoice_id": None})
+    backend.enqueue(spec('job1'))
+    assert backend.poll('job1') == ('queued', None)
+
+
+def test_requester_gives_up_on_a_job_that_left_the_queue(backend):
+    queue = SharedJobQueue(backend_name='sqlite')
+    queue._backend = backend
+    job = Job('job1', servicio='farmaciadelahorro', accion='facturar', timeout=30)
+    backend.enqueue = lambda spec: None
+    with pytest.raises(JobLost):
+        queue.run(job, {})
@@ -0,0 +1,94 @@
+import pytest
+
+from journal import JobJournal, DESCARGAR, INVOICED, OPEN, CLICKED
+from portals import AlreadyIssued
+
+TICKET = {'ticket': '123456', 'rfc': 'XAXX010101000', 'caja': '7'}
+
+
+class DownloadingPortal:
+    servicio = 'farmaciadelahorro'
+    default_action = 'facturar'
+    actions = ('facturar', DESCARGAR)
+
+
+class IssuingOnlyPortal:
+    servicio = 'guadalajara'
+    default_action = 'facturar'
+    actions = ('facturar',)
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return JobJournal(path=tmp_path / 'journal.sqlite3', abandon_after=0)
+
+
+def run_until(journal, job_id, portal, *events):
+    journal.begin(job_id, portal.servicio, portal.default_action, TICKET)
+    for event in events:
+        journal.step(job_id, 'obtener_factura', event, issues=True)
+
+
+def test_issuing_step_that_failed_before_clicking_is_not_issued(journal):
+    run_until(journal, 'job1', IssuingOnlyPortal, 'started', 'failed')
+    journal.finish('job1', 'failed')
+    assert journal.issued(IssuingOnlyPortal.servicio, TICKET) is None
+    assert journal.resume_action(IssuingOnlyPortal, 'facturar', TICKET) == 'facturar'
+
+
+def test_clicked_issuing_step_marks_the_ticket_issued(journal):
+    run_until(journal, 'job1', IssuingOnlyPortal, 'started', CLICKED, 'failed')
+    journal.finish('job1', 'failed')
+    previous = journal.issued(IssuingOnlyPortal.servicio, TICKET)
+    assert previous["job_id"] == 'job1'
+    with pytest.raises(AlreadyIssued):
+        journal.resume_action(IssuingOnlyPortal, 'facturar', TICKET)
+    assert journal.resume_action(IssuingOnlyPortal, 'facturar', dict(TICKET, resubmit=True)) == 'facturar'
+
+
+def test_steps_that_do_not_issue_never_mark_the_ticket(journal):
+    journal.begin('job1', IssuingOnlyPortal.servicio, 'facturar', TICKET)
+    journal.step('job1', 'buscar_ticket', 'started')
+    journal.step('job1', 'buscar_ticket', CLICKED)
+    journal.finish('job1', 'failed')
+    assert journal.issued(IssuingOnlyPortal.servicio, TICKET) is None
+
+
+def test_issued_ticket_is_downloaded_where_the_portal_can(journal):
+    run_until(journal, 'job1', DownloadingPortal, 'started', CLICKED)
+    journal.finish('job1', 'failed')
+    assert journal.resume_action(DownloadingPortal, 'facturar', TICKET) == DESCARGAR
+
+
+def test_completed_job_settles_the_ticket_and_later_requests_download(journal):
+    run_until(journal, 'job1', DownloadingPortal, 'started', CLICKED)
+    journal.finish('job1', 'failed')
+    run_until(journal, 'job2', DownloadingPortal, 'started', CLICKED, 'done')
+    journal.finish('job2', 'completed')
+    assert journal.issued(DownloadingPortal.servicio, TICKET) is None
+    assert journal.ticket_state(DownloadingPortal.servicio, TICKET) == INVOICED
+    assert journal.resume_action(DownloadingPortal, 'facturar', TICKET) == DESCARGAR
+
+
+def test_open_ticket_settles_an_uncertain_issue(journal):
+    run_until(journal, 'job1', IssuingOnlyPortal, 'started', CLICKED)
+    journal.finish('job1', 'failed')
+    journal.remember(IssuingOnlyPortal.servicio, TICKET, OPEN)
+    assert journal.resume_action(IssuingOnlyPortal, 'facturar', TICKET) == 'facturar'
+
+
+def test_explicit_actions_are_left_alone(journal):
+    run_until(journal, 'job1', IssuingOnlyPortal, 'started', CLICKED)
+    journal.finish('job1', 'failed')
+    assert journal.resume_action(IssuingOnlyPortal, DESCARGAR, TICKET) == DESCARGAR
+
+
+def test_interrupted_hands_out_only_issued_jobs_once(journal):
+    run_until(journal, 'clicked', IssuingOnlyPortal, 'started', CLICKED)
+    journal.begin('unclicked', IssuingOnlyPortal.servicio, 'facturar', dict(TICKET, ticket='999'))
+    journal.step('unclicked', 'obtener_factura', 'started', issues=True)
+    claimed = journal.interrupted()
+    assert [job["job_id"] for job in claimed] == ['clicked']
+    assert claimed[0]["data"]["ticket"] == TICKET["ticket"]
+    assert journal.interrupted() == []
+    assert journal.status()["jobs"] == {'interrupted': 1, 'abandoned': 1}
@@ -0,0 +1,70 @@
+import logging
+
+import pytest
+
+import log_config
+from log_config import JobAwareLogger, JobContextFilter, job_context
+
+
+class Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def handler():
+    """A handler set up like setup_logging's, with the root logger at INFO"""
+    root = logging.getLogger()
+    level = root.level
+    collect = Collect()
+    collect.addFilter(JobContextFilter())
+    root.addHandler(collect)
+    root.setLevel(logging.INFO)
+    yield collect
+    root.removeHandler(collect)
+    root.setLevel(level)
+
+
+def test_global_level_applies_outside_jobs(handler):
+    logger = logging.getLogger('tests.outside')
+    assert not logger.isEnabledFor(logging.DEBUG)
+    logger.debug("hidden")
+    logger.info("shown")
+    assert [r.getMessage() for r in handler.records] == ["shown"]
+    assert handler.records[0].job_id is None
+
+
+def test_debug_job_lowers_the_level_and_tags_records(handler):
+    logger = logging.getLogger('tests.job')
+    with job_context('job1', 'farmaciadelahorro', logging.DEBUG):
+        log_config.set_step('buscar_ticket')
+        assert logger.isEnabledFor(logging.DEBUG)
+        logger.debug("detail %s", 1)
+    assert not logger.isEnabledFor(logging.DEBUG)
+    record, = handler.records
+    assert (record.getMessage(), record.job_id, record.servicio, record.step) == (
+        "detail 1", 'job1', 'farmaciadelahorro', 'buscar_ticket')
+
+
+def test_loggers_created_before_the_module_are_adopted(monkeypatch):
+    # As if the logger had been created before log_config set the logger class
+    monkeypatch.setattr(logging.Logger.manager, 'loggerClass', logging.Logger)
+    logger = logging.getLogger('tests.early')
+    assert type(logger) is logging.Logger
+    log_config._adopt_loggers()
+    assert type(logger) is JobAwareLogger
+    with job_context('job1', level=logging.DEBUG):
+        assert logger.isEnabledFor(logging.DEBUG)
+
+
+def test_loggers_with_their_own_level_keep_it(handler, monkeypatch):
+    quiet = logging.getLogger('tests.quiet')
+    monkeypatch.setattr(quiet, 'level', logging.WARNING)
+    with job_context('job1', level=logging.DEBUG):
+        logging.getLogger('tests.quiet.child').info("hidden")
+        quiet.warning("shown")
+    assert [r.getMessage() for r in handler.records] == ["shown"]
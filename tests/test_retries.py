@@ -0,0 +1,54 @@
+import socket
+
+import pytest
+
+import retries
+from retries import check_webhook_url, InvalidWebhook
+
+
+@pytest.fixture
+def resolve(monkeypatch):
+    """Answer name lookups from a dict instead of DNS"""
+    names = {}
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        if host not in names:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET6 if ':' in address else socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                 (address, port or 0)) for address in names[host]]
+
+    monkeypatch.setattr(retries.socket, 'getaddrinfo', getaddrinfo)
+    return names
+
+
+def test_public_host_is_accepted(resolve):
+    resolve['hooks.example.com'] = ['93.184.216.34', '2606:2800:220:1::1']
+    check_webhook_url('https://hooks.example.com:8443/cfdi?x=1')
+
+
+@pytest.mark.parametrize('address', [
+    '127.0.0.1', '10.1.2.3', '172.16.0.5', '192.168.1.10', '169.254.169.254', '100.64.0.1',
+    '0.0.0.0', '224.0.0.1', '::1', 'fe80::1', 'fd00::1', '::ffff:127.0.0.1',
+])
+def test_internal_addresses_are_refused(resolve, address):
+    resolve['hooks.example.com'] = ['93.184.216.34', address]
+    with pytest.raises(InvalidWebhook):
+        check_webhook_url('https://hooks.example.com/cfdi')
+
+
+@pytest.mark.parametrize('url', ['ftp://hooks.example.com/x', 'hooks.example.com/x', 'https:///x', 'file:///etc/passwd'])
+def test_only_http_urls_are_accepted(resolve, url):
+    resolve['hooks.example.com'] = ['93.184.216.34']
+    with pytest.raises(InvalidWebhook):
+        check_webhook_url(url)
+
+
+def test_unresolvable_host_is_refused(resolve):
+    with pytest.raises(InvalidWebhook):
+        check_webhook_url('https://nowhere.invalid/cfdi')
+
+
+def test_bad_port_is_refused(resolve):
+    resolve['hooks.example.com'] = ['93.184.216.34']
+    with pytest.raises(InvalidWebhook):
+        check_webhook_url('https://hooks.example.com:99999/cfdi')
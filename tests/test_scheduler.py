@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+from scheduler import PortalLimit
+from settings import PORTAL_BACKOFF_SECONDS, PORTAL_SLOWDOWN_FACTOR
+
+
+def job(accion='facturar', seconds=10.0, status='done', http_errors=None):
+    steps = [{"name": "step", "status": status, "seconds": seconds}]
+    return SimpleNamespace(accion=accion, steps=steps, http_errors=http_errors or {})
+
+
+@pytest.fixture
+def limit():
+    return PortalLimit('farmaciadelahorro', max_sessions=2, rate_per_minute=6, burst=2)
+
+
+def run(limit, finished, now=100.0):
+    limit.start()
+    limit.finish(finished, now)
+
+
+def test_clean_jobs_set_the_typical_time_per_action(limit):
+    run(limit, job('preflight', seconds=2))
+    run(limit, job('facturar', seconds=30))
+    assert limit.typical_seconds == {'preflight': 2, 'facturar': 30}
+    assert limit.backoffs == 0
+
+
+def test_slow_action_is_compared_with_its_own_baseline(limit):
+    run(limit, job('preflight', seconds=2))
+    run(limit, job('facturar', seconds=30))
+    run(limit, job('descargar', seconds=25))
+    assert limit.backoffs == 0
+    run(limit, job('facturar', seconds=30 * PORTAL_SLOWDOWN_FACTOR + 1))
+    assert limit.backoffs == 1
+    assert limit.rate == limit.limit / 2
+
+
+def test_failed_jobs_neither_count_as_slow_nor_move_the_baseline(limit):
+    run(limit, job(seconds=10))
+    run(limit, job(seconds=10 * PORTAL_SLOWDOWN_FACTOR * 3, status='failed'))
+    assert limit.backoffs == 0
+    assert limit.typical_seconds == {'facturar': 10}
+
+
+def test_429_pauses_the_portal_and_doubles_while_it_repeats(limit):
+    run(limit, job(status='failed', http_errors={"429": 1}), now=100.0)
+    assert limit.paused_until == 100.0 + PORTAL_BACKOFF_SECONDS
+    run(limit, job(status='failed', http_errors={"429": 2}), now=200.0)
+    assert limit.strikes == 2
+    assert limit.paused_until == 200.0 + PORTAL_BACKOFF_SECONDS * 2
+    assert limit.rate == pytest.approx(limit.limit / 4)
+
+
+def test_clean_jobs_win_the_rate_back(limit):
+    run(limit, job(http_errors={"5xx": 3}))
+    assert limit.rate == limit.limit / 2
+    for _ in range(10):
+        run(limit, job())
+    assert limit.rate == limit.limit
+    assert limit.strikes == 0
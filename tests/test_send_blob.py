@@ -0,0 +1,96 @@
+import hashlib
+
+import pytest
+
+flask = pytest.importorskip('flask')
+
+CONTENT = bytes(range(256)) * 40
+ETAG = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture(scope='module')
+def app_module():
+    import startup
+    from job_queue import job_queue
+    from retries import retry_scheduler
+
+    # Importing app starts the background services; send_blob needs none of them
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(startup, 'start', lambda: None)
+        patch.setattr(retry_scheduler, 'start', lambda *args: None)
+        patch.setattr(job_queue, 'start', lambda *args: None)
+        import app
+        yield app
+
+
+@pytest.fixture
+def blob(tmp_path):
+    path = tmp_path / 'factura.pdf'
+    path.write_bytes(CONTENT)
+    return path
+
+
+@pytest.fixture
+def get(app_module, blob):
+    def get(**headers):
+        with app_module.app.test_request_context(headers=headers):
+            response = app_module.send_blob(blob, ETAG, 'factura ñ.pdf', 'application/pdf')
+            response.direct_passthrough = False
+            return response.status_code, response.headers, response.get_data()
+    return get
+
+
+def test_full_download(get):
+    status, headers, body = get()
+    assert status == 200
+    assert body == CONTENT
+    assert headers["ETag"] == f'"{ETAG}"'
+    assert headers["Content-Length"] == str(len(CONTENT))
+    assert "filename*=UTF-8''factura%20%C3%B1.pdf" in headers["Content-Disposition"]
+
+
+@pytest.mark.parametrize('if_none_match', [f'"{ETAG}"', f'W/"{ETAG}"', f'"other", "{ETAG}"', '*'])
+def test_matching_etag_answers_304(get, if_none_match):
+    status, _, body = get(**{'If-None-Match': if_none_match})
+    assert status == 304
+    assert body == b''
+
+
+def test_other_etag_gets_the_file(get):
+    status, _, body = get(**{'If-None-Match': '"other"'})
+    assert (status, body) == (200, CONTENT)
+
+
+@pytest.mark.parametrize('spec, start, stop', [
+    ('bytes=100-199', 100, 200),
+    ('bytes=10000-', 10000, len(CONTENT)),
+    ('bytes=-24', len(CONTENT) - 24, len(CONTENT)),
+])
+def test_single_range_answers_206(get, spec, start, stop):
+    status, headers, body = get(Range=spec)
+    assert status == 206
+    assert body == CONTENT[start:stop]
+    assert headers["Content-Range"] == f"bytes {start}-{stop - 1}/{len(CONTENT)}"
+    assert headers["Content-Length"] == str(stop - start)
+
+
+def test_unsatisfiable_range_answers_416(get):
+    status, headers, _ = get(Range=f'bytes={len(CONTENT)}-')
+    assert status == 416
+    assert headers["Content-Range"] == f"bytes */{len(CONTENT)}"
+
+
+def test_multiple_ranges_get_the_whole_file(get):
+    status, headers, body = get(Range='bytes=0-9,100-109')
+    assert (status, body) == (200, CONTENT)
+    assert "Content-Range" not in headers
+
+
+def test_range_with_stale_if_range_gets_the_whole_file(get):
+    status, _, body = get(Range='bytes=0-9', **{'If-Range': '"other"'})
+    assert (status, body) == (200, CONTENT)
+
+
+def test_range_with_current_if_range_is_honoured(get):
+    status, _, body = get(Range='bytes=0-9', **{'If-Range': f'"{ETAG}"'})
+    assert (status, body) == (206, CONTENT[:10])
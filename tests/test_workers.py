@@ -0,0 +1,60 @@
+import queue
+
+import pytest
+
+import workers
+
+
+def spec(job_id):
+    return {"job_id": job_id, "servicio": 'farmaciadelahorro', "accion": 'facturar', "timeout": 30,
+            "log_level": None, "data": {}, "download_dir": '/nonexistent', "result_dir": '/nonexistent'}
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    def execute_job(job, data, download_dir, result_dir, driver_pool):
+        job.token.check()
+        return None
+
+    monkeypatch.setattr(workers, 'execute_job', execute_job)
+    return workers._WorkerLoop(1, queue.Queue(), queue.Queue(), pool=None)
+
+
+def read(loop, *messages):
+    for message in messages + (('stop',),):
+        loop.tasks.put(message)
+    loop._read_tasks()
+
+
+def run_next(loop):
+    # Each read() also queued the None that stops the loop
+    spec = loop._jobs.get()
+    while spec is None:
+        spec = loop._jobs.get()
+    loop._run(spec)
+
+
+def results(loop):
+    outcome = {}
+    while not loop.events.empty():
+        _, _, job_id, result = loop.events.get()
+        outcome[job_id] = result["cancel_reason"]
+    return outcome
+
+
+def test_early_cancel_of_a_later_job_survives_the_jobs_before_it(loop):
+    read(loop, ('job', spec('a')), ('job', spec('b')), ('cancel', 'b', 'api'))
+    run_next(loop)
+    run_next(loop)
+    assert results(loop) == {'a': None, 'b': 'api'}
+
+
+def test_cancel_of_a_finished_job_is_dropped(loop):
+    read(loop, ('job', spec('a')))
+    run_next(loop)
+    read(loop, ('cancel', 'a', 'api'))
+    assert loop._early_cancels == {}
+    # A later job reusing the client's id starts clean
+    read(loop, ('job', spec('a')))
+    run_next(loop)
+    assert results(loop) == {'a': None}
@@ -0,0 +1,600 @@
+import os
+import time
+import queue
+import atexit
+import shutil
+import signal
+import logging
+import threading
+import multiprocessing
+from pathlib import Path
+from urllib.parse import urlparse
+
+import cfdi
+import portals
+import sat
+from browser_tracker import tree_rss_mb
+from diagnostics import snapshot_store, read_performance_log, portal_errors
+from jobs import Job, JobCancelled
+from journal import job_journal
+from log_config import setup_logging, listen_to_workers, job_context, step_var, job_level_var
+from settings import (
+    WORKER_PROCESSES, WORKER_HEARTBEAT_INTERVAL, WORKER_HEARTBEAT_TIMEOUT,
+    WORKER_HANG_TIMEOUT, WORKER_START_TIMEOUT, WORKER_MAX_RSS_MB, CANCEL_GRACE_PERIOD,
+)
+
+logger = logging.getLogger(__name__)
+
+# Supervised worker processes.
+#
+# Selenium jobs run in child processes, each owning its own driver pool. The
+# web process only dispatches jobs over a queue and waits for the result, so
+# a chromedriver call that never returns blocks one worker instead of the
+# gunicorn worker and every other job in it. The supervisor watches worker
+# heartbeats and job progress, hard-kills a worker (with its chromedriver and
+# Chrome processes) when it hangs or grows past its memory cap, and spawns a
+# replacement.
+
+# How long a cancelled job may keep its worker before the worker is killed
+CANCEL_KILL_DELAY = 10
+
+# Startup failures back off up to this many seconds between respawns
+MAX_RESPAWN_DELAY = 60
+
+
+def force_quit_on_cancel(job, store):
+    """Quit the driver if the job has not unwound shortly after cancellation"""
+    def on_cancel(reason):
+        def quit_if_stuck():
+            if not job.finished and store.driver:
+                logger.warning("Job %s still running %ss after cancel (%s), quitting driver", job.id, CANCEL_GRACE_PERIOD, reason)
+                try:
+                    store.close_driver()
+                except Exception as e:
+                    logger.error("Force quit failed: %s", str(e))
+
+        timer = threading.Timer(CANCEL_GRACE_PERIOD, quit_if_stuck)
+        timer.daemon = True
+        timer.start()
+
+    job.token.add_callback(on_cancel)
+
+
+def record_portal_errors(job, store):
+    """Count the portal's 429/5xx answers for its rate limit; returns the drained network log"""
+    if not store or not store.driver:
+        return None
+    entries = read_performance_log(store.driver)
+    job.http_errors = portal_errors(entries, urlparse(portals.get_adapter(job.servicio).url).hostname)
+    return entries
+
+
+def execute_job(job, data, download_dir, result_dir, driver_pool):
+    """Drive the portal for one job and return the path of the invoice ZIP in result_dir"""
+    from service_store import ServiceStore
+
+    adapter_cls = portals.get_adapter(job.servicio)
+    # Preflight checks never reach an issuing step, so they stay out of the journal
+    journaled = job.accion != portals.PREFLIGHT
+    if journaled:
+        # A ticket an earlier job may have issued is downloaded, not submitted again
+        job.accion = job_journal.resume_action(adapter_cls, job.accion, data)
+        job_journal.begin(job.id, job.servicio, job.accion, data)
+
+    outcome = 'failed'
+    store = None
+    try:
+        store = ServiceStore(download_directory=download_dir, cancel_token=job.token, driver_pool=driver_pool)
+        force_quit_on_cancel(job, store)
+        store.setup_driver(job.servicio)
+
+        # Process the form with the portal's adapter
+        adapter = adapter_cls(store, job_id=job.id if journaled else None)
+        job.steps = adapter.timings
+        result = adapter.run(data, job.accion)
+        # The flow may have switched to another action (an invoiced ticket is downloaded)
+        job.accion = adapter.accion
+        record_portal_errors(job, store)
+        if job.accion == portals.PREFLIGHT:
+            # Only the ticket check ran; the pool resets the half-filled page
+            store.close_driver(reuse=True)
+            return None
+        zip_file_path = Path(result)
+
+        # Read what the portal issued; the ZIP is named after the CFDI UUID
+        job.cfdi = cfdi.parse_zip(zip_file_path)
+        if job.cfdi:
+            cfdi.add_manifest(zip_file_path, job.cfdi)
+        name = f"factura_{job.cfdi['uuid']}.zip" if job.cfdi and job.cfdi["uuid"] else zip_file_path.name
+
+        # Move the ZIP out of the job's download dir, which is deleted afterwards
+        zip_path = Path(result_dir) / name
+        zip_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(zip_file_path), zip_path)
+
+        store.close_driver(reuse=True)
+        outcome = 'completed'
+        return zip_path
+
+    except portals.PortalRejected:
+        # The portal answered normally, it just refused the data
+        outcome = 'rejected'
+        record_portal_errors(job, store)
+        if store:
+            store.close_driver(reuse=True)
+        raise
+
+    except Exception as e:
+        # One-shot failure snapshot while the browser still shows the failing page
+        if store and store.driver:
+            try:
+                performance = record_portal_errors(job, store)
+                snapshot_store.capture(store.driver, job.id, error=e, step=step_var.get(),
+                                       extra={"servicio": job.servicio, "accion": job.accion},
+                                       performance=performance)
+                job.has_diagnostics = True
+            except Exception as snapshot_error:
+                logger.error("Failure snapshot failed: %s", str(snapshot_error))
+        raise
+
+    finally:
+        if store:
+            store.close_driver()
+        if journaled:
+            job_journal.finish(job.id, 'cancelled' if job.token.cancelled else outcome)
+
+
+def kill_process_group(process):
+    """SIGKILL a worker and everything it started; workers lead their own group"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        try:
+            process.kill()
+        except Exception:
+            pass
+
+
+# -- worker process --
+
+def worker_main(worker_id, tasks, events, log_queue):
+    """Entry point of a worker process"""
+    # Own process group, so a hard kill also takes chromedriver and Chrome
+    os.setsid()
+    setup_logging(log_queue)
+
+    try:
+        import startup
+        sat.load_index()
+        for adapter in portals.enabled_adapters():
+            adapter.compile()
+        pool = startup.get_driver_pool()
+        pool.warm()
+        if pool.last_error is not None:
+            raise RuntimeError(f"driver pool: {pool.last_error}")
+    except Exception as e:
+        logger.error("Worker %s failed to start: %s", worker_id, str(e))
+        events.put(('failed', worker_id, str(e)))
+        return
+
+    _WorkerLoop(worker_id, tasks, events, pool).serve()
+
+
+class _WorkerLoop:
+    """Runs jobs one at a time; side threads read control messages and send heartbeats"""
+
+    def __init__(self, worker_id, tasks, events, pool):
+        self.worker_id = worker_id
+        self.tasks = tasks
+        self.events = events
+        self.pool = pool
+        self.parent_pid = os.getppid()
+        self.current = None
+        self._jobs = queue.Queue()
+        # Jobs handed to this worker but not started yet, and cancels sent for them
+        self._queued = set()
+        self._early_cancels = {}
+        self._cancel_lock = threading.Lock()
+
+    def serve(self):
+        threading.Thread(target=self._read_tasks, name="tasks", daemon=True).start()
+        threading.Thread(target=self._heartbeat, name="heartbeat", daemon=True).start()
+        self.events.put(('ready', self.worker_id))
+
+        while True:
+            spec = self._jobs.get()
+            if spec is None:
+                break
+            self._run(spec)
+
+        self.pool.shutdown()
+        logger.info("Worker %s stopped", self.worker_id)
+
+    def _read_tasks(self):
+        while True:
+            message = self.tasks.get()
+            if message[0] == 'job':
+                with self._cancel_lock:
+                    self._queued.add(message[1]['job_id'])
+                self._jobs.put(message[1])
+            elif message[0] == 'cancel':
+                _, job_id, reason = message
+                with self._cancel_lock:
+                    job = self.current
+                    if job and job.id == job_id:
+                        job.token.cancel(reason)
+                    elif job_id in self._queued:
+                        self._early_cancels[job_id] = reason
+                    # Otherwise the job has finished already
+            elif message[0] == 'stop':
+                self._jobs.put(None)
+                return
+
+    def _heartbeat(self):
+        while True:
+            if os.getppid() != self.parent_pid:
+                # The web process is gone; take our browsers down with us
+                os.killpg(os.getpgid(0), signal.SIGKILL)
+            job = self.current
+            self.events.put(('heartbeat', self.worker_id, {
+                "job_id": job.id if job else None,
+                "idle_seconds": round(time.monotonic() - job.token.last_check, 1) if job else 0,
+                "steps": [dict(step) for step in job.steps] if job else None,
+                "pool": self.pool.status(),
+            }))
+            time.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+    def _run(self, spec):
+        job = Job(spec['job_id'], servicio=spec['servicio'], accion=spec['accion'], timeout=spec['timeout'])
+        with self._cancel_lock:
+            self.current = job
+            self._queued.discard(job.id)
+            early_cancel = self._early_cancels.pop(job.id, None)
+        if early_cancel:
+            job.token.cancel(early_cancel)
+
+        result = {"zip_path": None, "error": None, "cancel_reason": None}
+        try:
+            with job_context(job.id, job.servicio, spec['log_level']):
+                zip_path = execute_job(job, spec['data'], spec['download_dir'], spec['result_dir'], self.pool)
+            result["zip_path"] = str(zip_path) if zip_path else None
+        except JobCancelled as e:
+            result["cancel_reason"] = e.reason
+        except Exception as e:
+            result["error"] = str(e)
+            # Rejections keep their class (PortalRejected or a subclass) across the queue
+            result["rejected"] = type(e).__name__ if isinstance(e, portals.PortalRejected) else None
+        finally:
+            self.current = None
+
+        # The journal or the flow may have turned the job into a download
+        result["accion"] = job.accion
+        result["has_diagnostics"] = job.has_diagnostics
+        result["cfdi"] = job.cfdi
+        result["http_errors"] = job.http_errors
+        result["steps"] = [dict(step) for step in job.steps]
+        self.events.put(('result', self.worker_id, job.id, result))
+
+
+def result_error(result):
+    """The exception a job's result message stands for, or None if it succeeded"""
+    if result["cancel_reason"]:
+        return JobCancelled(result["cancel_reason"])
+    if result["error"]:
+        return (getattr(portals, result["rejected"]) if result.get("rejected") else Exception)(result["error"])
+    return None
+
+
+# -- supervisor (web process) --
+
+class _Submission:
+    """A job handed to a worker, resolved by the result message or by the monitor"""
+
+    def __init__(self, job):
+        self.job = job
+        self.done = threading.Event()
+        self.zip_path = None
+        self.error = None
+        self.stuck_since = None
+
+
+class _WorkerHandle:
+    def __init__(self, worker_id, process, tasks):
+        self.id = worker_id
+        self.process = process
+        self.tasks = tasks
+        self.started = time.monotonic()
+        self.ready = False
+        self.last_heartbeat = None
+        self.idle_seconds = 0
+        self.rss_mb = None
+        self.pool = None
+        self.submission = None
+        self.retiring = False
+
+
+class WorkerSupervisor:
+    """
+    Owns the worker processes: dispatch, heartbeats, hang and memory
+    enforcement, respawn.
+    """
+
+    def __init__(self, processes=WORKER_PROCESSES):
+        self.processes = processes
+        self._ctx = multiprocessing.get_context('spawn')
+        self._events = None
+        self._log_queue = None
+        self._workers = {}
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._started = False
+        self._failures = 0
+        self._respawn_at = 0
+        self.restarts = 0
+        self.last_error = None
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._events = self._ctx.Queue()
+        self._log_queue = self._ctx.Queue()
+        listen_to_workers(self._log_queue)
+        for _ in range(self.processes):
+            self._spawn()
+        threading.Thread(target=self._collect, name="worker-events", daemon=True).start()
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+        atexit.register(self.shutdown)
+
+    def _spawn(self):
+        with self._lock:
+            self._next_id += 1
+            worker_id = self._next_id
+        tasks = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=worker_main, args=(worker_id, tasks, self._events, self._log_queue),
+            name=f"worker-{worker_id}", daemon=True,
+        )
+        process.start()
+        with self._lock:
+            self._workers[worker_id] = _WorkerHandle(worker_id, process, tasks)
+        logger.info("Started worker %s (pid %s)", worker_id, process.pid)
+
+    # -- request-thread API --
+
+    def run(self, job, data, download_dir, result_dir):
+        """Run a job on an idle worker and block until it finishes; returns the ZIP path"""
+        submission = _Submission(job)
+        worker = self._checkout(submission)
+        job.status = "running"
+        worker.tasks.put(('job', {
+            "job_id": job.id,
+            "servicio": job.servicio,
+            "accion": job.accion,
+            "timeout": job.token.remaining(),
+            "log_level": job_level_var.get(),
+            "data": data,
+            "download_dir": str(download_dir),
+            "result_dir": str(result_dir),
+        }))
+
+        def forward_cancel(reason):
+            if not submission.done.is_set():
+                worker.tasks.put(('cancel', job.id, reason))
+
+        job.token.add_callback(forward_cancel)
+        logger.info("Job %s dispatched to worker %s", job.id, worker.id)
+
+        submission.done.wait()
+        if submission.error is not None:
+            raise submission.error
+        return Path(submission.zip_path) if submission.zip_path else None
+
+    def _checkout(self, submission):
+        """Wait for an idle worker without ignoring cancellation, and claim it"""
+        while True:
+            submission.job.token.check()
+            try:
+                worker_id = self._idle.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self._lock:
+                worker = self._workers.get(worker_id)
+                if worker and worker.ready and worker.submission is None and not worker.retiring:
+                    worker.submission = submission
+                    return worker
+
+    def _resolve(self, submission, zip_path=None, error=None):
+        submission.zip_path = zip_path
+        submission.error = error
+        submission.done.set()
+        if isinstance(error, JobCancelled):
+            # Keep the web-side token in step with the worker's, for /jobs/<id>
+            submission.job.token.cancel(error.reason)
+
+    # -- background threads --
+
+    def _collect(self):
+        """Apply ready / heartbeat / result / failed messages from the workers"""
+        while True:
+            try:
+                message = self._events.get()
+            except (EOFError, OSError):
+                return
+            kind, worker_id = message[0], message[1]
+            with self._lock:
+                worker = self._workers.get(worker_id)
+            if worker is None:
+                continue
+
+            if kind == 'ready':
+                worker.ready = True
+                worker.last_heartbeat = time.monotonic()
+                self._failures = 0
+                logger.info("Worker %s ready after %.1fs", worker_id, time.monotonic() - worker.started)
+                self._idle.put(worker_id)
+
+            elif kind == 'heartbeat':
+                info = message[2]
+                worker.last_heartbeat = time.monotonic()
+                worker.idle_seconds = info["idle_seconds"]
+                worker.pool = info["pool"]
+                submission = worker.submission
+                if submission and info["job_id"] == submission.job.id:
+                    submission.job.steps = info["steps"]
+
+            elif kind == 'result':
+                job_id, result = message[2], message[3]
+                with self._lock:
+                    submission = worker.submission
+                    if submission is None or submission.job.id != job_id:
+                        continue
+                    worker.submission = None
+                submission.job.accion = result["accion"]
+                submission.job.steps = result["steps"]
+                submission.job.has_diagnostics = result["has_diagnostics"]
+                submission.job.cfdi = result["cfdi"]
+                submission.job.http_errors = result["http_errors"]
+                self._resolve(submission, zip_path=result["zip_path"], error=result_error(result))
+
+                if worker.retiring:
+                    self._replace(worker, f"retired after reaching {worker.rss_mb} MB", graceful=True)
+                else:
+                    self._idle.put(worker_id)
+
+            elif kind == 'failed':
+                self.last_error = message[2]
+
+    def _monitor(self):
+        while True:
+            time.sleep(WORKER_HEARTBEAT_INTERVAL)
+            with self._lock:
+                workers = list(self._workers.values())
+            for worker in workers:
+                try:
+                    self._check(worker, time.monotonic())
+                except Exception as e:
+                    logger.error("Worker monitor failed for worker %s: %s", worker.id, str(e))
+
+            with self._lock:
+                missing = self.processes - len(self._workers)
+            if missing > 0 and time.monotonic() >= self._respawn_at:
+                self._spawn()
+
+    def _check(self, worker, now):
+        if not worker.process.is_alive():
+            self._replace(worker, f"exited with code {worker.process.exitcode}")
+            return
+        if not worker.ready:
+            if now - worker.started > WORKER_START_TIMEOUT:
+                self._replace(worker, f"did not start within {WORKER_START_TIMEOUT}s")
+            return
+        if now - worker.last_heartbeat > WORKER_HEARTBEAT_TIMEOUT:
+            self._replace(worker, f"missed heartbeats for {now - worker.last_heartbeat:.0f}s")
+            return
+
+        submission = worker.submission
+        if submission is not None:
+            if worker.idle_seconds > WORKER_HANG_TIMEOUT:
+                self._replace(worker, f"made no progress for {worker.idle_seconds:.0f}s")
+                return
+            token = submission.job.token
+            if token.cancelled or token.remaining() == 0:
+                if submission.stuck_since is None:
+                    submission.stuck_since = now
+                elif now - submission.stuck_since > CANCEL_KILL_DELAY:
+                    self._replace(worker, f"did not stop job {submission.job.id} after cancellation")
+                    return
+
+        worker.rss_mb = tree_rss_mb(worker.process.pid)
+        if worker.rss_mb > WORKER_MAX_RSS_MB:
+            with self._lock:
+                busy = worker.submission is not None
+                worker.retiring = True
+            if not busy:
+                self._replace(worker, f"idle at {worker.rss_mb} MB, over the {WORKER_MAX_RSS_MB} MB cap", graceful=True)
+            elif worker.rss_mb > 2 * WORKER_MAX_RSS_MB:
+                self._replace(worker, f"reached {worker.rss_mb} MB, twice the memory cap")
+            else:
+                logger.warning("Worker %s at %s MB, retiring it after the current job", worker.id, worker.rss_mb)
+
+    def _replace(self, worker, reason, graceful=False):
+        """Take a worker out of service, fail its job if any, and schedule a replacement"""
+        with self._lock:
+            if self._workers.get(worker.id) is not worker:
+                return
+            del self._workers[worker.id]
+            submission, worker.submission = worker.submission, None
+            self.restarts += 1
+            if not worker.ready:
+                self._failures += 1
+                self._respawn_at = time.monotonic() + min(MAX_RESPAWN_DELAY, 2 ** self._failures)
+
+        if graceful:
+            logger.info("Stopping worker %s: %s", worker.id, reason)
+            worker.tasks.put(('stop',))
+        else:
+            logger.error("Killing worker %s: %s", worker.id, reason)
+            self.last_error = f"worker {worker.id} {reason}"
+        threading.Thread(target=self._reap, args=(worker, graceful), name=f"reap-{worker.id}", daemon=True).start()
+
+        if submission is not None:
+            for step in submission.job.steps or ():
+                if step.get("status") == "running":
+                    step["status"] = "killed"
+            token = submission.job.token
+            if token.cancelled:
+                error = JobCancelled(token.reason)
+            elif token.remaining() == 0:
+                error = JobCancelled("deadline")
+            else:
+                error = Exception(f"Worker process {reason}")
+            self._resolve(submission, error=error)
+
+    def _reap(self, worker, graceful):
+        if graceful:
+            worker.process.join(10)
+        # Also clears any Chrome processes a cleanly exited worker left behind
+        kill_process_group(worker.process)
+        worker.process.join(5)
+
+    def shutdown(self):
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for worker in workers:
+            worker.tasks.put(('stop',))
+        for worker in workers:
+            worker.process.join(5)
+            kill_process_group(worker.process)
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            workers = list(self._workers.values())
+        return {
+            "processes": self.processes,
+            "ready": sum(1 for worker in workers if worker.ready),
+            "busy": sum(1 for worker in workers if worker.submission is not None),
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            "workers": [
+                {
+                    "id": worker.id,
+                    "pid": worker.process.pid,
+                    "ready": worker.ready,
+                    "job_id": worker.submission.job.id if worker.submission else None,
+                    "idle_seconds": worker.idle_seconds,
+                    "rss_mb": worker.rss_mb,
+                    "heartbeat_age": round(now - worker.last_heartbeat, 1) if worker.last_heartbeat else None,
+                    "retiring": worker.retiring,
+                    "driver_pool": worker.pool,
+                }
+                for worker in workers
+            ],
+        }
+
+
+supervisor = WorkerSupervisor()